@@ -1,48 +1,121 @@
 #!/usr/bin/env python2.7
 
+import glob
 import itertools
+import json
+import multiprocessing
 import numpy as np
+import os
+import re
 import sys
 
 import argh
 
-from helper_functions import convert_to_complex
+from helper_functions import convert_to_float_table
+from pyramid import build_pyramid, get_dpi, save_pyramid, select_level
+from xmlparser import read_params
+
+
+CHUNK_LINES = 1000000
+# largest relative deviation of the inferred grid shape from the estimate
+# (at least GRID_SHAPE_SLACK points), see infer_grid_shape
+GRID_SHAPE_TOLERANCE = 0.05
+GRID_SHAPE_SLACK = 2
+READ_BUFFER = 2**24
+# blank and comment lines (after a newline), which are skipped by
+# convert_to_float_table
+NON_DATA_LINE = re.compile(r'\n[ \t\r\f\v]*(?:#[^\n]*)?(?=\n)')
+
+
+def infer_grid_shape(npoints, r_nx, r_ny, tolerance=GRID_SHAPE_TOLERANCE):
+    """Return the grid dimensions (r_nx, r_ny) with r_nx*r_ny = npoints which
+    are closest to the estimated dimensions (r_nx, r_ny).
+
+    An exception is raised if the closest divisor pair deviates from the
+    estimate by more than the relative tolerance (or GRID_SHAPE_SLACK
+    points) in either dimension, e.g., for a truncated file.
+    """
+
+    d = np.arange(1, int(np.sqrt(npoints)) + 1)
+    d = d[npoints % d == 0]
+    nx = np.concatenate((d, npoints // d))
+    ny = npoints // nx
+
+    idx = np.argmin((nx - r_nx)**2 + (ny - r_ny)**2)
+    nx, ny = int(nx[idx]), int(ny[idx])
+
+    for n, n_est in ((nx, r_nx), (ny, r_ny)):
+        if abs(n - n_est) > max(GRID_SHAPE_SLACK, tolerance*n_est):
+            raise Exception(("Error: {} data points do not fit the estimated "
+                             "grid (r_nx, r_ny) = ({}, {}), closest is ({}, "
+                             "{}).").format(npoints, r_nx, r_ny, nx, ny))
+
+    return nx, ny
+
+
+def get_grid_shape(npoints, L=None, W=None, pphw=None, N=None, r_nx=None,
+                   r_ny=None, xml=None):
+    """Return the grid dimensions (r_nx, r_ny) of a wavefunction with npoints
+    entries.
+
+    If r_nx and r_ny are not supplied, they are estimated from the companion
+    xml file or from pphw, N, L and W, and resolved to the divisor pair of
+    npoints closest to this estimate.
+    """
+
+    if r_nx is not None and r_ny is not None:
+        return r_nx, r_ny
+
+    if xml is not None:
+        xml_params = read_params(xml)
+        r_nx, r_ny = xml_params.get("r_nx"), xml_params.get("r_ny")
+    elif None not in (pphw, N, L, W):
+        nyout = pphw*N
+        dy = W/(nyout + 1.)
+        r_nx = int(L/dy)
+        r_ny = int(W/dy)
+    else:
+        raise Exception(("Error: either pphw/N, xml or r_nx/r_ny have "
+                         "to be supplied."))
+
+    r_nx_est, r_ny_est = r_nx, r_ny
+    r_nx, r_ny = infer_grid_shape(npoints, r_nx_est, r_ny_est)
+    if (r_nx, r_ny) != (r_nx_est, r_ny_est):
+        print "Using (r_nx, r_ny) = ({}, {}) instead of ({}, {}).".format(
+            r_nx, r_ny, r_nx_est, r_ny_est)
+
+    return r_nx, r_ny
+
+
+def get_system_size(L=None, W=None, xml=None):
+    """Return the system length L and width W, read from the input xml file
+    if given."""
+
+    if xml is not None:
+        xml_params = read_params(xml)
+        L, W = xml_params.get("L", L), xml_params.get("W", W)
+
+    return L, W
 
 
 def read_ascii_array(ascii_file, L=None, W=None, pphw=None, N=None, r_nx=None,
-                     r_ny=None, return_abs=True, pic_ascii=False):
+                     r_ny=None, return_abs=True, pic_ascii=False, xml=None):
     """Read the wavefunction in .ascii format and return the data together with
-    a XY meshgrid."""
+    a XY meshgrid. If the input xml file is given, L and W are read from
+    it."""
+
+    L, W = get_system_size(L, W, xml)
 
     if not pic_ascii:
-        n, Z = np.genfromtxt(ascii_file, unpack=True, usecols=(0, 1),
-                             dtype=complex, converters={1: convert_to_complex})
-        if r_nx is None and r_nx is None:
-            if None not in (pphw, N, L, W):
-                nyout = pphw*N
-                dy = W/(nyout + 1.)
-                r_nx = int(L/dy)
-                r_ny = int(W/dy)
-            else:
-                raise Exception(("Error: either pphw/N or r_nx/r_ny have "
-                                 "to be supplied."))
-
-            shift = xrange(-50, 50)
-            for (xn, yn) in itertools.product(shift, repeat=2):
-                r_nx_shift = r_nx + xn
-                r_ny_shift = r_ny + yn
-                try:
-                    print "Trying ({}, {})".format(r_nx_shift, r_ny_shift)
-                    Z = Z.reshape(r_ny_shift, r_nx_shift, order='F')
-                    print "Successfull for (xn, yn) = ({}, {})".format(xn, yn)
-                    break
-                except ValueError as error:
-                    warning = "Warning: {}. Cannot use (r_xn, r_yn) = ({}, {})."
-                    print warning.format(error, r_nx_shift, r_ny_shift)
-
-            r_nx, r_ny = r_nx_shift, r_ny_shift
-        else:
-            Z = Z.reshape(r_ny, r_nx, order='F')
+        with open(ascii_file) as f:
+            table = convert_to_float_table(f.read())
+        # columns: n, Re(psi), Im(psi)
+        Z = table[:, 1] + 1j*table[:, 2]
+        del table
+
+        r_nx, r_ny = get_grid_shape(len(Z), L=L, W=W, pphw=pphw, N=N,
+                                    r_nx=r_nx, r_ny=r_ny, xml=xml)
+        Z = Z.reshape(r_ny, r_nx, order='F')
 
         x = np.linspace(0., L, r_nx)
         y = np.linspace(0., W, r_ny)
@@ -63,30 +136,241 @@ def read_ascii_array(ascii_file, L=None, W=None, pphw=None, N=None, r_nx=None,
     return X, Y, Z
 
 
+def count_lines(infile):
+    """Return the number of data lines of a text file, i.e., without the
+    blank and comment lines (#) skipped by convert_to_float_table."""
+
+    nlines = 0
+    rest = "\n"
+    with open(infile, "rb") as f:
+        for buf in iter(lambda: f.read(READ_BUFFER), ""):
+            # only count complete lines (with the preceding newline), the
+            # rest is prepended to the next buffer
+            buf = rest + buf
+            end = buf.rfind("\n")
+            buf, rest = buf[:end+1], buf[end:]
+            nlines += buf.count("\n") - 1 - len(NON_DATA_LINE.findall(buf))
+    if not NON_DATA_LINE.match(rest + "\n"):
+        nlines += 1
+
+    return nlines
+
+
+def convert_ascii_to_npy(ascii_file, output, L=None, W=None, pphw=None,
+                         N=None, r_nx=None, r_ny=None, xml=None,
+                         return_abs=True, float32=False,
+                         chunksize=CHUNK_LINES):
+    """Convert a wavefunction in .ascii format to .npy with bounded memory.
+
+    The .ascii file is parsed in chunks of chunksize lines, which are written
+    directly into a preallocated, memory-mapped (r_ny, r_nx) array in Fortran
+    order (output.npy). Instead of full X, Y meshgrids, only the 1D axes x
+    and y are stored (output_axes.npz).
+
+        Parameters:
+        -----------
+            ascii_file: str
+                Input .ascii file.
+            output: str
+                Output file prefix.
+            L, W, pphw, N, r_nx, r_ny, xml:
+                Grid settings, see get_grid_shape.
+            return_abs: bool
+                Whether to store |psi|^2 instead of the complex wavefunction.
+            float32: bool
+                Whether to store |psi|^2 in single precision.
+            chunksize: int
+                Number of lines parsed at once.
+
+        Returns:
+        --------
+            x, y: (r_nx,), (r_ny,) ndarrays
+                Grid axes.
+            Z: (r_ny, r_nx) memmap
+                Wavefunction (intensity).
+    """
+
+    L, W = get_system_size(L, W, xml)
+
+    npoints = count_lines(ascii_file)
+    r_nx, r_ny = get_grid_shape(npoints, L=L, W=W, pphw=pphw, N=N,
+                                r_nx=r_nx, r_ny=r_ny, xml=xml)
+
+    if return_abs:
+        dtype = np.float32 if float32 else np.float64
+    else:
+        dtype = np.complex128
+    Z = np.lib.format.open_memmap(output + ".npy", mode="w+", dtype=dtype,
+                                  shape=(r_ny, r_nx), fortran_order=True)
+    # flat view in the memory layout of Z, i.e., Z.flatten('F')
+    Z_flat = Z.reshape(-1, order='F')
+
+    n = 0
+    with open(ascii_file) as f:
+        while True:
+            lines = list(itertools.islice(f, chunksize))
+            if not lines:
+                break
+            table = convert_to_float_table("".join(lines))
+            # columns: n, Re(psi), Im(psi)
+            if return_abs:
+                z = table[:, 1]**2 + table[:, 2]**2
+            else:
+                z = table[:, 1] + 1j*table[:, 2]
+            Z_flat[n:n+len(z)] = z
+            n += len(z)
+
+    if n != r_nx*r_ny:
+        raise Exception(("Error: found {} data points, expected "
+                         "{}.").format(n, r_nx*r_ny))
+    Z.flush()
+
+    x = np.linspace(0., L, r_nx)
+    y = np.linspace(0., W, r_ny)
+    np.savez(output + "_axes.npz", x=x, y=y)
+
+    return x, y, Z
+
+
+def convert_batch_entry(ascii_file, **convert_kwargs):
+    """Convert a single .ascii file next to its input and return its manifest
+    entry."""
+
+    output = os.path.splitext(ascii_file)[0]
+    x, y, Z = convert_ascii_to_npy(ascii_file, output, **convert_kwargs)
+    r_ny, r_nx = Z.shape
+
+    return {'ascii_file': ascii_file,
+            'npy': output + ".npy",
+            'axes': output + "_axes.npz",
+            'dtype': str(Z.dtype),
+            'r_nx': r_nx,
+            'r_ny': r_ny,
+            'dx': float(x[1] - x[0]) if r_nx > 1 else None,
+            'dy': float(y[1] - y[0]) if r_ny > 1 else None}
+
+
+def convert_batch(pattern, nprocs=4, manifest="ascii_to_numpy_manifest.json",
+                  **convert_kwargs):
+    """Convert all .ascii files matching a glob pattern with a bounded pool of
+    worker processes and write a manifest with the grid shapes and spacings
+    of all converted files."""
+
+    ascii_files = sorted(glob.glob(pattern))
+    print "Converting {} files...".format(len(ascii_files))
+
+    pool = multiprocessing.Pool(processes=nprocs)
+    results = [pool.apply_async(convert_batch_entry, args=(f,),
+                                kwds=convert_kwargs) for f in ascii_files]
+    entries = []
+    for f, r in zip(ascii_files, results):
+        try:
+            entries.append(r.get())
+        except Exception as ex:
+            print "WARNING: could not convert {}: {}".format(f, ex)
+    pool.close()
+    pool.join()
+
+    with open(manifest, "w") as f:
+        json.dump(entries, f, sort_keys=True, indent=4)
+
+    return entries
+
+
 @argh.arg('ascii-file', type=str)
+@argh.arg('--xml', type=str)
 def main(ascii_file, pphw=50, N=2.5, L=100., W=1., plot=False, pic_ascii=False,
-         output="ascii_to_numpy"):
+         output="ascii_to_numpy", xml=None, stream=False, batch=False,
+         nprocs=4, float32=False, pyramid=False):
+    """Convert a wavefunction in .ascii format to numpy format.
 
-    X, Y, Z = read_ascii_array(ascii_file, pphw=pphw, N=N, L=L, W=W,
-                               return_abs=True, pic_ascii=pic_ascii)
+        Parameters:
+        -----------
+            ascii_file: str
+                Input .ascii file (glob pattern in batch mode).
+            pphw: int
+                Points per halfwave.
+            N: float
+                Number of open modes.
+            L, W: float
+                System length, width (overridden by xml).
+            plot: bool
+                Whether to plot |psi|^2.
+            pic_ascii: bool
+                Whether the input is a pic.*.ascii file.
+            output: str
+                Output file prefix.
+            xml: str
+                Companion input xml to read the grid settings from.
+            stream: bool
+                Whether to convert in chunks to output.npy and
+                output_axes.npz with bounded memory instead of writing
+                full meshgrids to output.npz.
+            batch: bool
+                Whether to stream-convert all files matching the glob
+                pattern ascii_file concurrently. Each file is written next to
+                its input and a manifest with the grid shapes and spacings
+                is written to output_manifest.json.
+            nprocs: int
+                Number of worker processes in batch mode.
+            float32: bool
+                Whether to store |psi|^2 in single precision in stream and
+                batch mode.
+            pyramid: bool
+                Whether to write the downsampled levels of |psi|^2 (max
+                pooling) to output_pyramid.npz.
+    """
 
-    print "Writing .npz file..."
-    np.savez(output + ".npz", X=X, Y=Y, Z=Z)
+    if xml is not None:
+        # the axes, plot size and grid estimate use the system size of the
+        # xml instead of the defaults of L and W
+        L, W = get_system_size(L, W, xml)
+        print "Using L = {}, W = {} from {}.".format(L, W, xml)
+
+    if batch:
+        convert_batch(ascii_file, nprocs=nprocs,
+                      manifest=output + "_manifest.json", pphw=pphw, N=N,
+                      L=L, W=W, xml=xml, return_abs=True, float32=float32)
+        return
+
+    if stream and not pic_ascii:
+        print "Streaming to .npy file..."
+        X, Y, Z = convert_ascii_to_npy(ascii_file, output, pphw=pphw, N=N,
+                                       L=L, W=W, xml=xml, return_abs=True,
+                                       float32=float32)
+    else:
+        X, Y, Z = read_ascii_array(ascii_file, pphw=pphw, N=N, L=L, W=W,
+                                   return_abs=True, pic_ascii=pic_ascii,
+                                   xml=xml)
+
+        print "Writing .npz file..."
+        np.savez(output + ".npz", X=X, Y=Y, Z=Z)
     print "done."
 
+    if pyramid or plot:
+        levels = build_pyramid(X, Y, Z, pooling='max')
+
+    if pyramid:
+        print "Writing pyramid..."
+        save_pyramid(output + "_pyramid.npz", Z=levels)
+        print "done."
+
     if plot:
         from matplotlib import pyplot as plt
         print "Plotting..."
-        f, ax1 = plt.subplots(nrows=1, figsize=(2*L, L/2))
+        figsize = (2*L, L/2)
+        f, ax1 = plt.subplots(nrows=1, figsize=figsize)
         cmap = plt.cm.jet
 
-        ax1.pcolormesh(X, Y, Z, cmap=cmap)
+        # render from the coarsest level that resolves the output image
+        ax1.pcolormesh(*select_level(levels, figsize), cmap=cmap)
 
         for ax in (ax1, ):
             ax.set_xlim(X.min(), X.max())
             ax.set_ylim(Y.min(), Y.max())
 
-        plt.savefig(output + '.jpg', bbox_inches='tight')
+        plt.savefig(output + '.jpg', bbox_inches='tight',
+                    dpi=get_dpi(figsize))
         print "done."
 
 
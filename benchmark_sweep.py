@@ -0,0 +1,224 @@
+#!/usr/bin/env python2.7
+"""Measure the per-point overhead of the Python side of raster_eps_delta
+and optimize.
+
+The stages of each sweep point are timed individually, with fake_solver.py
+standing in for greens_code. raster_eps_delta:
+
+    boundary:   boundary generation (write_boundary)
+    xml:        rendering of the xml input file (write_xml)
+    solver:     fake solver run including process startup (run_code)
+    parsing:    reading the Bloch modes and eigenvectors (get_eigensystem)
+    archiving:  in-process compression into the sweep archive (SweepArchive)
+    archiving (legacy): shutil.copy and gzip subprocess per file
+
+optimize (--optimize, requires ep.potential):
+
+    boundary:   boundary generation and xml rendering (prepare_calc)
+    solver:     fake solver run including process startup (run_code)
+    parsing:    S-matrix evaluation via S_Matrix.py -p
+
+loop_eigensystem and jordan are not covered: they call their solvers
+(solve_xml_mumps_dev, subSGE.py) directly instead of via sweep.run_code.
+"""
+from collections import OrderedDict
+import json
+import numpy as np
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import argh
+
+import bloch
+from optimize import prepare_calc
+from raster_eps_delta import write_boundary, write_xml
+from sweep import (SOLVER_ENV, SweepArchive, get_point_id, make_run_directory,
+                   run_code)
+
+
+XML_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<input>
+  <params>
+    <param name="L">LENGTH</param>
+    <param name="W">WIDTH</param>
+    <param name="modes">MODES</param>
+    <param name="points_per_halfwave">PPHW</param>
+    <param name="Gamma0">GAMMA0</param>
+    <param name="neumann">NEUMANN</param>
+    <param name="N_file_boundary">N_FILE_BOUNDARY</param>
+  </params>
+  <boundary upper="BOUNDARY_UPPER" lower="BOUNDARY_LOWER"/>
+</input>
+"""
+FAKE_SOLVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "fake_solver.py")
+S_MATRIX = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "S_Matrix.py")
+
+
+def archive_legacy(infile, outfile):
+    """Archive infile as done per file before the sweep archive was
+    introduced."""
+    shutil.copy(infile, outfile)
+    subprocess.call(['gzip', '-f', outfile])
+
+
+def print_timings(timings, title):
+    """Print mean, min and max time and the share of each stage."""
+
+    total = sum(np.mean(T) for name, T in timings.iteritems()
+                if name != 'archiving (legacy)')
+    print "-- {}".format(title)
+    print "{:20} {:>10} {:>10} {:>10} {:>7}".format("stage", "mean [s]",
+                                                    "min [s]", "max [s]",
+                                                    "share")
+    for name, T in timings.iteritems():
+        print "{:20} {:10.4f} {:10.4f} {:10.4f} {:6.1f}%".format(
+            name, np.mean(T), np.min(T), np.max(T), 100.*np.mean(T)/total)
+
+
+@argh.arg("--xml-template", type=str)
+@argh.arg("--workdir", type=str)
+@argh.arg("--outfile", type=str)
+def benchmark_sweep(npoints=5, N=2.6, pphw=300, eta=0.1, W=1.0, neumann=0,
+                    delay=0., xml_template=None, workdir=None, keep=False,
+                    outfile=None, optimize=False, L=10., phase=-1.0,
+                    loop_type='Allen-Eberly'):
+    """Run npoints sweep points with the fake solver and report the time
+    spent per point in each stage.
+
+        Parameters:
+        -----------
+            npoints: int
+                Number of sweep points (eps in [0.01, 0.1], delta = 0.5).
+            N, pphw, eta, W, neumann:
+                Sweep settings as in raster_eps_delta.
+            delay: float
+                Runtime of the fake solver in seconds.
+            xml_template: str
+                xml template file. Defaults to a minimal template.
+            workdir: str
+                Working directory. Defaults to a temporary directory.
+            keep: bool
+                Whether to keep the working directory.
+            outfile: str
+                If supplied, write the timings to a JSON file.
+            optimize: bool
+                Whether to benchmark the optimize points as well.
+            L, phase, loop_type:
+                Settings of the optimize points (x = (eps, 0.5, phase)).
+    """
+
+    workdir = os.path.abspath(workdir or tempfile.mkdtemp(prefix="sweep_"))
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    if xml_template is None:
+        xml_template = os.path.join(workdir, "input.xml_template")
+        with open(xml_template, "w") as f:
+            f.write(XML_TEMPLATE)
+    xml_template = os.path.abspath(xml_template)
+
+    os.environ[SOLVER_ENV] = "{} {} --delay {}".format(sys.executable,
+                                                       FAKE_SOLVER, delay)
+    settings = {'N': N,
+                'pphw': pphw,
+                'eta': eta,
+                'W': W,
+                'neumann': neumann}
+
+    timings = OrderedDict((name, []) for name in ('boundary', 'xml', 'solver',
+                                                  'parsing', 'archiving',
+                                                  'archiving (legacy)'))
+
+    timings_optimize = OrderedDict((name, []) for name in ('boundary',
+                                                           'solver',
+                                                           'parsing'))
+
+    def timed(name, function, *args, **kwargs):
+        t0 = time.time()
+        result = function(*args, **kwargs)
+        timings[name].append(time.time() - t0)
+        return result
+
+    def timed_optimize(name, function, *args, **kwargs):
+        t0 = time.time()
+        result = function(*args, **kwargs)
+        timings_optimize[name].append(time.time() - t0)
+        return result
+
+    archive = SweepArchive(os.path.join(workdir, "sweep_archive.tar"))
+    for e in np.linspace(0.01, 0.1, npoints):
+        d = 0.5
+        point_id = get_point_id(e, d)
+        rundir = make_run_directory(workdir, point_id)
+        xml = os.path.join(rundir, "input.xml")
+
+        L, N_file_boundary = timed('boundary', write_boundary, e, d,
+                                   rundir=rundir, **settings)
+        timed('xml', write_xml, L, N_file_boundary,
+              xml_template=xml_template, rundir=rundir, **settings)
+        timed('solver', run_code, cwd=rundir, ncores=1, logfile="tmp.out")
+
+        evalsfile = os.path.join(rundir, "Evals.complex_potential.dat")
+        evecsfile = os.path.join(rundir, "Evecs.complex_potential.dat")
+        timed('parsing', bloch.get_eigensystem, xml=xml, evalsfile=evalsfile,
+              evecsfile=evecsfile, return_eigenvectors=True,
+              eigenvector_modes=[0, 1], neumann=neumann, verbose=False)
+
+        files = [(evalsfile, "evals_" + point_id + ".dat"),
+                 (xml, "xml_" + point_id + ".dat"),
+                 (os.path.join(rundir, "tmp.out"), "tmp_" + point_id + ".out")]
+
+        def archive_point():
+            for infile, name in files:
+                archive.add_file(infile, name, delete=False)
+            archive.wait()
+        timed('archiving', archive_point)
+
+        def archive_point_legacy():
+            for infile, name in files:
+                archive_legacy(infile, os.path.join(workdir, name))
+        timed('archiving (legacy)', archive_point_legacy)
+
+        shutil.rmtree(rundir)
+
+        if optimize:
+            rundir = make_run_directory(workdir, "optimize_" + point_id)
+            args = (N, L, W, pphw, False, xml_template,
+                    os.path.join(rundir, "input.xml"), loop_type, 1)
+            cwd = os.getcwd()
+            os.chdir(rundir)
+            try:
+                timed_optimize('boundary', prepare_calc, (e, d, phase), *args)
+            finally:
+                os.chdir(cwd)
+            timed_optimize('solver', run_code, cwd=rundir, ncores=1,
+                           logfile="greens.out")
+            timed_optimize('parsing', subprocess.call,
+                           [sys.executable, S_MATRIX, "-p"], cwd=rundir)
+            shutil.rmtree(rundir)
+    archive.close()
+
+    print
+    print "{} points, pphw={}, solver delay={}s".format(npoints, pphw, delay)
+    print_timings(timings, "raster_eps_delta")
+    if optimize:
+        print
+        print_timings(timings_optimize, "optimize")
+
+    if outfile:
+        with open(outfile, "w") as f:
+            json.dump({'raster_eps_delta': timings,
+                       'optimize': timings_optimize}, f, indent=4)
+
+    if not keep:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(benchmark_sweep)
@@ -1,18 +1,105 @@
 #!/usr/bin/env python2.7
 
 import glob
+import mmap
 import numpy as np
 
 import argh
 
-from helper_functions import convert_to_complex
-from xmlparser import XML
+from helper_functions import convert_to_complex_array, open_archived_file
+from xmlparser import read_params
+
+
+class EigenvectorFile(object):
+    """Lazy, row-wise access to a greens_code eigenvector file.
+
+    The byte offsets of all rows are determined once on a memory map of the
+    file. Rows are parsed only on request and cached, such that repeated
+    queries of the same modes do not touch the file again.
+
+        Parameters:
+        -----------
+            evecsfile: str
+                Eigenvectors input file (Evecs.*.dat).
+
+        Attributes:
+        -----------
+            offsets: (M, 2) ndarray
+                Start and end byte offsets of the M non-empty rows.
+    """
+
+    def __init__(self, evecsfile):
+        self.evecsfile = evecsfile
+        self._cache = {}
+
+        with open(evecsfile, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = self._index_rows()
+
+    def _index_rows(self):
+        """Return the start and end byte offsets of all non-empty rows."""
+
+        data = np.frombuffer(self._mmap, dtype=np.uint8)
+        newlines = np.flatnonzero(data == ord("\n"))
+        size = len(data)
+        del data
+
+        starts = np.concatenate(([0], newlines + 1))
+        ends = np.concatenate((newlines, [size]))
+        offsets = np.column_stack((starts, ends))
+
+        return offsets[ends > starts]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, row):
+        """Return the eigenvector stored in the given row."""
+
+        if row not in self._cache:
+            start, end = self.offsets[row]
+            self._cache[row] = convert_to_complex_array(self._mmap[start:end])
+
+        return self._cache[row]
+
+    def get_rows(self, rows):
+        """Return the eigenvectors of the given rows as (len(rows), N)
+        ndarray."""
+        return np.asarray([self[r] for r in rows])
+
+    def close(self):
+        self._mmap.close()
+
+
+def read_evals(evalsfile):
+    """Return the eigenvalues beta and group velocities stored in the first
+    two columns of an eigenvalue file. Gzipped files (*.gz) are decompressed
+    on the fly and members of sweep archives can be read directly (see
+    helper_functions.open_archived_file)."""
+
+    with open_archived_file(evalsfile) as f:
+        columns = [" ".join(l.split()[:2]) for l in f
+                   if l.strip() and not l.lstrip().startswith("#")]
+    beta, velocities = convert_to_complex_array(" ".join(columns)).reshape(-1, 2).T
+
+    return beta, velocities
+
+
+def get_wavenumbers(beta, L):
+    """Return the Bloch wavenumbers K_n of the eigenvalues beta = exp(i*K_n*L)
+    for a unit cell of length L."""
+
+    k = np.angle(beta) - 1j*np.log(np.abs(beta))
+    # k /= dx*r_nx
+    k /= L  # = period L for chi(x+L) = chi(x) (note that generally L!=r_nx*dx)
+
+    return k
 
 
 def get_eigensystem(xml='input.xml', evalsfile=None, evecsfile=None,
                     modes=None, L=None, dx=None, r_nx=None, sort=True,
                     return_velocities=False, return_eigenvectors=False,
-                    verbose=True, neumann=False):
+                    eigenvector_modes=None, verbose=True, neumann=False):
     """Extract the eigenvalues beta and return the Bloch modes.
 
         Parameters:
@@ -39,6 +126,9 @@ def get_eigensystem(xml='input.xml', evalsfile=None, evecsfile=None,
                 Whether to return eigenvalues and group velocities.
             return_eigenvectors: bool
                 Whether to return eigenvalues and eigenvectors.
+            eigenvector_modes: list of int
+                Indices of the (sorted) modes for which the eigenvectors are
+                parsed, e.g., [0, 1]. Defaults to all modes.
             verbose: bool
                 Print additional output.
             neumann: bool
@@ -49,7 +139,9 @@ def get_eigensystem(xml='input.xml', evalsfile=None, evecsfile=None,
             k_left, k_right: (N,) ndarrays
                 Bloch modes of left and right movers.
             chi_left, chi_right: (N,N) ndarrays (optional)
-                Eigenvectors of left and right movers.
+                Eigenvectors of left and right movers. If eigenvector_modes
+                is supplied, only the rows of the requested modes are
+                returned.
             v_left, v_right: (N,) ndarrays (optional)
                 Velocities of left and right movers.
     """
@@ -66,7 +158,7 @@ def get_eigensystem(xml='input.xml', evalsfile=None, evecsfile=None,
         if verbose:
             print "# Parameters 'modes', 'dx' and 'r_nx' not found."
             print "# Reading xml file {}.".format(xml)
-        xml_params = XML(xml).params
+        xml_params = read_params(xml)
         modes = xml_params.get("modes")
         L = xml_params.get("L")
         dx = xml_params.get("dx")
@@ -82,29 +174,24 @@ def get_eigensystem(xml='input.xml', evalsfile=None, evecsfile=None,
     # get reciprocal lattice vector G
     G = 2.*np.pi/L
 
-    # get eigenvectors chi_n (performance critical!)
+    # index the eigenvectors chi_n (performance critical!) - the rows are
+    # parsed only after the requested modes have been determined
     if return_eigenvectors:
         if evecsfile is None:
             evecsfile = glob.glob("Evecs.*.dat")
-        if len(evecsfile) != 1:
-            print """Warning: found multiple files matching Evals.*.dat!
-                    Proceeding with file {}.""".format(evecsfile[0])
         if isinstance(evecsfile, list):
+            if len(evecsfile) != 1:
+                print """Warning: found multiple files matching Evecs.*.dat!
+                        Proceeding with file {}.""".format(evecsfile[0])
             evecsfile = evecsfile[0]
-        chi = np.loadtxt(evecsfile, dtype=str)
-        chi = np.asarray([map(convert_to_complex, x) for x in chi])
+        chi = EigenvectorFile(evecsfile)
 
-        chi_left = chi[:len(chi)//2]
-        chi_right = chi[len(chi)//2:]
+        rows_left = np.arange(len(chi)//2)
+        rows_right = np.arange(len(chi)//2, len(chi))
 
     # get beta = exp(i*K_n*dx) and group velocities v_n
-    beta, velocities = np.genfromtxt(evalsfile, unpack=True,
-                                     usecols=(0, 1), dtype=complex,
-                                     converters={0: convert_to_complex,
-                                                 1: convert_to_complex})
-    k = np.angle(beta) - 1j*np.log(np.abs(beta))
-    # k /= dx*r_nx
-    k /= L  # = period L for chi(x+L) = chi(x) (note that generally L!=r_nx*dx)
+    beta, velocities = read_evals(evalsfile)
+    k = get_wavenumbers(beta, L)
 
     # --- experimental: sort the array according to velocities first, then fill
     # v_left and v_right with left and rightmovers ----------------------------
@@ -137,11 +224,19 @@ def get_eigensystem(xml='input.xml', evalsfile=None, evecsfile=None,
         v_left = v_left[sort_left]
 
         if return_eigenvectors:
-            chi_left = chi_left[sort_left]
-            chi_right = chi_right[sort_right]
+            rows_left = rows_left[sort_left]
+            rows_right = rows_right[sort_right]
 
         # TODO: handle conservative case
 
+    if return_eigenvectors:
+        if eigenvector_modes is not None:
+            rows_left = rows_left[eigenvector_modes]
+            rows_right = rows_right[eigenvector_modes]
+        chi_left = chi.get_rows(rows_left)
+        chi_right = chi.get_rows(rows_right)
+        chi.close()
+
     # the following procedure is redundant:
     # np.angle(x) maps x into the domain [-pi,pi], i.e.,
     #   -pi <= k*L <= pi,
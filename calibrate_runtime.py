@@ -0,0 +1,265 @@
+#!/usr/bin/env python2.7
+"""Calibrate the greens_code runtime model of estimate_runtime.py
+
+    T = (a*ny**3*nx/Ncores + b*log2(Ncores)*ny**3)*1e-9
+
+with the wall times of finished runs.
+
+    collect(directories, machine=MACHINE, ncores=None, database=None):
+        Add the wall times of all runs below the directories to the timing
+        database.
+
+    fit(machine=MACHINE, database=None, save=True, verbose=False):
+        Fit the coefficients a and b of a machine by least squares and report
+        the prediction error.
+
+Runs are identified by a solver log (tmp.out or greens.out) next to the input
+xml file, or by the members tmp_<id>.out and xml_<id>.dat of a sweep archive.
+The wall time is read from the footer written by sweep.run_code, or from the
+output of the shell builtin or GNU time. The number of cores is read from the
+mpirun/srun command line in the log header, if available.
+"""
+from __future__ import division
+
+import json
+import numpy as np
+import os
+import re
+import scipy.optimize
+
+import argh
+
+from estimate_runtime import COEFFICIENTS, get_timings_database
+from helper_functions import (ARCHIVE_EXTENSION, ARCHIVE_INDEX_EXTENSION,
+                              open_archived_file, read_archive_index)
+from sweep import LOG_COMMAND, LOG_WALL_TIME
+from xmlparser import read_params
+
+
+MACHINE = 'VSC3'
+LOG_FILES = ("tmp.out", "greens.out")
+XML = "input.xml"
+# archived log and xml files of a sweep point, see raster_eps_delta.run_point
+ARCHIVED_LOG = re.compile(r'^tmp_(?P<id>.*)\.out(\.gz)?$')
+ARCHIVED_XML = "xml_{}.dat"
+
+# wall time formats: shell builtin 'real 1m2.345s', POSIX 'real 62.34' and
+# GNU time '0:01:02.34elapsed'
+WALL_TIME_FORMATS = (
+    (re.compile(r'^real\s+(\d+)m([\d.]+)s'),
+     lambda m: 60*int(m.group(1)) + float(m.group(2))),
+    (re.compile(r'^real\s+([\d.]+)\s*$'),
+     lambda m: float(m.group(1))),
+    (re.compile(r'(?:(\d+):)?(\d+):([\d.]+)elapsed'),
+     lambda m: (3600*int(m.group(1) or 0) + 60*int(m.group(2)) +
+                float(m.group(3)))))
+NCORES = re.compile(r'\s(?:-np|-n|--ntasks)[\s=]*(\d+)\s')
+
+
+def read_log(infile):
+    """Return the wall time in seconds and the number of cores (None if
+    unknown) of a solver run from its log file."""
+
+    T, ncores = None, None
+    with open_archived_file(infile) as f:
+        for line in f:
+            if line.startswith(LOG_COMMAND):
+                match = NCORES.search(line + " ")
+                ncores = int(match.group(1)) if match else 1
+            elif line.startswith(LOG_WALL_TIME):
+                T = float(line[len(LOG_WALL_TIME):])
+            else:
+                for regex, convert in WALL_TIME_FORMATS:
+                    match = regex.search(line)
+                    if match:
+                        T = convert(match)
+
+    return T, ncores
+
+
+def find_runs(directories):
+    """Return the pairs (log file, xml file) of all runs below the
+    directories, including the archived runs of sweep archives."""
+
+    index_extension = ARCHIVE_EXTENSION + ARCHIVE_INDEX_EXTENSION
+
+    runs = []
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            if XML in files:
+                runs.extend((os.path.join(root, f), os.path.join(root, XML))
+                            for f in LOG_FILES if f in files)
+            for f in files:
+                if not f.endswith(index_extension):
+                    continue
+                archive = os.path.join(root, f[:-len(ARCHIVE_INDEX_EXTENSION)])
+                members = read_archive_index(archive)
+                for member in members:
+                    match = ARCHIVED_LOG.match(member)
+                    if not match:
+                        continue
+                    xml = ARCHIVED_XML.format(match.group('id'))
+                    for m in (xml, xml + ".gz"):
+                        if m in members:
+                            runs.append((os.path.join(archive, member),
+                                         os.path.join(archive, m)))
+
+    return sorted(runs)
+
+
+def load_database(database=None):
+    """Return the timing database {'records': {source: record},
+    'coefficients': {machine: fit}}."""
+
+    database = database or get_timings_database()
+    if not os.path.exists(database):
+        return {'records': {}, 'coefficients': {}}
+
+    with open(database) as f:
+        return json.load(f)
+
+
+def save_database(data, database=None):
+    """Write the timing database atomically."""
+
+    database = database or get_timings_database()
+    tmp = database + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(tmp, database)
+
+
+@argh.arg("directories", nargs="*")
+@argh.arg("--ncores", type=int)
+@argh.arg("--database", type=str)
+def collect(directories, machine=MACHINE, ncores=None, database=None):
+    """Add the wall times and grid sizes of all runs below the directories
+    to the timing database. Runs already in the database are updated.
+
+        Parameters:
+        -----------
+            directories: list of str
+                Directories containing run directories or sweep archives.
+            machine: str
+                Machine on which the runs were executed.
+            ncores: int
+                Number of cores of runs whose log does not contain the
+                solver command line (defaults to 1).
+            database: str
+                Timing database. Defaults to $GREENS_CODE_TIMINGS or
+                ~/.greens_code_timings.json.
+    """
+
+    data = load_database(database)
+    records = data['records']
+
+    nruns, skipped = 0, 0
+    for logfile, xml in find_runs(directories or ["."]):
+        try:
+            T, run_ncores = read_log(logfile)
+            params = read_params(xml)
+        except Exception as ex:
+            print "WARNING: could not read {}: {}".format(logfile, ex)
+            skipped += 1
+            continue
+        if T is None:
+            skipped += 1
+            continue
+
+        records[os.path.abspath(logfile)] = {
+            'machine': machine,
+            'nx': params['r_nx'],
+            'ny': params['r_ny'],
+            'ncores': run_ncores or ncores or 1,
+            'T': T}
+        nruns += 1
+
+    save_database(data, database)
+    print "Added {} runs ({} without wall time skipped), {} in total.".format(
+        nruns, skipped, len(records))
+
+
+def get_design_matrix(nx, ny, ncores):
+    """Return the columns of the runtime model for the coefficients a and
+    b."""
+    return np.column_stack((ny**3*nx/ncores*1e-9,
+                            np.log2(ncores)*ny**3*1e-9))
+
+
+@argh.arg("--database", type=str)
+def fit(machine=MACHINE, database=None, save=True, verbose=False):
+    """Fit the coefficients a and b of the runtime model to the runs of a
+    machine in the timing database and report the prediction error.
+
+    The relative error of the predictions is minimized, i.e., each run is
+    weighted with its inverse wall time, subject to a, b >= 0. If all runs
+    use the same number of cores, only a is fitted and the default value of
+    b is kept. The grid sizes nx and ny are r_nx and r_ny of the xml files
+    (xmlparser.get_grid_params), as used by the sweep planner.
+
+        Parameters:
+        -----------
+            machine: str
+                Machine whose runs are fitted.
+            database: str
+                Timing database.
+            save: bool
+                Whether to store the coefficients in the database, where
+                they are picked up by estimate_runtime.get_runtime.
+            verbose: bool
+                Whether to print the measured and predicted time of each
+                run.
+    """
+
+    data = load_database(database)
+    records = [r for r in data['records'].values()
+               if r['machine'] == machine and r['T'] > 0]
+    if len(records) < 2:
+        raise Exception("Error: at least 2 runs are required to fit the "
+                        "coefficients of {} ({} found).".format(machine,
+                                                                len(records)))
+
+    nx, ny, ncores, T = [np.array([r[k] for r in records], dtype=float)
+                         for k in ('nx', 'ny', 'ncores', 'T')]
+    A = get_design_matrix(nx, ny, ncores)
+
+    a0, b0 = COEFFICIENTS.get(machine, COEFFICIENTS[MACHINE])
+    if len(set(ncores)) > 1:
+        (a, b), _ = scipy.optimize.nnls(A/T[:, np.newaxis], np.ones_like(T))
+    else:
+        print ("WARNING: all runs use {:.0f} cores, b is not "
+               "determined.").format(ncores[0])
+        b = b0
+        a = np.sum(A[:, 0]*(T - b*A[:, 1])/T**2)/np.sum((A[:, 0]/T)**2)
+
+    T_fit = A.dot([a, b])
+    T_default = A.dot([a0, b0])
+    error = (T_fit - T)/T
+    error_default = (T_default - T)/T
+
+    if verbose:
+        print "{:>8} {:>8} {:>6} {:>12} {:>12} {:>8}".format(
+            "nx", "ny", "cores", "T [s]", "T_fit [s]", "error")
+        for n in np.argsort(T):
+            print "{:8.0f} {:8.0f} {:6.0f} {:12.2f} {:12.2f} {:7.1%}".format(
+                nx[n], ny[n], ncores[n], T[n], T_fit[n], error[n])
+
+    rms_error = np.sqrt(np.mean(error**2))
+    print "{}: {} runs".format(machine, len(T))
+    print "    fitted:  a = {:.4g}, b = {:.4g}".format(a, b)
+    print "             rms error {:.1%}, max error {:.1%}".format(
+        rms_error, np.max(abs(error)))
+    print "    default: a = {:.4g}, b = {:.4g}".format(a0, b0)
+    print "             rms error {:.1%}, max error {:.1%}".format(
+        np.sqrt(np.mean(error_default**2)), np.max(abs(error_default)))
+
+    if save:
+        data['coefficients'][machine] = {'a': a,
+                                         'b': b,
+                                         'nruns': len(T),
+                                         'rms_error': rms_error}
+        save_database(data, database)
+
+
+if __name__ == '__main__':
+    argh.dispatch_commands([collect, fit])
@@ -4,17 +4,63 @@ from __future__ import division
 
 import argparse
 from argparse import RawDescriptionHelpFormatter
+import json
 import math
+import os
 import sys
 
 
+# default coefficients (a, b) of the runtime model, used unless calibrated
+# values are found in the timing database (see calibrate_runtime.py)
+COEFFICIENTS = {'VSC2': (6., 3.5),
+                'VSC3': (6., 3.5)}
+TIMINGS_DATABASE = os.path.expanduser("~/.greens_code_timings.json")
+# environment variable to override the location of the timing database
+TIMINGS_DATABASE_ENV = "GREENS_CODE_TIMINGS"
+_COEFFICIENTS_CACHE = {}
+
+
+def get_timings_database():
+    """Return the path of the timing database."""
+    return os.environ.get(TIMINGS_DATABASE_ENV, TIMINGS_DATABASE)
+
+
+def get_coefficients(machine):
+    """Return the coefficients (a, b) of the runtime model of a machine and
+    whether they have been calibrated.
+
+    Calibrated coefficients are read from the timing database (cached by
+    path and modification time); otherwise the defaults in COEFFICIENTS are
+    used.
+    """
+
+    database = get_timings_database()
+    if os.path.exists(database):
+        key = (database, os.path.getmtime(database))
+        if key not in _COEFFICIENTS_CACHE:
+            with open(database) as f:
+                _COEFFICIENTS_CACHE[key] = json.load(f).get('coefficients',
+                                                            {})
+        fit = _COEFFICIENTS_CACHE[key].get(machine)
+        if fit:
+            return (fit['a'], fit['b']), True
+
+    if machine not in COEFFICIENTS:
+        raise Exception("Error: no runtime coefficients for machine "
+                        "{}.".format(machine))
+
+    return COEFFICIENTS[machine], False
+
+
 def get_runtime(pphw=None, modes=None, length=None, width=None, nx=None,
-                ny=None, Ncores=None, machine=None):
-    """Print the estimated greens_code runtime.
+                ny=None, Ncores=None, machine=None, verbose=True):
+    """Return (and print) the estimated greens_code runtime.
 
     If neither nx nor ny are provided, the variables pphw, modes, length and
     width have to be supplied to determine the grid-spacing. If Ncores is
     unspecified, the estimated runtimes for 2^3, ..., 2^9 cores are printed.
+    The coefficients of the runtime model are measured with
+    calibrate_runtime.py; default values are used for uncalibrated machines.
 
         Parameters:
         -----------
@@ -34,6 +80,8 @@ def get_runtime(pphw=None, modes=None, length=None, width=None, nx=None,
                 Number of cores.
             machine: str
                 Machine on which greens_code is run (VSC2|VSC3).
+            verbose: bool
+                Whether to print the estimated runtime.
 
         Returns:
         --------
@@ -53,24 +101,28 @@ def get_runtime(pphw=None, modes=None, length=None, width=None, nx=None,
         nx = int(length/dx)
         ny = int(width/dy)
 
-    if machine == 'VSC2':
+    (a, b), calibrated = get_coefficients(machine)
+    if machine == 'VSC2' and not calibrated and verbose:
         print ("Warning: VSC2 parameters have not yet been determined. Using "
                "VSC3 predictions in the following.")
-        a = 6.
-        b = 3.5
-    elif machine == 'VSC3':
-        a = 6.
-        b = 3.5
 
     T = (a*ny**3*(nx/Ncores) + math.log(Ncores, 2)*b*ny**3)*1e-9
 
+    if verbose:
+        print "Estimated runtime for {:4} core(s): {}".format(Ncores,
+                                                             format_time(T))
+
+    return T
+
+
+def format_time(T):
+    """Return the time T in seconds formatted as 'h m s'."""
+
     T_h = T // 3600
     T_m = (T // 60) % 60
     T_s = T % 60
 
-    print "Estimated runtime for {:4} core(s): {:.0f}h {:2.0f}m {:2.0f}s".format(Ncores, T_h, T_m, T_s)
-
-    return T
+    return "{:.0f}h {:2.0f}m {:2.0f}s".format(T_h, T_m, T_s)
 
 
 def parse_arguments():
@@ -15,6 +15,7 @@ def get_bloch_eigensystem(plot=False):
     # get Bloch eigensystem
     K, _, ev, _, v, _ = bloch.get_eigensystem(return_eigenvectors=True,
                                               return_velocities=True,
+                                              eigenvector_modes=[0, 1],
                                               verbose=True, neumann=False)
     K0, K1 = K[0], K[1]
     ev0, ev1 = ev[0,:], ev[1,:]
@@ -0,0 +1,145 @@
+#!/usr/bin/env python2.7
+"""Stand-in for the greens_code solver (solve_xml_mumps) which allows to run
+and profile sweeps without a working solver/MPI stack.
+
+The parameters modes, points_per_halfwave, W and L are read from the input
+xml file and synthetic output files of realistic size are written to the
+working directory:
+
+    Evals.<name>.dat:
+        2*nyout rows '(beta) (velocity)' of left and right movers.
+    Evecs.<name>.dat, Evecs.<name>.abs:
+        2*nyout eigenvectors of length nyout and their absolute values
+        (repeated from a pool of EVECS_POOL random vectors, such that the
+        time to write the files is small compared to the solver delay).
+    Smat.<name>.dat:
+        S-matrix of dimension 2*int(modes) for a single run.
+    pic.geometry.<name>.1.jpg (optional):
+        Dummy image of a given size.
+
+The solver can be used in the sweeps via
+
+    export GREENS_CODE_SOLVER="python /path/to/fake_solver.py --delay 1"
+"""
+import numpy as np
+import os
+import time
+
+import argh
+
+from xmlparser import read_params
+
+
+CALC_NAME = "complex_potential"
+# environment variable to set the default delay
+DELAY_ENV = "FAKE_SOLVER_DELAY"
+COMPLEX_FMT = "({:.16e},{:.16e})"
+# bound for |Im(K_n*L)| to keep beta of evanescent modes finite
+MAX_DECAY = 700.
+# number of distinct eigenvectors, which are repeated to fill Evecs.*.dat
+EVECS_POOL = 16
+
+
+def format_complex_rows(z):
+    """Return the rows of the 2D complex array z in the (re,im) format of
+    greens_code."""
+
+    row = " ".join([COMPLEX_FMT]*z.shape[1]) + "\n"
+    values = np.empty(z.shape + (2,))
+    values[..., 0], values[..., 1] = z.real, z.imag
+
+    return "".join(row.format(*v) for v in values.reshape(len(z), -1))
+
+
+def get_bloch_modes(modes, nyout, L, eta=0.):
+    """Return synthetic eigenvalues beta = exp(iK_nL) and group velocities
+    of nyout left and right movers, respectively. The first int(modes) modes
+    are propagating, all others are evanescent."""
+
+    n = np.arange(1, nyout + 1)
+    k = np.sqrt((modes**2 - n**2 + 0j))*np.pi + 1j*eta
+    k *= 1. + 1e-3*np.random.randn(nyout)
+
+    kL = k*L
+    kL = kL.real + 1j*np.clip(kL.imag, -MAX_DECAY, MAX_DECAY)
+    beta_right = np.exp(1j*kL)
+    beta_left = np.exp(-1j*kL)
+    velocities = k/np.pi**2
+
+    beta = np.concatenate((beta_left, beta_right))
+    velocities = np.concatenate((-velocities, velocities))
+
+    return beta, velocities
+
+
+def write_output(name, modes, nyout, L, eta=0., jpg_size=0):
+    """Write the synthetic Evals, Evecs and Smat files."""
+
+    beta, velocities = get_bloch_modes(modes, nyout, L, eta=eta)
+    with open("Evals.{}.dat".format(name), "w") as f:
+        f.write(format_complex_rows(np.column_stack((beta, velocities))))
+
+    npool = min(EVECS_POOL, 2*nyout)
+    evecs = (np.random.randn(npool, nyout) + 1j*np.random.randn(npool, nyout))
+    evecs /= np.linalg.norm(evecs, axis=1)[:, np.newaxis]
+    rows = format_complex_rows(evecs).splitlines(True)
+    abs_rows = [" ".join("{:.18e}".format(x) for x in row) + "\n"
+                for row in abs(evecs)]
+    with open("Evecs.{}.dat".format(name), "w") as f:
+        f.writelines(rows[n % npool] for n in range(2*nyout))
+    with open("Evecs.{}.abs".format(name), "w") as f:
+        f.writelines(abs_rows[n % npool] for n in range(2*nyout))
+
+    ndims = 2*int(modes)
+    S = np.random.randn(ndims, ndims) + 1j*np.random.randn(ndims, ndims)
+    S /= np.sqrt(ndims)
+    with open("Smat.{}.dat".format(name), "w") as f:
+        f.write("1\n{}\n{}\n".format((modes*np.pi)**2/2., ndims))
+        for (i, j), s in np.ndenumerate(S):
+            f.write("{} {} {:.16e} {:.16e}\n".format(i, j, s.real, s.imag))
+
+    if jpg_size:
+        with open("pic.geometry.{}.1.jpg".format(name), "wb") as f:
+            f.write(os.urandom(jpg_size))
+
+
+@argh.arg("--delay", type=float)
+@argh.arg("--seed", type=int)
+def fake_solver(xml="input.xml", name=CALC_NAME, delay=None, eta=0.,
+                seed=None, jpg_size=0):
+    """Write synthetic greens_code output files for the input xml file.
+
+        Parameters:
+        -----------
+            xml: str
+                Input xml file.
+            name: str
+                Calculation name used in the output file names.
+            delay: float
+                Seconds to wait before the output is written, emulating the
+                solver runtime. Defaults to $FAKE_SOLVER_DELAY or 0.
+            eta: float
+                Imaginary part added to the Bloch wavenumbers.
+            seed: int
+                Random seed.
+            jpg_size: int
+                Size of the dummy image in bytes (no image if 0).
+    """
+
+    t0 = time.time()
+    if delay is None:
+        delay = float(os.environ.get(DELAY_ENV, 0.))
+    np.random.seed(seed)
+
+    params = read_params(xml)
+    modes, L = params['modes'], params['L']
+    nyout = int(params['nyout'])
+    print "fake solver: modes={} L={} nyout={}".format(modes, L, nyout)
+
+    time.sleep(delay)
+    write_output(name, modes, nyout, L, eta=eta, jpg_size=jpg_size)
+    print "fake solver: finished after {:.3f}s".format(time.time() - t0)
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(fake_solver)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python2.7
+
+import multiprocessing
+import numpy as np
+import os
+
+import argh
+
+import bloch
+from helper_functions import (find_archived_files, get_eps_delta,
+                              read_archive_index, split_archive_path)
+from xmlparser import read_params
+
+
+def get_length(delta, N=2.6, neumann=False):
+    """Return the unit cell length L = 2pi/(kr + delta) used in
+    raster_eps_delta."""
+
+    if neumann:
+        k0, k1 = [np.sqrt(N**2 - n**2)*np.pi for n in (0, 1)]
+    else:
+        k0, k1 = [np.sqrt(N**2 - n**2)*np.pi for n in (1, 2)]
+
+    return abs(2.*np.pi/(k0 - k1 + delta))
+
+
+def get_companion_xml(evalsfile):
+    """Return the path of the archived input xml file xml_eps_*_delta_*.dat
+    (optionally gzipped) of an eigenvalue file evals_eps_*_delta_*.dat, or
+    None if it does not exist. Members of sweep archives are looked up in
+    the archive index."""
+
+    archive, member = split_archive_path(evalsfile)
+    name = os.path.basename(member or evalsfile)
+    xml = "xml_" + name[len("evals_"):]
+    xml = xml[:-len(".gz")] if xml.endswith(".gz") else xml
+    candidates = (xml, xml + ".gz")
+
+    if member is not None:
+        members = read_archive_index(archive)
+        for c in candidates:
+            if c in members:
+                return os.path.join(archive, c)
+    else:
+        for c in candidates:
+            path = os.path.join(os.path.dirname(evalsfile), c)
+            if os.path.exists(path):
+                return path
+
+    return None
+
+
+def read_spectrum_point(evalsfile, N=2.6, neumann=False):
+    """Return eps, delta and the first two Bloch modes K0, K1 of an archived
+    eigenvalue file.
+
+    The unit cell length L is read from the archived input xml file of the
+    point (see get_companion_xml). If there is none, L is recovered from the
+    delta value encoded in the file name and N (see get_length).
+    """
+
+    try:
+        eps, delta = get_eps_delta(evalsfile)
+        xml = get_companion_xml(evalsfile)
+        if xml is not None:
+            L = read_params(xml)['L']
+        else:
+            print ("WARNING: no input xml found for {}, using L(delta) with "
+                   "N = {}.").format(evalsfile, N)
+            L = get_length(delta, N=N, neumann=neumann)
+
+        beta, _ = bloch.read_evals(evalsfile)
+        k = bloch.get_wavenumbers(beta, L)
+        k_left = k[:len(k)//2]
+        k_left = k_left[np.argsort(abs(k_left.imag))]
+
+        return eps, delta, k_left[0], k_left[1]
+    except Exception as ex:
+        print "WARNING: could not read {}: {}".format(evalsfile, ex)
+
+
+@argh.arg("directories", nargs="+", type=str)
+def harvest_bloch_spectrum(directories, N=2.6, neumann=False,
+                           outfile="bloch_spectrum.dat", nprocs=None):
+    """Collect the Bloch spectrum of finished (eps, delta) raster scans.
+
+    All (optionally gzipped) evals_eps_*_delta_*.dat files found below the
+    given directories, including the members of sweep archives, are read in
+    parallel and written to a single file with the layout of bloch.tmp,
+    i.e., the columns
+
+        eps delta Re(K0) Im(K0) Re(K1) Im(K1)
+
+    sorted with respect to eps and delta, as expected by plot_3D_spectrum.
+
+        Parameters:
+        -----------
+            directories: list of str
+                Directories to scan recursively.
+            N: float
+                Number of open modes used in the scan (only used for points
+                without archived input xml file).
+            neumann: bool
+                Whether Neumann or Dirichlet boundary conditions were used
+                (only used for points without archived input xml file).
+            outfile: str
+                Spectrum output file.
+            nprocs: int
+                Number of worker processes. Defaults to the number of CPUs.
+    """
+
+    evals_files = find_archived_files(directories, "evals")
+    print "Found {} eigenvalue files.".format(len(evals_files))
+
+    kwargs = {'N': N,
+              'neumann': neumann}
+    pool = multiprocessing.Pool(processes=nprocs)
+    results = [pool.apply_async(read_spectrum_point, args=(f,), kwds=kwargs)
+               for f in evals_files]
+    results = [r.get() for r in results]
+    pool.close()
+    pool.join()
+
+    results = [r for r in results if r is not None]
+    if not results:
+        print "No spectrum data found."
+        return
+
+    eps, delta, K0, K1 = [np.array(x) for x in zip(*results)]
+    idx = np.lexsort((delta, eps))
+    eps, delta, K0, K1 = [x[idx] for x in (eps, delta, K0, K1)]
+
+    np.savetxt(outfile, zip(eps, delta, K0.real, K0.imag, K1.real, K1.imag))
+    print "Wrote {} points to {}.".format(len(eps), outfile)
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(harvest_bloch_spectrum)
@@ -4,10 +4,34 @@
     convert_to_complex(s):
         Convert a string of the form (x,y) to a complex number z = x+1j*y.
 
+    convert_to_complex_array(s):
+        Convert a string of whitespace separated (x,y) tuples to a complex
+        array.
+
+    convert_to_float_table(s):
+        Convert the rows of a string with real and (x,y) complex columns to a
+        2D float array.
+
     loadtxt_complex(filename, **loadtxt_kwargs):
         Wrapper for numpy's loadtxt which replaces all '+-' with '-' before
         evaluation.
 
+    get_eps_delta(filename):
+        Return the (eps, delta) values encoded in an archived file name.
+
+    find_archived_files(directories, prefix):
+        Return all archived sweep files with a given prefix below the given
+        directories, including the members of sweep archives.
+
+    split_archive_path(path):
+        Split a path <archive>.tar/<member> into archive and member name.
+
+    read_archive_index(archive):
+        Return the table of contents of a sweep archive.
+
+    open_archived_file(path):
+        Open a plain, gzipped or sweep archive member file for reading.
+
     natural_sorting(text, args="delta", sep="_")
         Sort a text with respect to a given argument value.
 
@@ -21,6 +45,8 @@
     convert_json_to_cfg(infile=None, outfile="out.cfg"):
         Convert a JSON file to a config file that is expandable by the shell.
 """
+import gzip
+import io
 import json
 import numpy as np
 import os
@@ -29,6 +55,12 @@ import sys
 import re
 
 
+# sweep archives are tar files with a table of contents <archive>.tar.index
+ARCHIVE_EXTENSION = ".tar"
+ARCHIVE_INDEX_EXTENSION = ".index"
+_ARCHIVE_INDEX_CACHE = {}
+
+
 def convert_to_complex(s):
     """Convert a string of the form (x,y) to a complex number z = x+1j*y."""
 
@@ -38,6 +70,35 @@ def convert_to_complex(s):
     return x + 1j*y
 
 
+def convert_to_complex_array(s):
+    """Convert a string of whitespace separated (x,y) tuples to a complex
+    array."""
+
+    for c in "(),":
+        s = s.replace(c, " ")
+    z = np.fromstring(s, sep=" ")
+
+    return z.view(np.complex128)
+
+
+def convert_to_float_table(s):
+    """Convert the rows of a string with real and (x,y) complex columns to a
+    2D float array. Complex columns are split into two consecutive columns
+    holding the real and imaginary part, respectively. Comment lines (#) are
+    ignored."""
+
+    if "#" in s:
+        s = "\n".join(l for l in s.splitlines()
+                      if not l.lstrip().startswith("#"))
+    for c in "(),":
+        s = s.replace(c, " ")
+
+    first_row = s.lstrip().split("\n", 1)[0]
+    table = np.fromstring(s, sep=" ")
+
+    return table.reshape(-1, len(first_row.split()))
+
+
 def loadtxt_complex(filename, **loadtxt_kwargs):
     """Wrapper for numpy's loadtxt which replaces all '+-' with '-' before
     evaluation."""
@@ -49,6 +110,98 @@ def loadtxt_complex(filename, **loadtxt_kwargs):
     return array
 
 
+def get_eps_delta(filename):
+    """Return the (eps, delta) values encoded in an archived file name of the
+    form *_eps_<eps>_delta_<delta>.*"""
+
+    regex = re.compile(r'eps_([-+]?[0-9.]+)_delta_([-+]?[0-9.]+)')
+    eps, delta = regex.search(os.path.basename(filename)).groups()
+
+    return float(eps.rstrip(".")), float(delta.rstrip("."))
+
+
+def find_archived_files(directories, prefix):
+    """Return all (optionally gzipped) sweep files of the form
+    <prefix>_eps_*_delta_*.dat below the given directories.
+
+    Matching members of sweep archives (see sweep.SweepArchive) are returned
+    as paths <archive>.tar/<member>, which can be read with
+    open_archived_file.
+    """
+
+    regex = re.compile(r'^' + prefix + r'_eps_.*_delta_.*\.dat(\.gz)?$')
+    index_extension = ARCHIVE_EXTENSION + ARCHIVE_INDEX_EXTENSION
+
+    archived_files = []
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            archived_files.extend(os.path.join(root, f) for f in files
+                                  if regex.match(f))
+            for f in files:
+                if f.endswith(index_extension):
+                    archive = os.path.join(root, f[:-len(
+                        ARCHIVE_INDEX_EXTENSION)])
+                    archived_files.extend(
+                        os.path.join(archive, m)
+                        for m in read_archive_index(archive)
+                        if regex.match(m))
+
+    return sorted(archived_files)
+
+
+def split_archive_path(path):
+    """Split a path of the form <archive>.tar/<member> into the archive and
+    the member name. Returns (path, None) for regular files."""
+
+    separator = ARCHIVE_EXTENSION + os.sep
+    if separator in path and not os.path.exists(path):
+        archive, member = path.rsplit(separator, 1)
+        return archive + ARCHIVE_EXTENSION, member
+
+    return path, None
+
+
+def read_archive_index(archive):
+    """Return the table of contents {member: (offset, size)} of a sweep
+    archive, read from <archive>.index. The result is cached until the
+    index file is modified."""
+
+    index_file = archive + ARCHIVE_INDEX_EXTENSION
+    key = (os.path.abspath(index_file), os.path.getmtime(index_file),
+           os.path.getsize(index_file))
+
+    if key not in _ARCHIVE_INDEX_CACHE:
+        index = {}
+        with open(index_file) as f:
+            for line in f:
+                name, offset, size = line.split()
+                index[name] = (int(offset), int(size))
+        _ARCHIVE_INDEX_CACHE[key] = index
+
+    return _ARCHIVE_INDEX_CACHE[key]
+
+
+def open_archived_file(path):
+    """Open a file for reading in binary mode. Gzipped files (*.gz) are
+    decompressed on the fly and members of sweep archives are addressed as
+    <archive>.tar/<member>, e.g., sweep_archive.tar/evals_eps_*.dat.gz."""
+
+    archive, member = split_archive_path(path)
+    if member is None:
+        opener = gzip.open if path.endswith(".gz") else open
+        return opener(path, "rb")
+
+    offset, size = read_archive_index(archive)[member]
+    with open(archive, "rb") as f:
+        f.seek(offset)
+        data = io.BytesIO(f.read(size))
+
+    if member.endswith(".gz"):
+        return gzip.GzipFile(fileobj=data, mode="rb")
+    else:
+        return data
+
+
 def natural_sorting(text, args="delta", sep="_"):
     """Sort a text with respect to a given argument value."""
 
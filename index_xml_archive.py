@@ -0,0 +1,73 @@
+#!/usr/bin/env python2.7
+
+import multiprocessing
+import numpy as np
+
+import argh
+
+from helper_functions import find_archived_files, get_eps_delta
+from xmlparser import read_params
+
+
+def read_archived_params(xmlfile):
+    """Return eps, delta and the xml parameters of an archived xml file."""
+
+    try:
+        eps, delta = get_eps_delta(xmlfile)
+        return eps, delta, read_params(xmlfile)
+    except Exception as ex:
+        print "WARNING: could not read {}: {}".format(xmlfile, ex)
+
+
+@argh.arg("directories", nargs="+", type=str)
+def index_xml_archive(directories, outfile="xml_params.dat", nprocs=None):
+    """Collect the parameters of all archived xml files of finished sweeps.
+
+    All (optionally gzipped) xml_eps_*_delta_*.dat files found below the given
+    directories, including the members of sweep archives, are parsed in
+    parallel. The parameters, including the derived grid settings nyout, dx,
+    dy, r_nx, r_ny and pot_len, are written to a single table with the
+    columns
+
+        eps delta <param_1> <param_2> ...
+
+    sorted with respect to eps and delta. Parameters missing in individual
+    files are set to nan.
+
+        Parameters:
+        -----------
+            directories: list of str
+                Directories to scan recursively.
+            outfile: str
+                Parameter table output file.
+            nprocs: int
+                Number of worker processes. Defaults to the number of CPUs.
+    """
+
+    xml_files = find_archived_files(directories, "xml")
+    print "Found {} xml files.".format(len(xml_files))
+
+    pool = multiprocessing.Pool(processes=nprocs)
+    results = [pool.apply_async(read_archived_params, args=(f,))
+               for f in xml_files]
+    results = [r.get() for r in results]
+    pool.close()
+    pool.join()
+
+    results = [r for r in results if r is not None]
+    if not results:
+        print "No xml parameters found."
+        return
+
+    names = sorted(set().union(*[params.keys() for _, _, params in results]))
+    table = np.array([[eps, delta] + [params.get(n, np.nan) for n in names]
+                      for eps, delta, params in results])
+    table = table[np.lexsort((table[:, 1], table[:, 0]))]
+
+    header = " ".join(["eps", "delta"] + names)
+    np.savetxt(outfile, table, header=header)
+    print "Wrote {} parameter sets to {}.".format(len(table), outfile)
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(index_xml_archive)
@@ -10,7 +10,7 @@ import argh
 import bloch
 from helper_functions import replace_in_file
 from ep.waveguide import Neumann, Dirichlet, DirichletPositionDependentLoss
-from xmlparser import XML
+from xmlparser import read_params
 
 
 class Jordan(object):
@@ -75,7 +75,7 @@ class Jordan(object):
         self.interactive = interactive
 
         self._update_boundary(x0, y0)
-        self.__dict__.update(XML(xml).params)
+        self.__dict__.update(read_params(xml))
 
     def _setup(self):
         pass
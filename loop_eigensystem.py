@@ -16,6 +16,7 @@ import traceback
 import argh
 
 import ep.profile
+from potential_writer import write_potential_file
 from ep.waveguide import Neumann, DirichletReduced, DirichletPositionDependentLossReduced
 import bloch
 
@@ -167,6 +168,7 @@ def run_single_job(n, xn, epsn, deltan, eta=None, pphw=None, XML=None, N=None,
         # get Bloch eigensystem
         K, _, ev, _, v, _ = bloch.get_eigensystem(return_eigenvectors=True,
                                                   return_velocities=True,
+                                                  eigenvector_modes=[0, 1],
                                                   verbose=True,
                                                   neumann=neumann)
         # remove eigenvalue files
@@ -512,12 +514,11 @@ def get_loop_eigenfunction(N=1.05, eta=0.0, L=5., d=1., eps=0.05, nx=None,
         np.savetxt("potential_{}.dat".format(n), c)
 
         c = np.abs(c).flatten(order='F')
-        nfile = range(len(c))
-        np.savetxt("potential_{}_imag.dat".format(n),
-                   zip(nfile, c), fmt='%i %10.6f')
+        write_potential_file("potential_{}_imag.dat".format(n), c,
+                             fmt='%i %10.6f')
         c = (c.max() - c)/c.max()
-        np.savetxt("potential_{}_imag_normalized.dat".format(n),
-                   zip(nfile, c), fmt='%i %10.6f')
+        write_potential_file("potential_{}_imag_normalized.dat".format(n), c,
+                             fmt='%i %10.6f')
     # -------------------------------------------------------------------------
 
     X, Y = np.meshgrid(x, y)
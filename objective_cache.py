@@ -0,0 +1,151 @@
+#!/usr/bin/env python2.7
+"""Persistent cache of objective function evaluations for the waveguide
+optimizers (optimize.py, optimize_reflection.py).
+
+    ObjectiveCache(path=CACHE, settings=None, digits=DIGITS):
+        Append-only file of the evaluated parameter vectors and objective
+        values, keyed by the rounded parameters and the fixed settings.
+
+    cached(function, cache):
+        Wrap an objective function such that evaluations are looked up in
+        and added to a cache.
+
+    get_file_hash(path):
+        Return the md5 hash of a file, e.g., of an input file template.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+CACHE = "optimize_cache.jsonl"
+# significant digits of the parameters used as cache key
+DIGITS = 10
+# population size per parameter of differential evolution (scipy's default)
+DE_POPSIZE = 15
+
+
+class ObjectiveCache(object):
+    """Persistent cache of objective function evaluations.
+
+    Every evaluation is appended as a JSON line {settings, x, value} to the
+    cache file, such that restarted optimizations, re-sampled points of
+    differential evolution and line searches revisiting a point are not
+    solved again. Only entries whose settings (the fixed arguments of the
+    objective, e.g., N, L, pphw and loop_type) match are used. Parameters
+    are compared after rounding to the given number of significant digits.
+
+        Parameters:
+        -----------
+            path: str
+                Cache file. An existing file is loaded.
+            settings: dict
+                Fixed arguments of the objective function (JSON
+                serializable).
+            digits: int
+                Significant digits of the parameters in the cache key.
+    """
+
+    def __init__(self, path=CACHE, settings=None, digits=DIGITS):
+        self.path = path
+        self.settings = settings or {}
+        self.digits = digits
+        self.entries = {}
+        self.hits = 0
+
+        settings_key = json.dumps(self.settings, sort_keys=True)
+        if os.path.exists(path):
+            with open(path) as f:
+                for n, line in enumerate(f):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        print "WARNING: skipping line {} of {}".format(n + 1,
+                                                                       path)
+                        continue
+                    if json.dumps(entry['settings'],
+                                  sort_keys=True) == settings_key:
+                        self.entries[self.get_key(entry['x'])] = entry
+            print "Loaded {} cached evaluations from {}.".format(len(self),
+                                                                 path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_key(self, x):
+        """Return the cache key of the parameters x."""
+        return tuple("{:.{}g}".format(float(xn), self.digits) for xn in x)
+
+    def get(self, x):
+        """Return the cached value of the parameters x, or None."""
+
+        entry = self.entries.get(self.get_key(x))
+        if entry is None:
+            return None
+
+        self.hits += 1
+        return entry['value']
+
+    def add(self, x, value):
+        """Add an evaluation to the cache and append it to the file."""
+
+        entry = {'settings': self.settings,
+                 'x': [float(xn) for xn in x],
+                 'value': float(value)}
+        self.entries[self.get_key(x)] = entry
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    def get_best(self):
+        """Return the parameters and the value of the cached evaluation with
+        the smallest value (None if the cache is empty)."""
+
+        if not self.entries:
+            return None
+        entry = min(self.entries.values(), key=lambda e: e['value'])
+
+        return np.array(entry['x']), entry['value']
+
+    def get_population(self, bounds, size):
+        """Return an initial population of differential evolution of the
+        given size: the best cached points within bounds, filled up with
+        uniformly distributed random points."""
+
+        lower, upper = np.array(bounds, dtype=float).T
+        entries = sorted(self.entries.values(), key=lambda e: e['value'])
+        best = [e['x'] for e in entries
+                if np.all((lower <= e['x']) & (e['x'] <= upper))][:size]
+
+        random = lower + (upper - lower)*np.random.random((size - len(best),
+                                                           len(lower)))
+
+        return np.vstack([np.reshape(best, (-1, len(lower))), random])
+
+
+def cached(function, cache):
+    """Return a wrapper of function(x, *args) which looks up the objective
+    value in cache and only calls function for new parameters x."""
+
+    def cached_function(x, *args):
+        value = cache.get(x)
+        if value is not None:
+            print "cached evaluation for x = {}".format(list(x))
+            return value
+
+        value = function(x, *args)
+        cache.add(x, value)
+        return value
+
+    return cached_function
+
+
+def get_file_hash(path):
+    """Return the md5 hash of the file content (None if the file does not
+    exist)."""
+
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
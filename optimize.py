@@ -2,6 +2,7 @@
 
 from __future__ import division
 
+import functools
 import glob
 import numpy as np
 import os
@@ -15,6 +16,12 @@ import argh
 
 import ep.potential
 from helper_functions import replace_in_file
+from objective_cache import (CACHE, DE_POPSIZE, ObjectiveCache, cached,
+                             get_file_hash)
+from sweep import get_groups, run_code, run_points
+
+
+SOLVER = "solve_xml_mumps"
 
 
 def prepare_calc(x, N=None, L=None, W=None, pphw=None, linearized=None,
@@ -45,28 +52,178 @@ def prepare_calc(x, N=None, L=None, W=None, pphw=None, linearized=None,
     replace_in_file(xml_template, xml, **replacements)
 
 
-def run_single_job(x, *args):
+def solve_single_job(x, *args):
     """Prepare and simulate a waveguide with profile
 
         xi = xi(eps0, delta0, phase0)
 
-    with a parametrization function determined by loop_type.
+    in the working directory and return the objective 1 - T together with
+    the S-matrix data.
     """
     prepare_calc(x, *args)
     ncores = args[-1]
-    cmd = "mpirun -np {0} solve_xml_mumps > greens.out 2>&1".format(ncores)
-    subprocess.call(cmd.split())
+    run_code(ncores=ncores, logfile="greens.out", solver=SOLVER)
 
     subprocess.call("S_Matrix.py -p", shell=True)
     S = np.loadtxt("S_matrix.dat", unpack=True, usecols=(5, 6))
     T = (S[5] + S[6])/2.
 
-    with open("optimize.log", "a") as f:
+    return 1. - T, S
+
+
+def write_log(x, S, logfile="optimize.log"):
+    """Append the parameters x and the S-matrix data to the logfile."""
+    with open(logfile, "a") as f:
         np.savetxt(f, x, newline=" ", fmt='%+15.8f')
         np.savetxt(f, S, newline=" ", fmt='%+.8e')
         f.write("\n")
 
-    return 1. - T
+
+def run_single_job(x, *args):
+    """Prepare and simulate a waveguide with profile
+
+        xi = xi(eps0, delta0, phase0)
+
+    with a parametrization function determined by loop_type.
+    """
+    value, S = solve_single_job(x, *args)
+    write_log(x, S)
+
+    return value
+
+
+def _solve_in_directory(directory, x, args):
+    """Run solve_single_job in directory (for use in sweep.run_points)."""
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        return solve_single_job(x, *args)
+    finally:
+        os.chdir(cwd)
+
+
+def get_gradient_points(x, stepsize, bounds=None):
+    """Return the one-sided difference points x + h*e_i and the signed steps
+    h, which keep the points within the bounds.
+
+    Forward steps are used where x + stepsize does not exceed the upper
+    bound, else backward steps. If neither fits (bound interval smaller than
+    stepsize), the step is clipped to the larger distance to the bounds,
+    which is 0 for a fixed parameter.
+    """
+
+    x = np.asarray(x, dtype=float)
+    steps = np.full(len(x), float(stepsize))
+    if bounds is not None:
+        lower, upper = np.array(bounds, dtype=float).T
+        forward = np.clip(upper - x, 0., stepsize)
+        backward = np.clip(x - lower, 0., stepsize)
+        steps = np.where(forward >= backward, forward, -backward)
+
+    return [x + h*e for h, e in zip(steps, np.eye(len(x)))], steps
+
+
+def run_single_job_with_gradient(x, *args, **kwargs):
+    """Return the objective of run_single_job and its finite-difference
+    gradient.
+
+    The base point and the len(x) perturbed points are simulated
+    concurrently in separate directories _grad_<n>, with the ncores cores
+    (last element of args) split evenly among the len(x) + 1 solver runs,
+    each of which is pinned to its own cores (see sweep.get_groups).
+    All evaluations are logged in optimize.log. Points found in the cache
+    are not solved again.
+
+        Parameters:
+        -----------
+            x: (3,) ndarray
+                Parameters (eps0, delta0, phase0).
+            args: tuple
+                Arguments of run_single_job.
+            stepsize: float
+                Finite-difference step.
+            bounds: list of tuples
+                Parameter bounds (lower, upper), see get_gradient_points.
+                The gradient of parameters without room for a step is 0.
+            cache: ObjectiveCache
+                Cache of previous evaluations.
+
+        Returns:
+        --------
+            value: float
+                Objective at x.
+            gradient: (3,) ndarray
+                Finite-difference gradient at x.
+    """
+
+    stepsize = kwargs.get('stepsize', 1e-2)
+    bounds = kwargs.get('bounds')
+    cache = kwargs.get('cache')
+
+    points, steps = get_gradient_points(x, stepsize, bounds=bounds)
+    points = [np.asarray(x, dtype=float)] + points
+
+    values = [None]*len(points)
+    if cache is not None:
+        for n, xn in enumerate(points):
+            values[n] = cache.get(xn)
+    # points of parameters without room for a step coincide with x
+    fixed = [n + 1 for n in np.flatnonzero(steps == 0.)]
+    todo = [n for n, value in enumerate(values)
+            if value is None and n not in fixed]
+    if not todo:
+        return get_gradient(values, steps, fixed)
+
+    ncores = args[-1]
+    ncores_job = max(ncores//len(todo), 1)
+    if ncores < len(todo):
+        print ("WARNING: {} cores are shared by {} concurrent solver "
+               "runs.").format(ncores, len(todo))
+    args = list(args[:-1]) + [ncores_job]
+
+    # isolated directories for the concurrent runs
+    root_dir = os.getcwd()
+    xml_template = args[5]
+    if xml_template:
+        args[5] = os.path.abspath(xml_template)
+    directories = []
+    for n in todo:
+        directory = os.path.join(root_dir, "_grad_" + str(n))
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.mkdir(directory)
+        directories.append(directory)
+
+    groups = get_groups(ncores_job, ntasks=ncores_job*len(todo))
+    results = list(run_points(_solve_in_directory,
+                              [(directory, points[n], args)
+                               for directory, n in zip(directories, todo)],
+                              groups=groups))
+    if None in results:
+        raise Exception("Error: solver runs for the gradient at x = {} "
+                        "failed.".format(list(x)))
+
+    for n, (value, S) in zip(todo, results):
+        write_log(points[n], S)
+        if cache is not None:
+            cache.add(points[n], value)
+        values[n] = value
+    for directory in directories:
+        shutil.rmtree(directory)
+
+    return get_gradient(values, steps, fixed)
+
+
+def get_gradient(values, steps, fixed=()):
+    """Return the objective at x and the one-sided difference gradient from
+    the values at x and the points of get_gradient_points (the points fixed
+    coincide with x)."""
+
+    values = np.array([values[0] if n in fixed else v
+                       for n, v in enumerate(values)], dtype=float)
+    steps = np.where(steps == 0., 1., steps)
+
+    return values[0], (values[1:] - values[0])/steps
 
 
 def get_shell_script_entry(Ln, node, ncores, root_dir):
@@ -198,8 +355,23 @@ def optimize(eps0=0.2, delta0=0.4, phase0=-1.0, L=10., W=1.,
              N=2.5, pphw=100, xml='input.xml', xml_template=None,
              linearized=False, loop_type='Allen-Eberly', ncores=4,
              algorithm='minimize', method='L-BFGS-B',
-             min_tol=1e-5, min_stepsize=1e-2, min_maxiter=100):
-    """Optimize the waveguide configuration with scipy.optimize.minimize."""
+             min_tol=1e-5, min_stepsize=1e-2, min_maxiter=100,
+             concurrent_gradient=False, cache=CACHE, warm_start=False):
+    """Optimize the waveguide configuration with scipy.optimize.minimize.
+
+    With concurrent_gradient, the finite-difference gradient of a single
+    length L is evaluated by solving the base point and all perturbed points
+    concurrently, with the ncores cores split among them (see
+    run_single_job_with_gradient), and passed to minimize as jac.
+
+    All evaluations are stored in the persistent cache file (keyed by the
+    rounded parameters, N, L, W, pphw, linearized, loop_type and the content
+    of the xml template), such that revisited points are not solved again,
+    e.g., when an optimization is restarted. An empty cache disables
+    caching. With warm_start, the minimization starts from the best cached
+    point and differential evolution from a population seeded with the best
+    cached points.
+    """
 
     if len(L) > 1:
         header = "#{:>14}" + 4*" {:>15}"
@@ -220,24 +392,65 @@ def optimize(eps0=0.2, delta0=0.4, phase0=-1.0, L=10., W=1.,
     args = (N, L, W, pphw, linearized, xml_template, xml, loop_type, ncores)
     BOUNDS = ((0.0, 0.35), (0.0, 3.5), (-3.5, 0.0))
 
+    objective_cache = None
+    if cache:
+        settings = {'objective': opt_func.__name__,
+                    'N': N,
+                    'L': L,
+                    'W': W,
+                    'pphw': pphw,
+                    'linearized': linearized,
+                    'loop_type': loop_type,
+                    'xml_template': get_file_hash(xml_template)}
+        objective_cache = ObjectiveCache(cache, settings=settings)
+
+    if warm_start and not objective_cache:
+        print ("WARNING: no cached evaluations for the warm start, starting "
+               "from the initial values.")
+        warm_start = False
+
     if algorithm == 'minimize':
         x0 = (eps0, delta0, phase0)
+        if warm_start:
+            x0, value = objective_cache.get_best()
+            print "warm start from x0 = {} (value {})".format(list(x0),
+                                                               value)
         min_kwargs = {'disp': True,
                       'ftol': min_tol,
                       'maxiter': min_maxiter,
                       'eps': min_stepsize}
+        if concurrent_gradient and opt_func is run_single_job:
+            opt_func = functools.partial(run_single_job_with_gradient,
+                                         stepsize=min_stepsize, bounds=BOUNDS,
+                                         cache=objective_cache)
+            jac = True
+        else:
+            if concurrent_gradient:
+                print ("WARNING: concurrent gradients are only available for "
+                       "a single length L.")
+            if objective_cache is not None:
+                opt_func = cached(opt_func, objective_cache)
+            jac = None
         res = scipy.optimize.minimize(opt_func, x0, args=args, bounds=BOUNDS,
-                                      method=method, options=min_kwargs)
+                                      method=method, jac=jac,
+                                      options=min_kwargs)
 
     elif algorithm == 'differential_evolution':
         de_kwargs = {'disp': True,
                      'tol': min_tol,
                      'maxiter': min_maxiter}
+        if objective_cache is not None:
+            opt_func = cached(opt_func, objective_cache)
+        if warm_start:
+            de_kwargs['init'] = objective_cache.get_population(
+                BOUNDS, DE_POPSIZE*len(BOUNDS))
         res = scipy.optimize.differential_evolution(opt_func, args=args,
                                                     bounds=BOUNDS,
                                                     **de_kwargs)
 
     np.save("minimize_res.npy", res)
+    if objective_cache is not None:
+        print "{} cached evaluations reused.".format(objective_cache.hits)
 
 
 if __name__ == '__main__':
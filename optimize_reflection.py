@@ -9,12 +9,17 @@ import subprocess
 
 import argh
 
+from objective_cache import (CACHE, DE_POPSIZE, ObjectiveCache, cached,
+                             get_file_hash)
 from S_Matrix import test_S_matrix_symmetry
 
 
+RUN_SCRIPT = "run.sh"
+
+
 def run_single_job(x):
 
-    cmd = "./run.sh {} {} {} {}".format(*x)
+    cmd = "./{} {} {} {} {}".format(RUN_SCRIPT, *x)
     subprocess.check_call(cmd.split())
 
     S, F = test_S_matrix_symmetry("Smat.complex_potential.dat")
@@ -30,15 +35,40 @@ def run_single_job(x):
 
 def optimize(thresh0=1e-2, sx0=6.5, sy0=1.05, ampl0=2e4,
              ncores=4, algorithm='minimize', method='L-BFGS-B',
-             min_tol=1e-5, min_stepsize=1e-2, min_maxiter=100):
-    """Optimize the waveguide configuration with scipy.optimize.minimize."""
+             min_tol=1e-5, min_stepsize=1e-2, min_maxiter=100,
+             cache=CACHE, warm_start=False):
+    """Optimize the waveguide configuration with scipy.optimize.minimize.
+
+    All evaluations are stored in the persistent cache file (keyed by the
+    rounded parameters and the content of run.sh), such that revisited
+    points are not solved again. An empty cache disables caching. With
+    warm_start, the minimization starts from the best cached point and
+    differential evolution from a population seeded with the best cached
+    points.
+    """
 
     opt_func = run_single_job
 
     BOUNDS = ((1e-3, 5e-2), (0.1, 30.0), (0.1, 30.0), (1e1, 1e5))
 
+    objective_cache = None
+    if cache:
+        settings = {'objective': 'optimize_reflection',
+                    'run_script': get_file_hash(RUN_SCRIPT)}
+        objective_cache = ObjectiveCache(cache, settings=settings)
+        opt_func = cached(opt_func, objective_cache)
+
+    if warm_start and not objective_cache:
+        print ("WARNING: no cached evaluations for the warm start, starting "
+               "from the initial values.")
+        warm_start = False
+
     if algorithm == 'minimize':
         x0 = (thresh0, sx0, sy0, ampl0)
+        if warm_start:
+            x0, value = objective_cache.get_best()
+            print "warm start from x0 = {} (value {})".format(list(x0),
+                                                               value)
         min_kwargs = {'disp': True,
                       'ftol': min_tol,
                       'maxiter': min_maxiter,
@@ -50,11 +80,16 @@ def optimize(thresh0=1e-2, sx0=6.5, sy0=1.05, ampl0=2e4,
         de_kwargs = {'disp': True,
                      'tol': min_tol,
                      'maxiter': min_maxiter}
+        if warm_start:
+            de_kwargs['init'] = objective_cache.get_population(
+                BOUNDS, DE_POPSIZE*len(BOUNDS))
         res = scipy.optimize.differential_evolution(opt_func,
                                                     bounds=BOUNDS,
                                                     **de_kwargs)
 
     np.save("minimize_res.npy", res)
+    if objective_cache is not None:
+        print "{} cached evaluations reused.".format(objective_cache.hits)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,134 @@
+#!/usr/bin/env python2.7
+"""Fast writer for greens_code potential and boundary files.
+
+    write_columns(outfile, columns, fmt=FMT, chunksize=CHUNKSIZE):
+        Write 1D arrays as the columns of a text table.
+
+    write_potential_file(outfile, values, fmt=FMT, chunksize=CHUNKSIZE,
+                         binary=False):
+        Write the potential values in the 'index value' format read by
+        greens_code (or as raw binary data).
+
+    benchmark(npoints=10**6, repeat=3):
+        Compare the throughput with np.savetxt and check that the output is
+        byte-identical.
+"""
+import numpy as np
+import os
+import time
+
+import argh
+
+
+# np.savetxt's default format for two columns
+FMT = '%.18e %.18e'
+CHUNKSIZE = 2**16
+
+
+def write_columns(outfile, columns, fmt=FMT, chunksize=CHUNKSIZE):
+    """Write the 1D arrays columns as the columns of a text table.
+
+    The output is byte-identical to
+
+        np.savetxt(outfile, zip(*columns), fmt=fmt),
+
+    but is formatted in chunks of chunksize rows without building a list of
+    row tuples.
+
+        Parameters:
+        -----------
+            outfile: str
+                Output file.
+            columns: list of (N,) ndarrays
+                Table columns.
+            fmt: str
+                Row format.
+            chunksize: int
+                Number of rows formatted at once.
+    """
+
+    nrows = len(columns[0])
+    row = fmt + "\n"
+    table = np.empty((min(chunksize, nrows), len(columns)))
+    with open(outfile, "w") as f:
+        for start in xrange(0, nrows, chunksize):
+            n = min(chunksize, nrows - start)
+            for m, column in enumerate(columns):
+                table[:n, m] = column[start:start+n]
+            f.write((row*n) % tuple(table[:n].ravel()))
+
+
+def write_potential_file(outfile, values, fmt=FMT, chunksize=CHUNKSIZE,
+                         binary=False):
+    """Write the potential values to outfile.
+
+    The text output is byte-identical to
+
+        np.savetxt(outfile, list(enumerate(values)), fmt=fmt),
+
+    but is formatted in chunks of chunksize rows without building a list of
+    (index, value) tuples for the full grid.
+
+        Parameters:
+        -----------
+            outfile: str
+                Output file.
+            values: (N,) ndarray
+                Potential values, e.g., P.flatten('F').
+            fmt: str
+                Row format for the columns 'index value'.
+            chunksize: int
+                Number of rows formatted at once.
+            binary: bool
+                Whether to write the values as raw little-endian float64
+                data (without indices) instead.
+    """
+
+    values = np.ravel(values)
+
+    if binary:
+        values.astype('<f8').tofile(outfile)
+        return
+
+    write_columns(outfile, (np.arange(len(values)), values), fmt=fmt,
+                  chunksize=chunksize)
+
+
+def benchmark(npoints=10**6, repeat=3, fmt=FMT, outfile="benchmark.dat"):
+    """Compare write_potential_file with np.savetxt for a random potential of
+    npoints grid-points and check that both outputs are byte-identical."""
+
+    values = np.random.random(npoints)
+    reference = outfile + ".savetxt"
+
+    timings = {}
+    for name, write in (('np.savetxt', lambda: np.savetxt(
+                            reference, list(enumerate(values)), fmt=fmt)),
+                        ('write_potential_file', lambda: write_potential_file(
+                            outfile, values, fmt=fmt)),
+                        ('write_potential_file (binary)',
+                         lambda: write_potential_file(
+                            outfile + ".bin", values, binary=True))):
+        T = []
+        for n in range(repeat):
+            t0 = time.time()
+            write()
+            T.append(time.time() - t0)
+        timings[name] = min(T)
+
+    with open(reference) as f, open(outfile) as g:
+        identical = f.read() == g.read()
+
+    size = os.path.getsize(outfile)/1e6
+    print "{} grid-points, {:.1f} MB, best of {}:".format(npoints, size, repeat)
+    for name, T in sorted(timings.iteritems(), key=lambda x: -x[1]):
+        print "    {:32} {:8.3f}s {:12.0f} points/s".format(name, T,
+                                                           npoints/T)
+    print "byte-identical text output:", identical
+
+    for f in (outfile, reference, outfile + ".bin"):
+        os.remove(f)
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(benchmark)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python2.7
+"""Multi-resolution pyramids of large grids for fast plotting.
+
+    downsample(X, Y, Z, factor=2, pooling='max'):
+        Downsample a grid and its coordinates by block pooling.
+
+    build_pyramid(X, Y, Z, pooling='max', min_size=MIN_SIZE):
+        Return the successively downsampled levels of a grid (each axis is
+        pooled as long as it is longer than 2*min_size).
+
+    save_pyramid(outfile, **pyramids):
+        Write one or more pyramids to a .npz file.
+
+    load_pyramid(infile, name):
+        Read a pyramid written by save_pyramid.
+
+    get_dpi(figsize=None):
+        Return the resolution of savefig, bounded to MAX_PIXELS.
+
+    select_level(levels, figsize, dpi=None):
+        Return the coarsest level that still resolves the output image.
+"""
+import numpy as np
+
+import argh
+
+
+MIN_SIZE = 256
+# largest number of pixels of a figure along each axis, see get_dpi
+MAX_PIXELS = 8192
+POOLING = {'max': np.max,
+           'min': np.min,
+           'mean': np.mean}
+
+
+def _pool_axis(u, factor, pooling, axis):
+    """Pool the 2D array u in blocks of the given factor along axis."""
+
+    n = u.shape[axis] // factor
+    if axis == 0:
+        u = u[:n*factor].reshape(n, factor, -1)
+    else:
+        u = u[:, :n*factor].reshape(u.shape[0], n, factor)
+
+    return POOLING[pooling](u, axis=axis+1)
+
+
+def _pool_1d(u, factor):
+    """Average the 1D array u in blocks of the given factor."""
+
+    n = len(u) // factor
+    return u[:n*factor].reshape(n, factor).mean(axis=1)
+
+
+def downsample(X, Y, Z, factor=2, pooling='max'):
+    """Downsample a grid Z(y, x) and its coordinates by block pooling.
+
+    Z is pooled with the given pooling function (max|min|mean) over blocks
+    of factor x factor grid points, or fy x fx grid points if factor is a
+    tuple (fy, fx); the coordinates X and Y, either 1D axes or 2D meshgrids,
+    are averaged over the same blocks. Trailing rows and columns which do
+    not fill a complete block are discarded.
+    """
+
+    fy, fx = factor if np.iterable(factor) else (factor, factor)
+
+    for axis, f in enumerate((fy, fx)):
+        if f > 1:
+            Z = _pool_axis(Z, f, pooling, axis)
+            if X.ndim == 2:
+                X = _pool_axis(X, f, 'mean', axis)
+            if Y.ndim == 2:
+                Y = _pool_axis(Y, f, 'mean', axis)
+
+    if X.ndim == 1 and fx > 1:
+        X = _pool_1d(X, fx)
+    if Y.ndim == 1 and fy > 1:
+        Y = _pool_1d(Y, fy)
+
+    return X, Y, Z
+
+
+def build_pyramid(X, Y, Z, pooling='max', min_size=MIN_SIZE):
+    """Return the list of levels [(X, Y, Z), ...] of a grid, where level 0 is
+    the input and each following level is downsampled by a factor of 2 along
+    each axis which does not drop below min_size. The axes are pooled
+    separately, i.e., the long x-axis of a waveguide is downsampled even if
+    the y-axis is already short."""
+
+    levels = [(X, Y, Z)]
+    while True:
+        factor = [2 if n // 2 >= min_size else 1 for n in Z.shape]
+        if factor == [1, 1]:
+            break
+        X, Y, Z = downsample(X, Y, Z, factor=factor, pooling=pooling)
+        levels.append((X, Y, Z))
+
+    return levels
+
+
+def save_pyramid(outfile, **pyramids):
+    """Write the downsampled levels (>= 1) of one or more pyramids, given as
+    name=levels keyword arguments, to a .npz file. The arrays are stored as
+    <name>_<X|Y|Z>_<level>."""
+
+    arrays = {}
+    for name, levels in pyramids.iteritems():
+        for n, level in enumerate(levels[1:], 1):
+            for c, u in zip("XYZ", level):
+                arrays["{}_{}_{}".format(name, c, n)] = u
+    np.savez(outfile, **arrays)
+
+
+def load_pyramid(infile, name, level0=None):
+    """Return the levels of the pyramid name stored in infile. The full
+    resolution level 0 is not stored and has to be supplied separately if
+    needed."""
+
+    npz_file = np.load(infile)
+
+    levels = [level0] if level0 is not None else []
+    n = 1
+    while "{}_Z_{}".format(name, n) in npz_file.files:
+        levels.append(tuple(npz_file["{}_{}_{}".format(name, c, n)]
+                            for c in "XYZ"))
+        n += 1
+
+    return levels
+
+
+def get_dpi(figsize=None):
+    """Return the resolution used by matplotlib's savefig. If figsize is
+    given, the resolution is reduced such that the figure has at most
+    MAX_PIXELS pixels along each axis (pass it to savefig)."""
+    import matplotlib
+
+    dpi = matplotlib.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = matplotlib.rcParams['figure.dpi']
+    if figsize is not None:
+        dpi = min(dpi, float(MAX_PIXELS)/max(figsize))
+
+    return dpi
+
+
+def select_level(levels, figsize, dpi=None):
+    """Return the coarsest level (X, Y, Z) which still resolves the output
+    image, i.e., each axis of its grid either has at least as many points as
+    the image has pixels (at most MAX_PIXELS) in this direction or is not
+    downsampled at all.
+
+        Parameters:
+        -----------
+            levels: list of tuples
+                Pyramid, see build_pyramid.
+            figsize: tuple of floats
+                Size (width, height) of the figure or axes in inches.
+            dpi: float
+                Resolution. Defaults to get_dpi(figsize).
+    """
+
+    if dpi is None:
+        dpi = get_dpi(figsize)
+    nx_pixels, ny_pixels = [min(s*dpi, MAX_PIXELS) for s in figsize]
+    ny0, nx0 = levels[0][2].shape
+
+    for X, Y, Z in reversed(levels):
+        ny, nx = Z.shape
+        if (nx >= nx_pixels or nx == nx0) and (ny >= ny_pixels or ny == ny0):
+            return X, Y, Z
+
+    return levels[0]
+
+
+@argh.arg('npz-file', type=str)
+def main(npz_file, pooling='max', min_size=MIN_SIZE):
+    """Build the pyramid of the arrays X, Y, Z stored in an .npz file (as
+    written by ascii_to_numpy) and write it to <npz_file>_pyramid.npz."""
+
+    data = np.load(npz_file)
+    levels = build_pyramid(data['X'], data['Y'], data['Z'], pooling=pooling,
+                           min_size=min_size)
+    outfile = npz_file.replace(".npz", "") + "_pyramid.npz"
+    save_pyramid(outfile, Z=levels)
+    print "Wrote {} levels to {}.".format(len(levels) - 1, outfile)
+
+
+if __name__ == '__main__':
+    argh.dispatch_command(main)
@@ -1,29 +1,33 @@
 #!/usr/bin/env python2.7
 
+import glob
+import itertools
 import os
 import numpy as np
 import shutil
-import subprocess
 import sys
 
 import argh
 
 import bloch
 from ep.waveguide import Neumann, Dirichlet
+from estimate_runtime import format_time, get_runtime
 from helper_functions import replace_in_file
+from potential_writer import write_columns
+from sweep import (ARCHIVE, DONE, FAILED, MANIFEST, RUN_DIRECTORY, RUNNING,
+                   SweepArchive, SweepManifest, get_allocation_size,
+                   get_groups, get_point_id, iter_prefetched,
+                   make_run_directory, plan_points, run_code, run_points)
+from xmlparser import get_grid_params
 
 
-def run_code():
-    if os.environ.get('TMPDIR') and os.environ.get('NSLOTS'):
-        print "running code on cluster..."
-        print "$TMPDIR", os.environ.get('TMPDIR')
-        print "$NSLOTS", os.environ.get('NSLOTS')
-        cmd = ("time mpirun -np {SLURM_NTASKS} "
-               "solve_xml_mumps_dev").format(**os.environ)
-    else:
-        print "running code locally..."
-        cmd = "solve_xml_mumps_dev"
-    subprocess.call(cmd.split())
+PREFETCH = 4
+MACHINE = 'VSC3'
+# waveguides and x-grids per (delta, N, pphw, eta, W, neumann), see
+# get_waveguide
+_WAVEGUIDES = {}
+# boundaries of the eps values of the current delta, see get_boundaries
+_BOUNDARIES = {}
 
 
 def print_diff_warning(array, name):
@@ -37,31 +41,529 @@ def print_diff_warning(array, name):
         """.format(np.diff(array), name)
 
 
-def archive(infile, outfile, delete=True):
-    """Copy infile to outfile, compress the destination file and remove the
-    source."""
+def get_kr(N=2.6, neumann=0):
+    """Return the wavenumber difference kr = k0 - k1 of the modes 0 and 1."""
+
+    if not neumann:
+        k0, k1 = [np.sqrt(N**2 - n**2)*np.pi for n in (1, 2)]
+    else:
+        k0, k1 = [np.sqrt(N**2 - n**2)*np.pi for n in (0, 1)]
+
+    return k0 - k1
+
+
+def get_waveguide(delta, N=2.6, pphw=300, eta=0.1, W=1.0, neumann=0):
+    """Return the Constant-loop waveguide, the unit cell length L and the
+    x-grid of the boundary for a given delta.
+
+    Both only depend on delta (and the fixed sweep settings), but not on
+    eps, and are therefore cached for the lifetime of the process, i.e., they
+    are built once per delta and reused for all eps values of a sweep.
+    """
+
+    key = (delta, N, pphw, eta, W, neumann)
+    if key not in _WAVEGUIDES:
+        L = abs(2*np.pi/(get_kr(N, neumann) + delta))
+
+        # choose discretization such that r_nx < len(x_range)
+        r_nx_L = int(L*(N*pphw + 1))
+        x_range = np.linspace(0, L, r_nx_L)
+        if not neumann:
+            WG = Dirichlet(loop_type='Constant', N=N, L=L, W=W, eta=eta)
+        else:
+            WG = Neumann(loop_type='Constant', N=N, L=L, W=W, eta=eta)
+        _WAVEGUIDES[key] = (WG, L, x_range)
+
+    return _WAVEGUIDES[key]
+
+
+def get_point_cost(eps, delta, N=2.6, pphw=300, W=1.0, neumann=0, ncores=1,
+                   machine=MACHINE):
+    """Return the runtime of the point (eps, delta) estimated with
+    estimate_runtime.get_runtime.
+
+    The grid size (r_nx, r_ny) is derived from the xml parameters as in
+    xmlparser.read_params, i.e., as for the runs the coefficients of the
+    runtime model are calibrated with (see calibrate_runtime). Only r_nx
+    depends on the point, via the unit cell length L(delta).
+    """
+
+    L = abs(2*np.pi/(get_kr(N, neumann) + delta))
+    grid = get_grid_params({'modes': N, 'points_per_halfwave': pphw, 'W': W,
+                            'L': L})
+
+    return get_runtime(nx=grid['r_nx'], ny=grid['r_ny'], Ncores=ncores,
+                       machine=machine, verbose=False)
+
+
+def get_boundaries(eps_values, delta, N=2.6, pphw=300, eta=0.1, W=1.0,
+                   neumann=0):
+    """Return the lower and upper boundaries of all eps values for a given
+    delta as a dict {eps: (xi_lower, xi_upper)}.
+
+    The boundaries are evaluated in a single call of get_boundary with eps
+    as a column vector, i.e., as arrays of shape (len(eps_values),
+    len(x_range)). If the waveguide does not broadcast over eps (checked
+    against single evaluations of the first and last eps value), the
+    boundaries are evaluated point by point. Only the boundaries of the
+    last delta are kept.
+    """
+
+    key = (delta, N, pphw, eta, W, neumann, tuple(eps_values))
+    if key not in _BOUNDARIES:
+        _BOUNDARIES.clear()
+        WG, L, x_range = get_waveguide(delta, N=N, pphw=pphw, eta=eta, W=W,
+                                       neumann=neumann)
+        eps_values = np.asarray(eps_values, dtype=float)
+        shape = (len(eps_values), len(x_range))
+
+        try:
+            xi_lower, xi_upper = [np.broadcast_to(xi, shape) for xi in
+                                  WG.get_boundary(x=x_range,
+                                                  eps=eps_values[:, np.newaxis],
+                                                  delta=delta)]
+            for n in set((0, len(eps_values) - 1)):
+                single = WG.get_boundary(x=x_range, eps=eps_values[n],
+                                         delta=delta)
+                if not (np.allclose(xi_lower[n], single[0]) and
+                        np.allclose(xi_upper[n], single[1])):
+                    raise ValueError("boundaries do not broadcast over eps")
+        except Exception as ex:
+            print ("WARNING: batched boundary evaluation failed ({}), "
+                   "evaluating point by point").format(ex)
+            xi_lower, xi_upper = zip(*[WG.get_boundary(x=x_range, eps=e,
+                                                       delta=delta)
+                                       for e in eps_values])
+
+        _BOUNDARIES[key] = dict(zip(eps_values, zip(xi_lower, xi_upper)))
+
+    return _BOUNDARIES[key]
+
+
+def write_boundary(eps, delta, N=2.6, pphw=300, eta=0.1, W=1.0, neumann=0,
+                   rundir=".", eps_values=None):
+    """Write the boundary files lower.boundary and upper.boundary for the
+    point (eps, delta) to the directory rundir. If eps_values (containing
+    eps) is given, the boundaries of all eps_values are evaluated at once
+    (see get_boundaries).
+
+        Returns:
+        --------
+            L: float
+                Length of the unit cell.
+            N_file_boundary: int
+                Number of boundary points.
+    """
+
+    WG, L, x_range = get_waveguide(delta, N=N, pphw=pphw, eta=eta, W=W,
+                                   neumann=neumann)
+
+    if eps_values is None:
+        xi_lower, xi_upper = WG.get_boundary(x=x_range, eps=eps, delta=delta)
+    else:
+        xi_lower, xi_upper = get_boundaries(eps_values, delta, N=N, pphw=pphw,
+                                            eta=eta, W=W,
+                                            neumann=neumann)[eps]
+    print "lower.boundary.shape", xi_lower.shape
+
+    write_columns(os.path.join(rundir, "lower.boundary"), (x_range, xi_lower))
+    write_columns(os.path.join(rundir, "upper.boundary"), (x_range, xi_upper))
+
+    return L, len(x_range)
+
+
+def write_xml(L, N_file_boundary, N=2.6, pphw=300, eta=0.1, W=1.0,
+              xml="input.xml", xml_template="input.xml_template", neumann=0,
+              rundir="."):
+    """Render the xml input file from the template in the directory
+    rundir."""
+
+    replacements = {'LENGTH': str(L),
+                    'WIDTH': str(W),
+                    'MODES': str(N),
+                    'PPHW': str(pphw),
+                    'GAMMA0': str(eta),
+                    'NEUMANN': str(neumann),
+                    'N_FILE_BOUNDARY': str(N_file_boundary),
+                    'BOUNDARY_UPPER': 'upper.boundary',
+                    'BOUNDARY_LOWER': 'lower.boundary'}
+
+    replace_in_file(xml_template, os.path.join(rundir, xml), **replacements)
+
+
+def update_boundary(eps, delta, N=2.6, pphw=300, eta=0.1, W=1.0,
+                    xml="input.xml", xml_template="input.xml_template",
+                    neumann=0, rundir=".", eps_values=None):
+    """Write the boundary files and the xml input file for the point
+    (eps, delta) to the directory rundir."""
+
+    L, N_file_boundary = write_boundary(eps, delta, N=N, pphw=pphw, eta=eta,
+                                        W=W, neumann=neumann, rundir=rundir,
+                                        eps_values=eps_values)
+    write_xml(L, N_file_boundary, N=N, pphw=pphw, eta=eta, W=W, xml=xml,
+              xml_template=xml_template, neumann=neumann, rundir=rundir)
+
+
+def prepare_point(eps, delta, N=2.6, pphw=300, eta=0.1, W=1.0,
+                  xml="input.xml", xml_template="input.xml_template",
+                  neumann=0, rundir_root=RUN_DIRECTORY, eps_values=None):
+    """Create the run directory of the point (eps, delta) and render its
+    input files. Returns the point (eps, delta).
+
+    The boundaries of all eps_values of the same delta are evaluated
+    together, see get_boundaries."""
+
+    rundir = make_run_directory(rundir_root, get_point_id(eps, delta))
     try:
-        shutil.copy(infile, outfile)
-        subprocess.call(['gzip', outfile])
-        if delete:
-            os.remove(infile)
-    except:
-        print "WARNING: could not archive " + infile
+        update_boundary(eps, delta, N=N, pphw=pphw, eta=eta, W=W, xml=xml,
+                        xml_template=xml_template, neumann=neumann,
+                        rundir=rundir, eps_values=eps_values)
+    except Exception as ex:
+        print "WARNING: could not prepare point {}: {}".format((eps, delta),
+                                                               ex)
+
+    return eps, delta
+
+
+def run_point(eps, delta, N=2.6, pphw=300, eta=0.1, W=1.0, xml="input.xml",
+              xml_template="input.xml_template", neumann=0,
+              rundir_root=RUN_DIRECTORY, ncores=None, keep_rundirs=False,
+              prepared=False):
+    """Render the input files of the point (eps, delta) in its own run
+    directory (unless prepared with prepare_point), run the solver there
+    and collect the output files.
+
+        Returns:
+        --------
+            result: tuple
+                Parameters, the two leading Bloch modes and the overlap of
+                their eigenvectors (eps, delta, ev0, ev1, overlap), or None if
+                the solver output cannot be read.
+            files: dict
+                Contents of the output files to be archived, keyed by their
+                archive names.
+    """
+
+    point_id = get_point_id(eps, delta)
+    if prepared:
+        rundir = os.path.join(rundir_root, "run_" + point_id)
+    else:
+        rundir = make_run_directory(rundir_root, point_id)
+        update_boundary(eps, delta, N=N, pphw=pphw, eta=eta, W=W, xml=xml,
+                        xml_template=xml_template, neumann=neumann,
+                        rundir=rundir)
+    run_code(cwd=rundir, ncores=ncores, logfile="tmp.out")
+
+    def in_rundir(pattern):
+        files = glob.glob(os.path.join(rundir, pattern))
+        return files[0] if files else os.path.join(rundir, pattern)
+
+    result = None
+    files = {}
+
+    def collect(infile, name):
+        try:
+            with open(infile, "rb") as f:
+                files[name] = f.read()
+        except IOError:
+            print "WARNING: could not archive " + infile
+
+    try:
+        # if bloch.get_eigensystem is not called with modes, dx, etc.,
+        # these values are read from the xml file
+        evalsfile, evecsfile = [in_rundir(f) for f in ("Evals.*.dat",
+                                                       "Evecs.*.dat")]
+        bloch_evals, _, bloch_evecs, _ = bloch.get_eigensystem(
+            xml=os.path.join(rundir, xml), evalsfile=evalsfile,
+            evecsfile=evecsfile, return_eigenvectors=True,
+            eigenvector_modes=[0, 1], neumann=neumann)
+        bloch_evals, bloch_evecs = [np.array(x)[:2]
+                                    for x in (bloch_evals, bloch_evecs)]
+        overlap = (np.abs(bloch_evecs[0] - bloch_evecs[1])**2).sum()
+        print "overlap", overlap
+        result = (eps, delta, bloch_evals[0], bloch_evals[1], overlap)
+
+        # backup output files
+        collect(evalsfile, "evals_" + point_id + ".dat")
+        collect(os.path.join(rundir, xml), "xml_" + point_id + ".dat")
+    except Exception as ex:
+        print "Evals, evecs or xml file not found: {}".format(ex)
+
+    collect(os.path.join(rundir, "tmp.out"), "tmp_" + point_id + ".out")
+    # be backwards compatible in case no jpg is written
+    collect(in_rundir("pic.geometry.*.1.jpg"), "jpg_" + point_id + ".jpg")
+
+    if not keep_rundirs:
+        shutil.rmtree(rundir, ignore_errors=True)
+
+    return result, files
+
+
+def get_cell_score(gaps, size, slopes):
+    """Return a lower estimate of the eigenvalue gap |K0 - K1| inside a cell.
+
+    Each point of the cell is at most half the cell size away from one of
+    the corners in each direction, hence the gap inside the cell is bounded
+    from below by the smallest corner gap minus the largest change allowed
+    by the slopes of the gap in eps- and delta-direction. Small scores
+    indicate cells which may contain an exceptional point.
+
+        Parameters:
+        -----------
+            gaps: list of floats
+                Gaps at the corners of the cell.
+            size: tuple of floats
+                Cell size (eps, delta).
+            slopes: tuple of floats
+                Estimated maximum slopes |d gap/d eps|, |d gap/d delta| in
+                the vicinity of the cell.
+    """
+
+    gaps = np.asarray(gaps)
+    if not np.all(np.isfinite(gaps)):
+        return np.inf
+
+    return gaps.min() - (slopes[0]*size[0] + slopes[1]*size[1])/2.
+
+
+def refine_adaptively(solve, eps_range, delta_range, budget=None,
+                      resolution=None, tolerance=0., batchsize=1):
+    """Refine the grid eps_range x delta_range around exceptional points.
+
+    Starting from the coarse grid, cells with a score (see get_cell_score)
+    below tolerance, i.e., cells which may contain a vanishing gap, are
+    recursively split into four subcells, starting with the cells with the
+    smallest corner gap, until they are smaller than the target resolution
+    or the budget of solver calls is spent. The slopes of the gap are
+    estimated locally from the corner gaps of each cell and of the cells
+    touching it.
+
+    The coarse grid counts against the budget: if it has more points than
+    the budget allows, every n-th value of eps_range and delta_range (and
+    the last one) is used instead.
+
+        Parameters:
+        -----------
+            solve: function
+                solve(points) returns a dict mapping each (eps, delta) point
+                to the eigenvalue gap |K0 - K1| (nan for failed points).
+            eps_range, delta_range: ndarrays
+                Coarse grid.
+            budget: int
+                Maximum number of solver calls including the coarse grid
+                (at least 4). Defaults to no limit.
+            resolution: tuple of floats
+                Target cell size (eps, delta). Defaults to 1/8 of the coarse
+                grid spacing.
+            tolerance: float
+                Cells with a score below tolerance are refined.
+            batchsize: int
+                Minimum number of new points solved at once.
+
+        Returns:
+        --------
+            points: list of tuples
+                All (eps, delta) points solved.
+    """
+
+    if resolution is None:
+        resolution = [np.diff(u).min()/8. for u in (eps_range, delta_range)]
+    if budget is None:
+        budget = np.inf
+    elif budget < 4:
+        raise Exception("Error: a budget of at least 4 solver calls is "
+                        "required.")
+
+    def thin(u, stride):
+        return u[sorted(set(range(0, len(u), stride)) | set([len(u) - 1]))]
+
+    stride = 1
+    while len(thin(eps_range, stride))*len(thin(delta_range, stride)) > budget:
+        stride += 1
+    if stride > 1:
+        eps_range, delta_range = [thin(u, stride)
+                                  for u in (eps_range, delta_range)]
+        print ("WARNING: coarse grid exceeds the budget of {} solver calls, "
+               "thinning it with a stride of {} ({}x{} points).").format(
+                   budget, stride, len(eps_range), len(delta_range))
+
+    points = [(e, d) for e in eps_range for d in delta_range]
+    gaps = solve(points)
+    calls = len(points)
+
+    def get_corners(cell):
+        e0, e1, d0, d1 = cell
+        return [(e0, d0), (e0, d1), (e1, d0), (e1, d1)]
+
+    def split(cell):
+        e0, e1, d0, d1 = cell
+        em, dm = (e0 + e1)/2., (d0 + d1)/2.
+        return [(e0, em, d0, dm), (e0, em, dm, d1),
+                (em, e1, d0, dm), (em, e1, dm, d1)]
+
+    def get_slopes(cells):
+        # largest finite differences of the gap along the edges of each cell
+        # and of the cells touching it
+        slopes = np.zeros((len(cells), 2))
+        for n, cell in enumerate(cells):
+            e0, e1, d0, d1 = cell
+            g00, g01, g10, g11 = [gaps[p] for p in get_corners(cell)]
+            slopes[n] = (np.fmax(abs(g10 - g00), abs(g11 - g01))/(e1 - e0),
+                         np.fmax(abs(g01 - g00), abs(g11 - g10))/(d1 - d0))
+        slopes[~np.isfinite(slopes)] = 0.
+
+        e0, e1, d0, d1 = np.array(cells).T
+        touching = ((e0[:, np.newaxis] <= e1) & (e0 <= e1[:, np.newaxis]) &
+                    (d0[:, np.newaxis] <= d1) & (d0 <= d1[:, np.newaxis]))
+        return dict(zip(cells, [slopes[t].max(axis=0) for t in touching]))
+
+    cells = [(e0, e1, d0, d1)
+             for e0, e1 in zip(eps_range[:-1], eps_range[1:])
+             for d0, d1 in zip(delta_range[:-1], delta_range[1:])]
+
+    while calls < budget:
+        slopes = get_slopes(cells)
+        candidates = [c for c in cells if (c[1] - c[0] > resolution[0] or
+                                           c[3] - c[2] > resolution[1])]
+        corner_gaps = [[gaps[p] for p in get_corners(c)] for c in candidates]
+        candidates = [(min(g), c) for c, g in zip(candidates, corner_gaps)
+                      if get_cell_score(g, (c[1] - c[0], c[3] - c[2]),
+                                        slopes[c]) < tolerance]
+        candidates = [c for _, c in sorted(candidates)]
+        if not candidates:
+            break
+
+        # split the most promising cells until the batch is filled
+        refined, new_points = [], []
+        for cell in candidates:
+            subcells = split(cell)
+            cell_points = set(p for c in subcells for p in get_corners(c))
+            cell_points = [p for p in sorted(cell_points)
+                           if p not in gaps and p not in new_points]
+            if calls + len(new_points) + len(cell_points) > budget:
+                break
+            refined.append(cell)
+            new_points.extend(cell_points)
+            if len(new_points) >= batchsize:
+                break
+        if not refined:
+            break
+
+        print "Refining {} cells with {} new points...".format(
+            len(refined), len(new_points))
+        gaps.update(solve(new_points))
+        calls += len(new_points)
+        points.extend(new_points)
+        for cell in refined:
+            cells.remove(cell)
+            cells.extend(split(cell))
+
+    print "Adaptive refinement finished after {} solver calls.".format(calls)
+
+    return points
 
 
 @argh.arg("--eps", type=float, nargs="+")
 @argh.arg("--delta", type=float, nargs="+")
+@argh.arg("--ncores", type=int)
+@argh.arg("--group-size", type=int)
+@argh.arg("--budget", type=int)
+@argh.arg("--resolution", type=float, nargs=2)
+@argh.arg("--tolerance", type=float)
 def raster_eps_delta(N=2.6, pphw=300, eta=0.1, W=1.0, xml="input.xml",
                      xml_template="input.xml_template", eps=[0.01, 0.1, 30],
-                     delta=[0.3, 0.7, 50], dryrun=False, neumann=0):
+                     delta=[0.3, 0.7, 50], dryrun=False, neumann=0,
+                     nprocs=1, ncores=None, group_size=None,
+                     rundir_root=RUN_DIRECTORY, keep_rundirs=False, manifest=MANIFEST, archive=ARCHIVE,
+                     prefetch=PREFETCH, machine=MACHINE, adaptive=False,
+                     budget=None, resolution=None, tolerance=0.):
+    """Calculate the Bloch modes on the grid eps x delta.
 
-    # k_x for modes 0 and 1
-    if not neumann:
-        k0, k1 = [np.sqrt(N**2 - n**2)*np.pi for n in (1, 2)]
-    else:
-        k0, k1 = [np.sqrt(N**2 - n**2)*np.pi for n in (0, 1)]
+    Each grid point is solved in its own directory rundir_root/run_<id>,
+    such that up to nprocs solver runs with ncores MPI processes each can be
+    executed concurrently. Alternatively, the allocation ($SLURM_NTASKS
+    cores) is split into sub-groups of group_size cores, each running one
+    point at a time, and the points are streamed into the sub-groups as
+    they become free. The results are collected in grid order and
+    written to bloch.tmp and bloch_modes.dat. The output files of each point
+    (Evals, xml, tmp.out and jpg) are compressed in the background and
+    appended to a single indexed sweep archive.
+
+    The input files are rendered on a background thread up to prefetch
+    points ahead of the solver runs. The waveguide and its x-grid are built
+    only once per delta value, and the boundaries of all remaining eps
+    values of a delta are evaluated in one vectorized call.
+
+    The runtime of each point is estimated with the cost model of
+    estimate_runtime, the points are submitted longest-first and the
+    predicted makespan is printed before the solver runs are launched (also
+    in a dryrun).
 
-    kr = k0 - k1
+    The status and results of all points are checkpointed in a manifest
+    file after every point. Re-running the command skips the points which
+    are done and retries failed or interrupted ones.
+
+    In adaptive mode, the grid eps x delta is only the starting point: cells
+    where the gap |K0 - K1| or its variation indicates an exceptional point
+    are recursively subdivided (see refine_adaptively).
+
+        Parameters:
+        -----------
+            N: float
+                Number of open modes.
+            pphw: int
+                Points per half wavelength.
+            eta: float
+                Absorption strength.
+            W: float
+                Waveguide width.
+            xml: str
+                Name of the xml input file in the run directories.
+            xml_template: str
+                xml template file.
+            eps, delta: list of floats
+                Arguments of np.linspace for the eps and delta ranges.
+            dryrun: bool
+                Whether to only check the resolution of the grid.
+            neumann: int
+                Whether to use Neumann or Dirichlet boundary conditions.
+            nprocs: int
+                Number of concurrent solver runs.
+            ncores: int
+                Number of MPI processes per solver run. Defaults to an equal
+                share $SLURM_NTASKS//nprocs of the allocation on the cluster
+                and 1 otherwise.
+            group_size: int
+                If supplied, pack the solver runs into sub-groups of
+                group_size cores of the allocation (overrides nprocs and
+                ncores). The launcher can be set via $GREENS_CODE_LAUNCHER.
+            rundir_root: str
+                Directory holding the run directories.
+            keep_rundirs: bool
+                Whether to keep the run directories after each point.
+            manifest: str
+                Checkpoint file of the sweep.
+            archive: str
+                Sweep archive (*.tar) holding the output files of all points.
+            prefetch: int
+                Number of points whose input files are prepared ahead of the
+                solver runs (0: render the input files in the workers).
+            machine: str
+                Machine whose cost model is used to plan the sweep
+                (VSC2|VSC3).
+            adaptive: bool
+                Whether to refine the grid around exceptional points.
+            budget: int
+                Maximum number of solver calls in adaptive mode.
+            resolution: list of floats
+                Target resolution (eps, delta) in adaptive mode. Defaults to
+                1/8 of the grid spacing.
+            tolerance: float
+                Refine cells whose estimated minimal gap is below tolerance
+                in adaptive mode.
+    """
+
+    kr = get_kr(N, neumann)
 
     # ranges
     eps_range = np.linspace(*eps)
@@ -78,92 +580,149 @@ def raster_eps_delta(N=2.6, pphw=300, eta=0.1, W=1.0, xml="input.xml",
     print_diff_warning(r_ny_eps, "epsilon")
     print_diff_warning(r_nx_L, "length")
 
+    groups = None
+    if group_size:
+        groups = get_groups(group_size)
+        nprocs, ncores = len(groups), None
+        print "{} sub-groups of {} cores".format(len(groups), group_size)
+    else:
+        if ncores is None:
+            # share the allocation among the concurrent solver runs
+            ncores = max(get_allocation_size()//nprocs, 1)
+        if (os.environ.get('SLURM_NTASKS') and
+                nprocs*ncores > get_allocation_size()):
+            print ("WARNING: {} concurrent solver runs with {} cores each "
+                   "oversubscribe the allocation of {} cores.").format(
+                nprocs, ncores, get_allocation_size())
+        if nprocs > 1:
+            # pin the concurrent solver runs to disjoint cores
+            groups = get_groups(ncores, ntasks=nprocs*ncores)
+
+    def plan(points):
+        """Return the points ordered longest-first and print the predicted
+        makespan."""
+
+        # cores of each concurrent solver run
+        cores = group_size or ncores
+        costs = [get_point_cost(e, d, N=N, pphw=pphw, W=W, neumann=neumann,
+                                ncores=cores, machine=machine)
+                 for e, d in points]
+        points, loads, makespan = plan_points(points, costs, nworkers=nprocs)
+        if points:
+            print ("predicted makespan for {} points on {} x {} cores: {} "
+                   "(serial: {}, load balance: {:.0%})").format(
+                len(points), nprocs, cores, format_time(makespan),
+                format_time(sum(costs)), np.mean(loads)/makespan)
+        return points
+
     if dryrun:
+        plan([(e, d) for e in eps_range for d in delta_range])
         sys.exit()
 
-    def update_boundary(eps, delta):
-        L = abs(2*np.pi/(kr + delta))
+    kwargs = {'N': N,
+              'pphw': pphw,
+              'eta': eta,
+              'W': W,
+              'xml': xml,
+              'xml_template': os.path.abspath(xml_template),
+              'neumann': neumann,
+              'rundir_root': rundir_root,
+              'ncores': ncores,
+              'keep_rundirs': keep_rundirs}
 
-        # choose discretization such that r_nx < len(x_range)
-        # r_nx_L = (abs(2*np.pi/(kr + delta))*(N*pphw + 1)).astype(int)
-        r_nx_L = (L(N*pphw + 1)).astype(int)
-        x_range = np.linspace(0, L, r_nx_L)
-        if not neumann:
-            WG = Dirichlet(loop_type='Constant', N=N, L=L, W=W, eta=eta)
+    settings = dict(kwargs, eps=eps, delta=delta)
+    del settings['ncores'], settings['keep_rundirs']
+    manifest = SweepManifest(manifest, settings=settings)
+    archive = SweepArchive(archive)
+
+    def checkpoint(point, output):
+        e, d = point
+        result, files = output or (None, {})
+        for name, data in sorted(files.items()):
+            archive.add(name, data)
+        if result is None:
+            manifest.update(get_point_id(e, d), FAILED, eps=e, delta=d)
         else:
-            WG = Neumann(loop_type='Constant', N=N, L=L, W=W, eta=eta)
+            _, _, ev0_n, ev1_n, overlap_n = result
+            manifest.update(get_point_id(e, d), DONE,
+                            result=[float(x) for x in (ev0_n.real, ev0_n.imag,
+                                                       ev1_n.real, ev1_n.imag,
+                                                       overlap_n)],
+                            eps=e, delta=d)
 
-        xi_lower, xi_upper = WG.get_boundary(x=x_range, eps=eps, delta=delta)
-        print "lower.boundary.shape", xi_lower.shape
-
-        np.savetxt("lower.boundary", zip(x_range, xi_lower))
-        np.savetxt("upper.boundary", zip(x_range, xi_upper))
-
-        N_file_boundary = len(x_range)
-        replacements = {'LENGTH': str(L),
-                        'WIDTH': str(W),
-                        'MODES': str(N),
-                        'PPHW': str(pphw),
-                        'GAMMA0': str(eta),
-                        'NEUMANN': neumann,
-                        'N_FILE_BOUNDARY': str(N_file_boundary),
-                        'BOUNDARY_UPPER': 'upper.boundary',
-                        'BOUNDARY_LOWER': 'lower.boundary'}
-
-        replace_in_file(xml_template, xml, **replacements)
-
-    # parameters, eigenvalues and eigenvectors
-    # eps, delta, ev0, ev1, overlap = [ [] for n in range(5) ]
-    eps, delta, ev0, ev1, overlap = []*5
-    tmp = "bloch.tmp"
-    for e in eps_range:
-        for d in delta_range:
-            update_boundary(e, d)
-            run_code()
-            try:
-                # bloch_evals = bloch.get_eigensystem()
-                # TODO: why column 0 and not 1 to access right moving modes?
-                # bloch_evals = np.array(bloch_evals)[0, :2]
-                # if bloch.get_eigensystem is not called with modes, dx, etc.,
-                # these values are read from the xml file
-                bloch_evals, _, bloch_evecs, _ = bloch.get_eigensystem(return_eigenvectors=True,
-                                                                       neumann=neumann)
-                bloch_evals, bloch_evecs = [np.array(x)[:2] for x in (bloch_evals, bloch_evecs)]
-                bloch_evecs_overlap = (np.abs(bloch_evecs[0]-bloch_evecs[1])**2).sum()
-                print "overlap", bloch_evecs_overlap
-
-                ev0.append(bloch_evals[0])
-                ev1.append(bloch_evals[1])
-                overlap.append(bloch_evecs_overlap)
-                eps.append(e)
-                delta.append(d)
+    def solve(points):
+        """Solve all points which are not done and return the eigenvalue
+        gaps |K0 - K1| of all points."""
+
+        todo = [(e, d) for e, d in points
+                if manifest.get_status(get_point_id(e, d)) != DONE]
+        print "{} of {} points remaining".format(len(todo), len(points))
+        manifest.update([get_point_id(e, d) for e, d in todo], RUNNING)
+        # the plan only sets the submission order, the results are written
+        # to bloch.tmp in the order of points
+        grid_order = list(todo)
+        todo = planned = plan(todo)
+
+        if prefetch:
+            prepare_kwargs = dict((k, kwargs[k]) for k in (
+                'N', 'pphw', 'eta', 'W', 'xml', 'xml_template', 'neumann',
+                'rundir_root'))
+            eps_values = {}
+            for e, d in todo:
+                eps_values.setdefault(d, []).append(e)
+            todo = iter_prefetched(lambda p: prepare_point(
+                *p, eps_values=eps_values[p[1]], **prepare_kwargs),
+                                   todo, depth=max(prefetch, nprocs))
+
+        tmp = "bloch.tmp"
+        finished, nwritten = {}, 0
+        outputs = run_points(run_point, todo, nprocs=nprocs,
+                             callback=checkpoint, groups=groups,
+                             prepared=bool(prefetch), **kwargs)
+        for point, output in itertools.izip(planned, outputs):
+            finished[point] = output and output[0]
+            # write all finished points which precede the first unfinished
+            # point in grid order
+            while (nwritten < len(grid_order) and
+                   grid_order[nwritten] in finished):
+                result = finished.pop(grid_order[nwritten])
+                nwritten += 1
+                if result is None:
+                    continue
+                e, d, ev0_n, ev1_n, overlap_n = result
                 with open(tmp, "a") as f:
-                    f.write("{} {} {} {} {} {}\n".format(e, d,
-                                                         bloch_evals[0].real,
-                                                         bloch_evals[0].imag,
-                                                         bloch_evals[1].real,
-                                                         bloch_evals[1].imag))
-                    # backup output files
-                    evals_file = "evals_eps_{:.8f}_delta_{:.8f}.dat".format(e, d)
-                    archive("Evals.complex_potential.dat", evals_file)
-                    os.remove("Evecs.complex_potential.dat")
-                    os.remove("Evecs.complex_potential.abs")
-                    xml_file = "xml_eps_{:.8f}_delta_{:.8f}.dat".format(e, d)
-                    archive("input.xml", xml_file, delete=False)
-            except:
-                print "Evals, evecs or xml file not found!"
-            # tmp.out is not written if job is part of a job-array
-            tmp_file = "tmp_eps_{:.8f}_delta_{:.8f}.out".format(e, d)
-            archive("tmp.out", tmp_file)
-            # be backwards compatible in case no jpg is written
-            jpg_file = "jpg_eps_{:.8f}_delta_{:.8f}.jpg".format(e, d)
-            archive("pic.geometry.complex_potential.1.jpg", jpg_file)
-
-    eps, delta, ev0, ev1, overlap = [np.array(x) for x in (eps, delta, ev0,
-                                                           ev1, overlap)]
-    np.savetxt("bloch_modes.dat", zip(eps, delta,
-                                      ev0.real, ev0.imag,
-                                      ev1.real, ev1.imag, overlap))
+                    f.write("{} {} {} {} {} {}\n".format(
+                        e, d, ev0_n.real, ev0_n.imag, ev1_n.real,
+                        ev1_n.imag))
+
+        gaps = {}
+        for e, d in points:
+            result = manifest.get_result(get_point_id(e, d))
+            if manifest.get_status(get_point_id(e, d)) == DONE:
+                gaps[e, d] = abs(complex(*result[0:2]) - complex(*result[2:4]))
+            else:
+                gaps[e, d] = np.nan
+        return gaps
+
+    if adaptive:
+        points = refine_adaptively(solve, eps_range, delta_range,
+                                   budget=budget, resolution=resolution,
+                                   tolerance=tolerance, batchsize=nprocs)
+        points = sorted(points)
+    else:
+        points = [(e, d) for e in eps_range for d in delta_range]
+        solve(points)
+    archive.close()
+
+    # collect the results of all points (including previous runs)
+    point_ids = [get_point_id(e, d) for e, d in points]
+    bloch_modes = [[e, d] + manifest.get_result(point_id)
+                   for (e, d), point_id in zip(points, point_ids)
+                   if manifest.get_status(point_id) == DONE]
+    failed = [p for p in point_ids if manifest.get_status(p) != DONE]
+    if failed:
+        print "WARNING: {} points failed:".format(len(failed)), failed
+    np.savetxt("bloch_modes.dat", bloch_modes)
 
 if __name__ == '__main__':
     argh.dispatch_command(raster_eps_delta)
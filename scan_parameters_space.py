@@ -2,8 +2,6 @@
 
 import os
 import numpy as np
-import shutil
-import subprocess
 import sys
 
 import argh
@@ -11,24 +9,32 @@ import argh
 import bloch
 from ep.waveguide import Dirichlet
 from helper_functions import replace_in_file
+import sweep
+from sweep import (ARCHIVE, DONE, FAILED, MANIFEST, RUNNING, SweepArchive,
+                   SweepManifest, get_point_id)
 
 
 TMP = 'bloch.tmp'
 CALC_NAME = 'complex_potential'
+LOCAL_NCORES = 4
+# solver log, which holds the command line and wall time of the run for
+# calibrate_runtime
+LOG = 'tmp.out'
 
 
 def run_code():
     """Execute greens_code on the cluster or locally, dependent on the
-    environmental variable SLURM_NTASKS."""
+    environmental variable SLURM_NTASKS. The MPI launcher can be replaced
+    via $GREENS_CODE_LAUNCHER (see sweep.get_solver_command). The solver
+    output is written to tmp.out."""
     if os.environ.get('SLURM_NTASKS'):
         print "running code on cluster..."
         print "$SLURM_NTASKS", os.environ.get('SLURM_NTASKS')
-        cmd = ("time mpirun -np {SLURM_NTASKS} "
-               "solve_xml_mumps_dev").format(**os.environ)
+        ncores = int(os.environ['SLURM_NTASKS'])
     else:
         print "running code locally..."
-        cmd = "mpirun -np 4 solve_xml_mumps_dev"
-    subprocess.call(cmd.split())
+        ncores = LOCAL_NCORES
+    sweep.run_code(ncores=ncores, logfile=LOG)
 
 
 def print_diff_warning(array, name):
@@ -42,23 +48,21 @@ def print_diff_warning(array, name):
         """.format(np.diff(array), name)
 
 
-def archive(infile, outfile, delete=True):
-    """Copy infile to outfile, compress the destination file and remove the
-    source."""
-    try:
-        shutil.copy(infile, outfile)
-        subprocess.call(['gzip', outfile])
-        if delete:
-            os.remove(infile)
-    except Exception as ex:
-        print "WARNING: could not archive {}: {}".format(infile, ex)
-
-
 @argh.arg("--eps", type=float, nargs="+")
 @argh.arg("--delta", type=float, nargs="+")
 def raster_eps_delta(N=2.6, pphw=300, eta=0.1, W=1.0, xml="input.xml",
                      xml_template="input.xml_template", eps=[0.01, 0.1, 30],
-                     delta=[0.3, 0.7, 50], dryrun=False):
+                     delta=[0.3, 0.7, 50], dryrun=False, manifest=MANIFEST,
+                     archive=ARCHIVE):
+    """Calculate the Bloch modes on the grid eps x delta.
+
+    The Evals and xml files of each point are compressed in the background
+    and appended to a single indexed sweep archive.
+
+    The status and results of all points are checkpointed in the manifest
+    file after every point. Re-running the command skips the points which
+    are done and retries failed or interrupted ones.
+    """
 
     # k_x for modes 0 and 1
     k0, k1 = [np.sqrt(N**2 - n**2)*np.pi for n in (1, 2)]
@@ -112,47 +116,67 @@ def raster_eps_delta(N=2.6, pphw=300, eta=0.1, W=1.0, xml="input.xml",
 
         replace_in_file(xml_template, xml, **replacements)
 
-    # parameters, eigenvalues and eigenvectors
-    eps, delta, ev0, ev1 = [[] for n in range(4)]
-    for e in eps_range:
-        for d in delta_range:
-            update_boundary(e, d)
-            run_code()
-            try:
-                # bloch_evals = bloch.get_eigensystem()
-                # TODO: why column 0 and not 1 to access right moving modes?
-                # bloch_evals = np.array(bloch_evals)[0, :2]
-                # if bloch.get_eigensystem is not called with modes, dx, etc.,
-                # these values are read from the xml file
-                evalsfile = 'Evals.' + CALC_NAME + '.dat'
-                bloch_evals, _ = bloch.get_eigensystem(evalsfile=evalsfile)
-                bloch_evals = np.array(bloch_evals)[:2]
-
-                ev0.append(bloch_evals[0])
-                ev1.append(bloch_evals[1])
-                eps.append(e)
-                delta.append(d)
-                with open(TMP, "a") as f:
-                    f.write("{} {} {} {} {} {}\n".format(e, d,
-                                                         bloch_evals[0].real,
-                                                         bloch_evals[0].imag,
-                                                         bloch_evals[1].real,
-                                                         bloch_evals[1].imag))
-                    # backup output files
-                    eps_delta_id = "eps_{:.6f}_delta_{:.6f}".format(e, d)
-                    evals_file = "evals_" + eps_delta_id + ".dat"
-                    archive("Evals." + CALC_NAME + ".dat", evals_file)
-                    xml_file = "xml_" + eps_delta_id + ".dat"
-                    archive("input.xml", xml_file, delete=False)
-                    os.remove("Evecs." + CALC_NAME + ".dat")
-                    os.remove("Evecs." + CALC_NAME + ".abs")
-            except Exception as ex:
-                print "Evals, evecs or xml file not found: {}".format(ex)
-
-    eps, delta, ev0, ev1 = [np.array(x) for x in (eps, delta, ev0, ev1)]
-    np.savetxt("bloch_modes.dat", zip(eps, delta,
-                                      ev0.real, ev0.imag,
-                                      ev1.real, ev1.imag))
+    points = [(e, d) for e in eps_range for d in delta_range]
+    point_ids = [get_point_id(e, d, digits=6) for e, d in points]
+
+    settings = {'N': N,
+                'pphw': pphw,
+                'eta': eta,
+                'W': W,
+                'xml_template': os.path.abspath(xml_template),
+                'eps': eps,
+                'delta': delta}
+    manifest = SweepManifest(manifest, settings=settings)
+    archive = SweepArchive(archive)
+
+    for (e, d), eps_delta_id in zip(points, point_ids):
+        if manifest.get_status(eps_delta_id) == DONE:
+            continue
+        manifest.update(eps_delta_id, RUNNING, eps=e, delta=d)
+
+        update_boundary(e, d)
+        run_code()
+        try:
+            # bloch_evals = bloch.get_eigensystem()
+            # TODO: why column 0 and not 1 to access right moving modes?
+            # bloch_evals = np.array(bloch_evals)[0, :2]
+            # if bloch.get_eigensystem is not called with modes, dx, etc.,
+            # these values are read from the xml file
+            evalsfile = 'Evals.' + CALC_NAME + '.dat'
+            bloch_evals, _ = bloch.get_eigensystem(evalsfile=evalsfile)
+            bloch_evals = np.array(bloch_evals)[:2]
+
+            with open(TMP, "a") as f:
+                f.write("{} {} {} {} {} {}\n".format(e, d,
+                                                     bloch_evals[0].real,
+                                                     bloch_evals[0].imag,
+                                                     bloch_evals[1].real,
+                                                     bloch_evals[1].imag))
+            # backup output files
+            evals_file = "evals_" + eps_delta_id + ".dat"
+            archive.add_file("Evals." + CALC_NAME + ".dat", evals_file)
+            xml_file = "xml_" + eps_delta_id + ".dat"
+            archive.add_file("input.xml", xml_file, delete=False)
+            archive.add_file(LOG, "tmp_" + eps_delta_id + ".out")
+            os.remove("Evecs." + CALC_NAME + ".dat")
+            os.remove("Evecs." + CALC_NAME + ".abs")
+
+            result = [float(x) for x in (bloch_evals[0].real,
+                                         bloch_evals[0].imag,
+                                         bloch_evals[1].real,
+                                         bloch_evals[1].imag)]
+            manifest.update(eps_delta_id, DONE, result=result)
+        except Exception as ex:
+            print "Evals, evecs or xml file not found: {}".format(ex)
+            manifest.update(eps_delta_id, FAILED)
+
+    archive.close()
+
+    # collect the results of all points (including previous runs)
+    bloch_modes = [[e, d] + manifest.get_result(point_id)
+                   for (e, d), point_id in zip(points, point_ids)
+                   if manifest.get_status(point_id) == DONE]
+    np.savetxt("bloch_modes.dat", bloch_modes)
 
 if __name__ == '__main__':
     argh.dispatch_command(raster_eps_delta)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python2.7
+"""Stand-in for mpirun/srun which allows to test the packing of solver runs
+into sub-groups of an allocation (see sweep.get_groups) on a local machine.
+
+The command is run as a single process in place of ncores MPI ranks. If a
+log file is supplied (or $STUB_LAUNCHER_LOG is set), the start and end of
+each launch are appended as lines 'start|end <time> <cores> <pid>', which
+can be checked for cores used by more than one run at a time:
+
+    export GREENS_CODE_SOLVER="python /path/to/fake_solver.py --delay 1"
+    export GREENS_CODE_LAUNCHER="python /path/to/stub_launcher.py launch \\
+        -n {ncores} --cores {cores} -- {solver}"
+    export STUB_LAUNCHER_LOG=$PWD/launcher.log
+    SLURM_NTASKS=8 raster_eps_delta.py --group-size 2 ...
+    stub_launcher.py check launcher.log --ntasks 8
+"""
+import fcntl
+import os
+import subprocess
+import sys
+import time
+
+import argh
+
+
+# environment variable to set the default log file
+LOG_ENV = "STUB_LAUNCHER_LOG"
+
+
+def write_log(logfile, event, cores):
+    """Append an event line to the log file."""
+
+    with open(logfile, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write("{} {:.6f} {} {}\n".format(event, time.time(), cores,
+                                           os.getpid()))
+
+
+@argh.arg("-n", "--ncores", type=int)
+@argh.arg("-c", "--cores", type=str)
+@argh.arg("-l", "--logfile", type=str)
+@argh.arg("command", nargs="+")
+def launch(command, ncores=1, cores=None, logfile=None):
+    """Run command in place of ncores MPI ranks on the given cores and exit
+    with its return code.
+
+        Parameters:
+        -----------
+            command: list of str
+                Solver command line (after '--').
+            ncores: int
+                Number of MPI ranks.
+            cores: str
+                Comma-separated core ids of the sub-group.
+            logfile: str
+                Log file. Defaults to $STUB_LAUNCHER_LOG.
+    """
+
+    cores = cores or ",".join(str(c) for c in range(ncores))
+    if len(cores.split(",")) != ncores:
+        raise Exception("Error: {} ranks requested on cores {}.".format(ncores,
+                                                                        cores))
+    logfile = logfile or os.environ.get(LOG_ENV)
+
+    print "stub launcher: np={} cores={}: {}".format(ncores, cores,
+                                                     " ".join(command))
+    sys.stdout.flush()
+    if logfile:
+        write_log(logfile, "start", cores)
+    exit_code = subprocess.call(command)
+    if logfile:
+        write_log(logfile, "end", cores)
+
+    sys.exit(exit_code)
+
+
+@argh.arg("logfile", type=str)
+@argh.arg("--ntasks", type=int)
+def check(logfile, ntasks=None):
+    """Check a launcher log for cores which were used by more than one run
+    at a time (and cores outside of an allocation of ntasks cores) and print
+    the number of runs and the maximal number of concurrent runs."""
+
+    events = []
+    with open(logfile) as f:
+        for line in f:
+            event, t, cores, pid = line.split()
+            events.append((float(t), event == "start", cores, pid))
+
+    busy = {}
+    nruns, concurrent, max_concurrent, errors = 0, 0, 0, 0
+    for t, start, cores, pid in sorted(events):
+        cores = [int(c) for c in cores.split(",")]
+        if start:
+            nruns += 1
+            concurrent += 1
+            max_concurrent = max(max_concurrent, concurrent)
+            for c in cores:
+                if c in busy:
+                    print "ERROR: core {} used by {} and {}".format(c,
+                                                                    busy[c],
+                                                                    pid)
+                    errors += 1
+                if ntasks is not None and c >= ntasks:
+                    print "ERROR: core {} outside of allocation".format(c)
+                    errors += 1
+                busy[c] = pid
+        else:
+            concurrent -= 1
+            for c in cores:
+                busy.pop(c, None)
+
+    print "{} runs, at most {} concurrent, {} errors".format(nruns,
+                                                            max_concurrent,
+                                                            errors)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    argh.dispatch_commands([launch, check])
@@ -0,0 +1,548 @@
+#!/usr/bin/env python2.7
+"""Helper functions to run greens_code parameter sweeps.
+
+    get_solver_command(ncores=None, cores=None):
+        Return the command line of the solver.
+
+    get_groups(group_size, ntasks=None):
+        Split the allocation into sub-groups of group_size cores.
+
+    run_code(cwd=None, ncores=None, logfile=None):
+        Execute greens_code in a given directory.
+
+    get_point_id(eps, delta, digits=8):
+        Return the identifier eps_<eps>_delta_<delta> of a sweep point.
+
+    make_run_directory(root, point_id):
+        Create an empty run directory for a sweep point.
+
+    run_points(function, points, nprocs=1, callback=None, groups=None,
+               **kwargs):
+        Evaluate a function for all sweep points on a pool of processes (one
+        per sub-group of the allocation) and yield the results in the order
+        of the points.
+
+    plan_points(points, costs, nworkers=1):
+        Order the points longest-first and predict the makespan of a sweep.
+
+    iter_prefetched(function, items, depth=1):
+        Yield function(item) for all items, evaluated ahead on a background
+        thread.
+
+    SweepManifest(path=MANIFEST, settings=None):
+        Checkpoint file holding the status and results of all sweep points.
+
+    SweepArchive(path=ARCHIVE, nthreads=ARCHIVE_THREADS):
+        Single indexed archive of the compressed output files of a sweep.
+"""
+from collections import deque
+import gzip
+import heapq
+import io
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import subprocess
+import tarfile
+import threading
+import time
+
+from helper_functions import (ARCHIVE_EXTENSION, ARCHIVE_INDEX_EXTENSION,
+                              open_archived_file, read_archive_index)
+
+
+SOLVER = "solve_xml_mumps_dev"
+# environment variable to override the solver executable
+SOLVER_ENV = "GREENS_CODE_SOLVER"
+# command line template of the MPI launcher, which is formatted with the
+# number of cores {ncores}, the comma-separated core ids {cores} of the
+# sub-group and the solver command {solver}, e.g.,
+#   "python /path/to/stub_launcher.py -n {ncores} --cores {cores} -- {solver}"
+LAUNCHER = "time mpirun -np {ncores} {solver}"
+# launchers of concurrent runs in sub-groups (see run_points), which pin each
+# run to the cores of its sub-group (OpenMPI), or leave the placement to
+# srun --exclusive on the cluster, which puts concurrent job steps on disjoint
+# cores
+LAUNCHER_PINNED = ("time mpirun -np {ncores} --cpu-set {cores} --bind-to core "
+                   "{solver}")
+LAUNCHER_SLURM_PINNED = "time srun --exclusive -n {ncores} {solver}"
+# environment variable to override the launcher template
+LAUNCHER_ENV = "GREENS_CODE_LAUNCHER"
+# header and footer lines of the solver log files, see run_code
+LOG_COMMAND = "# command: "
+LOG_WALL_TIME = "# wall time [s]: "
+RUN_DIRECTORY = "runs"
+MANIFEST = "sweep_manifest.json"
+ARCHIVE = "sweep_archive" + ARCHIVE_EXTENSION
+ARCHIVE_THREADS = 2
+# file types which are not compressed further
+COMPRESSED_EXTENSIONS = ('.gz', '.jpg', '.png')
+
+# status of a sweep point in the manifest
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# core ids of the sub-group used by the current task of a worker process,
+# the queue of free sub-groups and whether the sub-groups run concurrently,
+# see run_points
+_GROUP = None
+_FREE_GROUPS = None
+_PIN_GROUPS = False
+
+
+def get_solver_command(ncores=None, cores=None, solver=None):
+    """Return the solver command line.
+
+    The solver executable (defaults to SOLVER) can be overridden with the
+    environment variable GREENS_CODE_SOLVER and the launcher template with
+    GREENS_CODE_LAUNCHER. If the core ids cores are not supplied, the
+    sub-group of the current task of a worker process is used (see
+    run_points). Without sub-group, ncores defaults to the whole allocation
+    ($SLURM_NTASKS) on the cluster and a single process otherwise. The
+    launcher is used for more than one core, or always if
+    GREENS_CODE_LAUNCHER is set. Only runs on explicitly given cores or in
+    concurrent sub-groups are pinned to their cores (LAUNCHER_PINNED, or
+    LAUNCHER_SLURM_PINNED on the cluster); all other runs use the plain
+    LAUNCHER.
+    """
+
+    solver = os.environ.get(SOLVER_ENV, solver or SOLVER)
+
+    pinned = cores is not None
+    if cores is None and _GROUP is not None and ncores in (None, len(_GROUP)):
+        cores = _GROUP
+        pinned = _PIN_GROUPS
+
+    launcher = os.environ.get(LAUNCHER_ENV)
+    if launcher:
+        template = launcher
+    elif not pinned:
+        template = LAUNCHER
+    elif os.environ.get('SLURM_NTASKS'):
+        template = LAUNCHER_SLURM_PINNED
+    else:
+        template = LAUNCHER_PINNED
+
+    if ncores is None:
+        if cores is not None:
+            ncores = len(cores)
+        else:
+            ncores = get_allocation_size()
+    if cores is None:
+        cores = range(ncores)
+
+    if ncores > 1 or launcher:
+        return template.format(
+            ncores=ncores, cores=",".join(str(c) for c in cores),
+            solver=solver)
+    else:
+        return solver
+
+
+def get_allocation_size():
+    """Return the number of cores of the allocation ($SLURM_NTASKS, or 1 if
+    not run on the cluster)."""
+    return int(os.environ.get('SLURM_NTASKS', 1))
+
+
+def get_groups(group_size, ntasks=None):
+    """Split the allocation of ntasks cores (defaults to $SLURM_NTASKS) into
+    sub-groups of group_size cores and return the list of core ids of each
+    sub-group.
+
+    Each sub-group runs one solver instance at a time, such that many small
+    problems share a single allocation instead of paying the MPI start-up on
+    all cores for every point.
+    """
+
+    if ntasks is None:
+        ntasks = get_allocation_size()
+    if group_size < 1 or group_size > ntasks:
+        raise Exception("Error: group size {} does not fit into an allocation "
+                        "of {} cores.".format(group_size, ntasks))
+
+    ngroups, unused = divmod(ntasks, group_size)
+    if unused:
+        print "WARNING: {} of {} cores are not used.".format(unused, ntasks)
+
+    return [range(n*group_size, (n + 1)*group_size) for n in range(ngroups)]
+
+
+def run_code(cwd=None, ncores=None, logfile=None, solver=None):
+    """Execute greens_code in the directory cwd (defaults to the working
+    directory) and return the exit code. If logfile is given, the solver
+    output is written to cwd/logfile, enclosed by the command line and the
+    wall time of the run (used by calibrate_runtime)."""
+
+    cmd = get_solver_command(ncores, solver=solver)
+    print "running '{}' in {}...".format(cmd, cwd or os.getcwd())
+
+    if logfile:
+        with open(os.path.join(cwd or ".", logfile), "w") as f:
+            f.write(LOG_COMMAND + cmd + "\n")
+            f.flush()
+            t0 = time.time()
+            exit_code = subprocess.call(cmd.split(), cwd=cwd, stdout=f,
+                                        stderr=subprocess.STDOUT)
+            f.write("{}{:.3f}\n".format(LOG_WALL_TIME, time.time() - t0))
+            return exit_code
+    else:
+        return subprocess.call(cmd.split(), cwd=cwd)
+
+
+def get_point_id(eps, delta, digits=8):
+    """Return the identifier eps_<eps>_delta_<delta> used to name the files
+    of a sweep point."""
+
+    return "eps_{0:.{2}f}_delta_{1:.{2}f}".format(eps, delta, digits)
+
+
+def make_run_directory(root, point_id):
+    """Create an empty directory root/run_<point_id> and return its path.
+    Leftovers of a previous run are removed."""
+
+    rundir = os.path.join(root, "run_" + point_id)
+    if os.path.exists(rundir):
+        shutil.rmtree(rundir)
+    os.makedirs(rundir)
+
+    return rundir
+
+
+def _call(function, point, kwargs):
+    """Return function(*point, **kwargs), or None if an exception is
+    raised."""
+
+    try:
+        return function(*point, **kwargs)
+    except Exception as ex:
+        print "WARNING: point {} failed: {}".format(point, ex)
+
+
+def _init_worker(free_groups, pin_groups):
+    """Store the queue of free sub-groups and whether the runs are pinned to
+    them in a new worker process."""
+    global _FREE_GROUPS, _PIN_GROUPS
+    _FREE_GROUPS, _PIN_GROUPS = free_groups, pin_groups
+
+
+def _call_in_group(function, point, kwargs):
+    """Call _call on a free sub-group, which is returned to the queue
+    afterwards."""
+
+    global _GROUP
+    _GROUP = _FREE_GROUPS.get()
+    try:
+        return _call(function, point, kwargs)
+    finally:
+        _FREE_GROUPS.put(_GROUP)
+        _GROUP = None
+
+
+def run_points(function, points, nprocs=1, callback=None, groups=None,
+               **kwargs):
+    """Evaluate function(*point, **kwargs) for all points and yield the
+    results in the order of points.
+
+    If nprocs > 1, up to nprocs points are evaluated concurrently on a pool
+    of processes; the results are still yielded in order, as soon as all
+    preceding points are finished. Points raising an exception yield None.
+    If supplied, callback(point, result) is called in the main process as
+    soon as each point is finished, i.e., not necessarily in order.
+
+    If the sub-groups groups of the allocation are supplied (see
+    get_groups), nprocs is set to the number of sub-groups and each point
+    takes a free sub-group for the time it is evaluated, i.e., the points
+    are streamed into the sub-groups as soon as they become free and the
+    solver runs (run_code) are launched on the cores of the sub-group. If
+    there is more than one sub-group, the runs are pinned to their cores
+    (see get_solver_command).
+    """
+
+    call, initializer, initargs = _call, None, ()
+    if groups is not None:
+        nprocs = len(groups)
+        free_groups = multiprocessing.Queue()
+        for group in groups:
+            free_groups.put(group)
+        call, initializer, initargs = (_call_in_group, _init_worker,
+                                       (free_groups, nprocs > 1))
+    elif nprocs == 1:
+        for point in points:
+            result = _call(function, point, kwargs)
+            if callback:
+                callback(point, result)
+            yield result
+        return
+
+    pool = multiprocessing.Pool(processes=nprocs, initializer=initializer,
+                                initargs=initargs)
+    try:
+        results = []
+        for point in points:
+            point = tuple(point)
+            if callback:
+                on_finish = lambda r, point=point: callback(point, r)
+            else:
+                on_finish = None
+            results.append(pool.apply_async(call,
+                                            args=(function, point, kwargs),
+                                            callback=on_finish))
+        for r in results:
+            yield r.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def plan_points(points, costs, nworkers=1):
+    """Order the points by decreasing cost and bin-pack them onto nworkers
+    workers (longest processing time first).
+
+    Each point is assigned to the worker with the smallest load, which is
+    what run_points does when the points are submitted in this order, i.e.,
+    the largest load (makespan) predicts the wall time of the sweep.
+
+        Parameters:
+        -----------
+            points: list
+                Sweep points.
+            costs: list of floats
+                Estimated runtimes of the points.
+            nworkers: int
+                Number of concurrent solver runs.
+
+        Returns:
+        --------
+            points: list
+                Points ordered by decreasing cost.
+            loads: list of floats
+                Predicted total runtime of each worker.
+            makespan: float
+                Predicted wall time of the sweep.
+    """
+
+    order = sorted(range(len(points)), key=lambda n: -costs[n])
+
+    workers = [(0., n) for n in range(nworkers)]
+    loads = [0.]*nworkers
+    for n in order:
+        load, worker = heapq.heappop(workers)
+        loads[worker] = load + costs[n]
+        heapq.heappush(workers, (loads[worker], worker))
+
+    return [points[n] for n in order], loads, max(loads)
+
+
+def iter_prefetched(function, items, depth=1):
+    """Yield function(item) for all items in order.
+
+    The values are computed on a background thread up to depth items ahead
+    of the consumer, e.g., to prepare the input files of the next points
+    while the solver is still running.
+    """
+
+    pool = ThreadPool(processes=1)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(function, args=(item,)))
+            if len(pending) > depth:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+class SweepManifest(object):
+    """Checkpoint file of a parameter sweep.
+
+    The manifest records the status (pending|running|done|failed) and the
+    results of each sweep point, keyed by its point id, in a JSON file. The
+    file is rewritten atomically (write to a temporary file and rename)
+    after every update, such that an interrupted sweep can be resumed by
+    skipping the points which are done.
+
+        Parameters:
+        -----------
+            path: str
+                Manifest file. An existing file is loaded.
+            settings: dict
+                Sweep settings stored with the manifest. A warning is printed
+                if they differ from the settings of an existing file.
+    """
+
+    def __init__(self, path=MANIFEST, settings=None):
+        self.path = path
+        self.settings = settings or {}
+        self.points = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.points = data.get('points', {})
+            if settings is not None and data.get('settings') != settings:
+                print "WARNING: settings differ from manifest " + path
+            print "Resuming sweep from {}: {} of {} points done.".format(
+                path, len(self.get_points(DONE)), len(self.points))
+
+    def get_status(self, point_id):
+        """Return the status of a point."""
+        return self.points.get(point_id, {}).get('status', PENDING)
+
+    def get_result(self, point_id):
+        """Return the stored result of a point (None if not available)."""
+        return self.points.get(point_id, {}).get('result')
+
+    def get_points(self, status):
+        """Return the ids of all points with the given status."""
+        return sorted(p for p in self.points if self.get_status(p) == status)
+
+    def update(self, point_ids, status, result=None, **info):
+        """Set the status of one or more points, optionally together with
+        the result and additional (JSON serializable) information, and
+        write the manifest."""
+
+        if isinstance(point_ids, basestring):
+            point_ids = [point_ids]
+
+        with self._lock:
+            for point_id in point_ids:
+                entry = self.points.setdefault(point_id, {})
+                entry.update(info)
+                entry['status'] = status
+                if result is not None:
+                    entry['result'] = result
+            self.save()
+
+    def save(self):
+        """Write the manifest atomically."""
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({'settings': self.settings, 'points': self.points}, f,
+                      indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+
+class SweepArchive(object):
+    """Single archive holding the output files of all points of a sweep.
+
+    Files are compressed in-process with gzip on a pool of background
+    threads and appended as <name>.gz members to an uncompressed tar file.
+    For each member, a line 'name offset size' is appended to the table of
+    contents <path>.index, which allows random access to any member without
+    scanning the archive (see helper_functions.open_archived_file). Both
+    files are append-only, i.e., an interrupted sweep leaves a readable
+    archive and a resumed sweep continues appending to it.
+
+        Parameters:
+        -----------
+            path: str
+                Archive file (*.tar).
+            nthreads: int
+                Number of compression threads.
+    """
+
+    def __init__(self, path=ARCHIVE, nthreads=ARCHIVE_THREADS):
+        self.path = path
+        self.index_file = path + ARCHIVE_INDEX_EXTENSION
+        self._lock = threading.Lock()
+        self._pending = []
+
+        self._truncate()
+        self._tar = tarfile.open(path, "a")
+        self._index = open(self.index_file, "a")
+        self._pool = ThreadPool(processes=nthreads)
+
+    def _truncate(self):
+        """Discard incomplete data after the last indexed member (e.g., of
+        an interrupted sweep) and restore the end-of-archive marker before
+        appending."""
+
+        if not (os.path.exists(self.path) and
+                os.path.exists(self.index_file)):
+            return
+
+        index = read_archive_index(self.path)
+        end = max([offset + size for offset, size in index.values()] + [0])
+        blocks, remainder = divmod(end, tarfile.BLOCKSIZE)
+        end = (blocks + (remainder > 0))*tarfile.BLOCKSIZE
+        with open(self.path, "r+b") as f:
+            f.truncate(end)
+            f.seek(end)
+            f.write(tarfile.NUL*2*tarfile.BLOCKSIZE)
+
+    def add(self, name, data):
+        """Schedule the string data to be compressed and appended as member
+        name (with suffix .gz unless it is already compressed)."""
+
+        self._pending.append(self._pool.apply_async(self._write,
+                                                    args=(name, data)))
+
+    def add_file(self, infile, name=None, delete=True):
+        """Read infile, schedule it to be appended as member name (defaults
+        to the basename of infile) and remove the source."""
+
+        try:
+            with open(infile, "rb") as f:
+                data = f.read()
+            self.add(name or os.path.basename(infile), data)
+            if delete:
+                os.remove(infile)
+        except Exception as ex:
+            print "WARNING: could not archive {}: {}".format(infile, ex)
+
+    def _write(self, name, data):
+        if not name.endswith(COMPRESSED_EXTENSIONS):
+            buf = io.BytesIO()
+            with gzip.GzipFile(filename=name, mode="wb", fileobj=buf) as f:
+                f.write(data)
+            data = buf.getvalue()
+            name += ".gz"
+
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+
+        with self._lock:
+            self._tar.addfile(info, io.BytesIO(data))
+            self._tar.fileobj.flush()
+            # the member data is padded to a multiple of BLOCKSIZE
+            blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+            padded_size = (blocks + (remainder > 0))*tarfile.BLOCKSIZE
+            offset = self._tar.offset - padded_size
+            self._index.write("{} {} {}\n".format(name, offset, info.size))
+            self._index.flush()
+
+    def wait(self):
+        """Wait until all scheduled files are written."""
+
+        pending, self._pending = self._pending, []
+        for r in pending:
+            r.get()
+
+    def read(self, name):
+        """Return the (decompressed) content of member name."""
+
+        self.wait()
+        with open_archived_file(os.path.join(self.path, name)) as f:
+            return f.read()
+
+    def close(self):
+        """Write all scheduled files and close the archive."""
+
+        self.wait()
+        self._pool.close()
+        self._pool.join()
+        self._tar.close()
+        self._index.close()
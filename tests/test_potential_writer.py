@@ -0,0 +1,40 @@
+import numpy as np
+
+from potential_writer import write_columns, write_potential_file
+
+
+def read(path):
+    with open(str(path), "rb") as f:
+        return f.read()
+
+
+def test_write_potential_file_matches_savetxt(tmpdir):
+    values = np.random.RandomState(0).randn(1000)
+    values[:3] = (0., -1e-300, 1e300)
+    reference = tmpdir.join("savetxt.dat")
+    np.savetxt(str(reference), list(enumerate(values)), fmt='%.18e %.18e')
+
+    # chunks of different size, including a partial last chunk
+    for chunksize in (1, 7, 1000, 4096):
+        outfile = tmpdir.join("potential_{}.dat".format(chunksize))
+        write_potential_file(str(outfile), values, chunksize=chunksize)
+        assert read(outfile) == read(reference)
+
+
+def test_write_potential_file_binary(tmpdir):
+    values = np.random.RandomState(1).rand(5, 7)
+    outfile = tmpdir.join("potential.bin")
+    write_potential_file(str(outfile), values, binary=True)
+    assert np.array_equal(np.fromfile(str(outfile), dtype='<f8'),
+                          values.ravel())
+
+
+def test_write_columns_matches_savetxt(tmpdir):
+    x = np.linspace(0., 1., 101)
+    y = np.sin(x)
+    reference = tmpdir.join("savetxt.dat")
+    np.savetxt(str(reference), zip(x, y))
+
+    outfile = tmpdir.join("columns.dat")
+    write_columns(str(outfile), (x, y), chunksize=10)
+    assert read(outfile) == read(reference)
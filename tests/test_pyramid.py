@@ -0,0 +1,57 @@
+import numpy as np
+
+from pyramid import MAX_PIXELS, build_pyramid, downsample, select_level
+from wavefunction_peaks import PLOT_FIGSIZE, PLOT_FIGSIZE_SCALING
+
+
+def get_grid(ny=300, nx=20000, L=100., W=1.):
+    x = np.linspace(0., L, nx)
+    y = np.linspace(0., W, ny)
+    X, Y = np.meshgrid(x, y)
+    Z = np.random.RandomState(0).rand(ny, nx)
+    return X, Y, Z
+
+
+def test_downsample_per_axis():
+    X, Y, Z = get_grid(ny=4, nx=10)
+    Xd, Yd, Zd = downsample(X, Y, Z, factor=(1, 2))
+
+    assert Zd.shape == (4, 5)
+    assert np.allclose(Zd, np.maximum(Z[:, ::2], Z[:, 1::2]))
+    assert np.allclose(Xd, 0.5*(X[:, ::2] + X[:, 1::2]))
+    assert np.allclose(Yd, Y[:, ::2])
+
+
+def test_build_pyramid_pools_long_axis():
+    X, Y, Z = get_grid()
+    levels = build_pyramid(X, Y, Z)
+
+    shapes = [level[2].shape for level in levels]
+    assert shapes[0] == (300, 20000)
+    assert len(levels) > 1
+    assert all(ny == 300 for ny, _ in shapes)
+    assert shapes[-1][1] >= 256 > shapes[-1][1]//2
+
+
+def test_select_level_at_repo_figsizes():
+    L, W = 100., 1.
+    X, Y, Z = get_grid(L=L, W=W)
+    levels = build_pyramid(X, Y, Z)
+
+    # figure sizes of ascii_to_numpy.main and wavefunction_peaks.main
+    for figsize in ((2*L, L/2), PLOT_FIGSIZE,
+                    (PLOT_FIGSIZE_SCALING*L, PLOT_FIGSIZE_SCALING*W)):
+        _, _, Z_level = select_level(levels, figsize, dpi=100)
+        assert Z_level.shape[1] < Z.shape[1]
+        assert Z_level.shape[1] >= min(figsize[0]*100, MAX_PIXELS)
+        assert Z_level.shape[0] == Z.shape[0]
+
+
+def test_select_level_resolves_image():
+    X, Y, Z = get_grid(ny=2048, nx=4096)
+    levels = build_pyramid(X, Y, Z)
+
+    _, _, Z_level = select_level(levels, (10, 5), dpi=100)
+    assert Z_level.shape == (512, 1024)
+    _, _, Z_level = select_level(levels, (100, 50), dpi=100)
+    assert Z_level.shape == Z.shape
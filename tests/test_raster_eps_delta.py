@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("ep.waveguide")
+from raster_eps_delta import refine_adaptively
+
+
+EP = (0.0412, 0.5377)
+
+
+def solve_cone(points):
+    """Gap of a synthetic exceptional point: |K0 - K1| = |(eps, delta) - EP|."""
+    return dict((p, np.hypot(p[0] - EP[0], p[1] - EP[1])) for p in points)
+
+
+def test_refine_adaptively_converges_to_ep():
+    eps_range = np.linspace(0., 0.1, 6)
+    delta_range = np.linspace(0.4, 0.6, 6)
+    resolution = (1e-3, 2e-3)
+    points = refine_adaptively(solve_cone, eps_range, delta_range,
+                               resolution=resolution)
+
+    assert len(points) == len(set(points))
+    assert len(points) < 36*8
+    distance = min(np.hypot(e - EP[0], d - EP[1]) for e, d in points)
+    assert distance < np.hypot(*resolution)
+
+
+def test_refine_adaptively_respects_budget():
+    eps_range = np.linspace(0., 0.1, 6)
+    delta_range = np.linspace(0.4, 0.6, 6)
+    for budget in (36, 50, 100):
+        points = refine_adaptively(solve_cone, eps_range, delta_range,
+                                   budget=budget)
+        assert 36 <= len(points) <= budget
+
+    # the coarse grid is thinned if it exceeds the budget
+    points = refine_adaptively(solve_cone, eps_range, delta_range, budget=20)
+    assert len(points) <= 20
+    coarse = set((e, d) for e in eps_range[[0, 2, 4, 5]]
+                 for d in delta_range[[0, 2, 4, 5]])
+    assert coarse <= set(points)
+
+
+def test_refine_adaptively_budget_minimum():
+    with pytest.raises(Exception):
+        refine_adaptively(solve_cone, np.arange(3.), np.arange(3.), budget=3)
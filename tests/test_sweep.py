@@ -0,0 +1,90 @@
+import os
+import tarfile
+
+from helper_functions import read_archive_index
+from sweep import (DONE, FAILED, PENDING, RUNNING, SweepArchive,
+                   SweepManifest, get_point_id)
+
+
+def test_manifest_resume(tmpdir):
+    path = str(tmpdir.join("manifest.json"))
+    settings = {'N': 2.6, 'pphw': 300}
+    points = [get_point_id(e, 0.5) for e in (0.01, 0.02, 0.03)]
+
+    manifest = SweepManifest(path, settings=settings)
+    manifest.update(points, RUNNING)
+    manifest.update(points[0], DONE, result=[1., 2.], eps=0.01)
+    manifest.update(points[1], FAILED)
+    assert not os.path.exists(path + ".tmp")
+
+    # an interrupted sweep leaves points[2] running
+    resumed = SweepManifest(path, settings=settings)
+    assert resumed.get_points(DONE) == [points[0]]
+    assert resumed.get_points(FAILED) == [points[1]]
+    assert resumed.get_points(RUNNING) == [points[2]]
+    assert resumed.get_result(points[0]) == [1., 2.]
+    assert resumed.get_result(points[1]) is None
+    assert resumed.points[points[0]]['eps'] == 0.01
+    assert resumed.get_status(get_point_id(0.04, 0.5)) == PENDING
+
+
+def test_manifest_settings_mismatch(tmpdir, capsys):
+    path = str(tmpdir.join("manifest.json"))
+    SweepManifest(path, settings={'N': 2.6}).save()
+    capsys.readouterr()
+
+    SweepManifest(path, settings={'N': 3.1})
+    assert "WARNING: settings differ" in capsys.readouterr()[0]
+
+
+def test_archive_roundtrip(tmpdir):
+    path = str(tmpdir.join("sweep_archive.tar"))
+    archive = SweepArchive(path)
+    archive.add("evals_a.dat", "1 2 3\n")
+    archive.add("pic_a.jpg", "\xff\xd8 jpg data")
+    infile = tmpdir.join("tmp.out")
+    infile.write("log")
+    archive.add_file(str(infile), "tmp_a.out")
+    archive.close()
+
+    assert not infile.exists()
+    assert sorted(read_archive_index(path)) == ["evals_a.dat.gz", "pic_a.jpg",
+                                                "tmp_a.out.gz"]
+    # the archive is a valid tar file
+    with tarfile.open(path) as tar:
+        assert sorted(tar.getnames()) == sorted(read_archive_index(path))
+
+    archive = SweepArchive(path)
+    assert archive.read("evals_a.dat.gz") == "1 2 3\n"
+    assert archive.read("pic_a.jpg") == "\xff\xd8 jpg data"
+    archive.close()
+
+
+def test_archive_truncates_on_resume(tmpdir):
+    path = str(tmpdir.join("sweep_archive.tar"))
+    archive = SweepArchive(path)
+    archive.add("evals_a.dat", "a"*1000)
+    archive.close()
+
+    # an interrupted write leaves the header and part of the data of an
+    # unindexed member instead of the end-of-archive marker
+    info = tarfile.TarInfo("evals_c.dat.gz")
+    info.size = 5000
+    offset, _ = read_archive_index(path)["evals_a.dat.gz"]
+    with open(path, "r+b") as f:
+        f.seek(offset + tarfile.BLOCKSIZE)
+        f.write(info.tobuf() + "c"*1000)
+
+    archive = SweepArchive(path)
+    archive.add("evals_b.dat", "b"*2000)
+    archive.close()
+
+    index = read_archive_index(path)
+    assert sorted(index) == ["evals_a.dat.gz", "evals_b.dat.gz"]
+    with tarfile.open(path) as tar:
+        assert tar.getnames() == ["evals_a.dat.gz", "evals_b.dat.gz"]
+
+    archive = SweepArchive(path)
+    assert archive.read("evals_a.dat.gz") == "a"*1000
+    assert archive.read("evals_b.dat.gz") == "b"*2000
+    archive.close()
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from scipy.ndimage import (gaussian_filter, maximum_filter, minimum_filter,
+                           uniform_filter)
+
+from wavefunction_peaks import filter_tiled, find_local_extrema
+
+
+def get_grid(ny=40, nx=301):
+    x = np.linspace(0., 10., nx)
+    y = np.linspace(0., 1., ny)
+    X, Y = np.meshgrid(x, y)
+    Z = np.random.RandomState(0).rand(ny, nx)
+    return X, Y, Z
+
+
+@pytest.mark.parametrize("filter, sigma, reference", [
+    ('uniform', (3, 7), uniform_filter),
+    ('uniform', (2.5, 4.5), uniform_filter),
+    ('gauss', (1.5, 4.), gaussian_filter)])
+def test_filter_tiled_matches_untiled_filter(filter, sigma, reference):
+    _, _, P = get_grid()
+    P_untiled = reference(P, sigma, mode='constant')
+
+    for tile_width in (1, 10, 64, 1000):
+        P_tiled = filter_tiled(P, sigma, filter=filter, tile_width=tile_width,
+                               nthreads=2)
+        # the running sums of uniform_filter differ by round-off per tile
+        assert np.allclose(P_tiled, P_untiled, rtol=0., atol=1e-12)
+
+
+def get_untiled_extrema(Z, X, Y, xlim, ylim, extremum_filter, size):
+    window = ((xlim[0] < X) & (X < xlim[1]) & (ylim[0] < Y) & (Y < ylim[1]))
+    extrema = (Z == extremum_filter(Z, size=size, mode='reflect')) & window
+    return set(zip(X[extrema], Y[extrema]))
+
+
+@pytest.mark.parametrize("peak_type, extremum_filter", [
+    ('minimum', minimum_filter), ('maximum', maximum_filter)])
+@pytest.mark.parametrize("xlim, ylim", [
+    ((-1., 11.), (-1., 2.)), ((2.05, 7.3), (0.1, 0.8))])
+def test_find_local_extrema_tiling(peak_type, extremum_filter, xlim, ylim):
+    X, Y, Z = get_grid()
+    size = 5
+    reference = get_untiled_extrema(Z, X, Y, xlim, ylim, extremum_filter, size)
+    assert reference
+
+    for tile_width in (1, 3, 50, 1000):
+        x, y = find_local_extrema(Z, X, Y, xlim, ylim, peak_type=peak_type,
+                                  size=size, tile_width=tile_width)
+        assert len(x) == len(reference)
+        assert set(zip(x, y)) == reference
+
+    # meshgrid with x varying along axis 0 (pic_ascii)
+    x, y = find_local_extrema(Z.T, X.T, Y.T, xlim, ylim, peak_type=peak_type,
+                              size=size, tile_width=17)
+    assert set(zip(x, y)) == reference
@@ -2,21 +2,24 @@
 
 import json
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import os
 import matplotlib
 if os.environ.get('SLURM_NTASKS'):
     matplotlib.use("Agg")
     print "Using 'Agg' backend..."
-from scipy.ndimage.filters import gaussian_filter, uniform_filter
-from scipy import stats
+from scipy.ndimage.filters import (gaussian_filter, maximum_filter,
+                                   minimum_filter, uniform_filter)
 import sys
 
 import argh
 
 from ascii_to_numpy import read_ascii_array
-from ep.helpers import get_local_peaks
 from helper_functions import convert_json_to_cfg
+from potential_writer import write_potential_file
+from pyramid import (build_pyramid, get_dpi, load_pyramid, save_pyramid,
+                     select_level)
 
 FILE_NAME = "peaks"
 PIC_ASCII_YMIN = 0.2375
@@ -27,6 +30,240 @@ PLOT_FIGSIZE = (200, 100)
 PLOT_FIGSIZE_SCALING = 25
 PLOT_FONTSIZE = 100
 PICKER_TOLERANCE = 5
+CUTOFF_BINS = 10000
+CUTOFF_BLOCKSIZE = 2**20
+FILTER_TILE_WIDTH = 2048
+GAUSSIAN_TRUNCATE = 4.0
+PEAK_FILTER_SIZE = 3
+
+
+def rasterize_peaks(x, y, shape, dx, value=POT_CUTOFF_VALUE, splat=False):
+    """Write the peak coordinates (x, y) to a grid of the given shape.
+
+    By default, each peak sets the grid-point (floor(y/dx), floor(x/dx)) to
+    value. If splat is True, the value is instead distributed over the four
+    surrounding grid-points with bilinear (sub-pixel) weights and
+    accumulated. Peaks outside the grid are discarded.
+    """
+
+    P = np.zeros(shape)
+    u, v = x/dx, y/dx
+    xn, yn = np.floor(u).astype(int), np.floor(v).astype(int)
+
+    if splat:
+        fx, fy = u - xn, v - yn
+        stencil = ((0, 0, (1. - fx)*(1. - fy)),
+                   (1, 0, fx*(1. - fy)),
+                   (0, 1, (1. - fx)*fy),
+                   (1, 1, fx*fy))
+    else:
+        stencil = ((0, 0, None), )
+
+    for sx, sy, w in stencil:
+        xi, yi = xn + sx, yn + sy
+        inside = (xi >= 0) & (xi < shape[1]) & (yi >= 0) & (yi < shape[0])
+        if w is None:
+            P[yi[inside], xi[inside]] = value
+        else:
+            np.add.at(P, (yi[inside], xi[inside]), value*w[inside])
+
+    return P
+
+
+def estimate_cutoff(P, bins=CUTOFF_BINS, blocksize=CUTOFF_BLOCKSIZE):
+    """Return the most frequent negative value of P.
+
+    The negative values are counted with np.bincount in bins equidistant
+    bins between P.min() and 0, processing blocks of about blocksize entries
+    at a time instead of copying and sorting all negative entries. The sums
+    of the values in each bin are accumulated in the same pass, and the
+    returned cutoff is the mean of the values in the most populated bin.
+    """
+
+    Pmin = P.min()
+    if Pmin >= 0.:
+        raise Exception("Error: cannot determine cutoff, P has no negative "
+                        "entries.")
+    scale = bins/-Pmin
+    rows = max(1, blocksize//P.shape[-1])
+
+    counts = np.zeros(bins, dtype=np.int64)
+    sums = np.zeros(bins)
+    for n in xrange(0, len(P), rows):
+        block = P[n:n+rows]
+        neg = block[block < 0.]
+        idx = np.minimum(((neg - Pmin)*scale).astype(np.intp), bins - 1)
+        counts += np.bincount(idx, minlength=bins)
+        sums += np.bincount(idx, weights=neg, minlength=bins)
+    imax = counts.argmax()
+
+    return sums[imax]/counts[imax]
+
+
+def filter_tiled(P, sigma, filter='uniform', tile_width=FILTER_TILE_WIDTH,
+                 nthreads=None):
+    """Apply a uniform or gaussian filter (mode='constant') to P in column
+    tiles processed by a pool of threads.
+
+    Each tile of tile_width columns is filtered together with a halo of
+    neighboring columns whose width matches the filter extent in
+    x-direction, such that the result is identical to filtering the full
+    array at once (up to round-off of the running sums of uniform_filter).
+
+        Parameters:
+        -----------
+            P: (r_ny, r_nx) ndarray
+                Input array.
+            sigma: tuple of floats
+                Filter size (uniform) or standard deviation (gauss) in
+                (y, x)-direction.
+            filter: str (gauss|uniform)
+                Filter type.
+            tile_width: int
+                Number of columns per tile (without halo).
+            nthreads: int
+                Number of threads. Defaults to the number of CPUs.
+    """
+
+    sigmay, sigmax = sigma
+    if 'uniform' in filter:
+        filter_function = uniform_filter
+        halo = int(np.ceil(sigmax)) + 1
+    elif 'gauss' in filter:
+        filter_function = gaussian_filter
+        halo = int(GAUSSIAN_TRUNCATE*sigmax + 0.5) + 1
+    else:
+        return P
+
+    r_nx = P.shape[1]
+    P_filtered = np.empty_like(P)
+
+    def filter_tile(start):
+        stop = min(start + tile_width, r_nx)
+        lo, hi = max(0, start - halo), min(r_nx, stop + halo)
+        tile = filter_function(P[:, lo:hi], sigma, mode='constant')
+        P_filtered[:, start:stop] = tile[:, start-lo:stop-lo]
+
+    pool = ThreadPool(processes=nthreads)
+    pool.map(filter_tile, range(0, r_nx, tile_width))
+    pool.close()
+    pool.join()
+
+    return P_filtered
+
+
+def get_axes(X, Y):
+    """Return the 1D axes x and y of the meshgrid X, Y and whether x varies
+    along axis 0 (as for pic_ascii input) instead of axis 1."""
+
+    if X.shape[0] > 1 and X[1, 0] != X[0, 0]:
+        return X[:, 0], Y[0], True
+
+    return X[0], Y[:, 0], False
+
+
+def find_local_extrema(Z, X, Y, xlim, ylim, peak_type='minimum',
+                       size=PEAK_FILTER_SIZE, tile_width=FILTER_TILE_WIDTH):
+    """Return the coordinates of the local extrema of Z inside the window
+    xlim[0] < X < xlim[1], ylim[0] < Y < ylim[1].
+
+    A grid-point is a local minimum (maximum) if it equals the minimum
+    (maximum) of its size x size neighborhood. Only the window and a halo of
+    size//2 grid-points are filtered, in column tiles of tile_width columns,
+    and the coordinates are collected per tile, i.e., neither a full-size
+    boolean array nor a np.where pass over the full grid is needed. Points at
+    the edges of Z use mirrored neighbors (mode='reflect').
+
+        Parameters:
+        -----------
+            Z: (r_ny, r_nx) ndarray
+                Wavefunction intensity.
+            X, Y: (r_ny, r_nx) ndarrays
+                Meshgrid. Arrays of shape (r_nx, r_ny), i.e., with x
+                varying along axis 0 (pic_ascii), are supported as well.
+            xlim, ylim: tuples of floats
+                Open interval of the window in x- and y-direction.
+            peak_type: str (minimum|maximum)
+                Type of the extrema.
+            size: int
+                Neighborhood size.
+            tile_width: int
+                Number of columns per tile (without halo).
+
+        Returns:
+        --------
+            x, y: (N,) ndarrays
+                Coordinates of the extrema.
+    """
+
+    if 'min' in peak_type:
+        extremum_filter = minimum_filter
+    elif 'max' in peak_type:
+        extremum_filter = maximum_filter
+    else:
+        raise Exception("Error: peak_type {} not supported.".format(peak_type))
+
+    x_axis, y_axis, transposed = get_axes(X, Y)
+    if transposed:
+        Z = Z.T
+    cols = np.flatnonzero((xlim[0] < x_axis) & (x_axis < xlim[1]))
+    rows = np.flatnonzero((ylim[0] < y_axis) & (y_axis < ylim[1]))
+    if not len(cols) or not len(rows):
+        return np.array([]), np.array([])
+
+    r_ny, r_nx = Z.shape
+    halo = size//2
+    r0, r1 = rows[0], rows[-1] + 1
+    y_lo, y_hi = max(0, r0 - halo), min(r_ny, r1 + halo)
+
+    x, y = [], []
+    for start in xrange(cols[0], cols[-1] + 1, tile_width):
+        stop = min(start + tile_width, cols[-1] + 1)
+        x_lo, x_hi = max(0, start - halo), min(r_nx, stop + halo)
+        tile = Z[y_lo:y_hi, x_lo:x_hi]
+        tile_filtered = extremum_filter(tile, size=size, mode='reflect')
+
+        core = np.s_[r0-y_lo:r1-y_lo, start-x_lo:stop-x_lo]
+        iy, ix = np.nonzero(tile[core] == tile_filtered[core])
+        x.append(x_axis[start + ix])
+        y.append(y_axis[r0 + iy])
+
+    return np.concatenate(x), np.concatenate(y)
+
+
+def get_pyramids(X, Y, **arrays):
+    """Return the downsampled pyramids of the wavefunction intensities Z_n (max
+    pooling) and the potentials P_n (mean pooling) for plotting."""
+
+    pyramids = {}
+    for name, Z in arrays.iteritems():
+        pooling = 'mean' if name.startswith('P') else 'max'
+        pyramids[name] = build_pyramid(X, Y, Z, pooling=pooling)
+
+    return pyramids
+
+
+def load_pyramids(npz_file, X, Y, **arrays):
+    """Return the pyramids of the arrays stored in <npz_file>_pyramid.npz
+    (written with --savez), with the full resolution arrays as level 0.
+
+    Arrays without stored levels are skipped, as is a pyramid file older
+    than npz_file, such that the missing pyramids are rebuilt by
+    get_pyramids.
+    """
+
+    pyramid_file = npz_file.replace(".npz", "") + "_pyramid.npz"
+    if (not os.path.exists(pyramid_file) or
+            os.path.getmtime(pyramid_file) < os.path.getmtime(npz_file)):
+        return {}
+
+    pyramids = {}
+    for name, Z in arrays.iteritems():
+        levels = load_pyramid(pyramid_file, name, level0=(X, Y, Z))
+        if len(levels) > 1:
+            pyramids[name] = levels
+
+    return pyramids
 
 
 def on_pick(event, event_coordinates, fig):
@@ -61,11 +298,283 @@ def on_key(event, plt):
         plt.close()
 
 
+def read_cached_ascii_array(ascii_file, cache=False, **ascii_array_kwargs):
+    """Read a wavefunction with read_ascii_array and, if cache is True, cache
+    the result in <ascii_file>.npz.
+
+    Only Z and the 1D axes x and y are cached, the meshgrid X, Y is rebuilt
+    on load. The cache is reused if it is newer than the .ascii file and was
+    written with the same read_ascii_array settings.
+    """
+
+    cache_file = ascii_file + ".npz"
+    settings = json.dumps(ascii_array_kwargs, sort_keys=True)
+
+    if (cache and os.path.exists(cache_file) and
+            os.path.getmtime(cache_file) >= os.path.getmtime(ascii_file)):
+        npz_file = np.load(cache_file)
+        if str(npz_file['settings']) == settings:
+            print "Using cached {}...".format(cache_file)
+            X, Y = np.meshgrid(npz_file['x'], npz_file['y'])
+            if npz_file['transposed']:
+                X, Y = X.T, Y.T
+            return X, Y, npz_file['Z']
+
+    X, Y, Z = read_ascii_array(ascii_file, **ascii_array_kwargs)
+    if cache:
+        x, y, transposed = get_axes(X, Y)
+        np.savez(cache_file, x=x, y=y, transposed=transposed, Z=Z,
+                 settings=settings)
+
+    return X, Y, Z
+
+
+def read_modes(mode_files, cache=False, nprocs=None, **ascii_array_kwargs):
+    """Read the wavefunction intensities of all mode files concurrently on
+    up to nprocs processes (defaults to the number of CPUs).
+
+        Returns:
+        --------
+            X, Y: ndarrays
+                Meshgrid of the first mode.
+            Z: dict
+                Wavefunction intensities |psi|^2, keyed by the mode number
+                (1, 2, ...) given by the position in mode_files.
+    """
+
+    kwargs = dict(ascii_array_kwargs, cache=cache)
+    nprocs = min(len(mode_files), nprocs or multiprocessing.cpu_count())
+
+    if nprocs > 1:
+        pool = multiprocessing.Pool(processes=nprocs)
+        try:
+            R = [pool.apply_async(read_cached_ascii_array, args=(m,),
+                                  kwds=kwargs) for m in mode_files]
+            results = [r.get() for r in R]
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [read_cached_ascii_array(m, **kwargs) for m in mode_files]
+
+    X, Y, _ = results[0]
+    Z = dict((n, Zn) for n, (_, _, Zn) in enumerate(results, 1))
+
+    return X, Y, Z
+
+
+def load_npz_potential(npz_potential):
+    """Read the arrays written with the --savez option.
+
+        Returns:
+        --------
+            X, Y: ndarrays
+                Meshgrid.
+            Z: dict
+                Wavefunction intensities keyed by the mode number.
+            potentials: dict
+                Tuples (P, x, y) of potential and peak coordinates keyed by
+                the mode number.
+    """
+
+    npz_file = np.load(npz_potential)
+    X, Y = npz_file['X'], npz_file['Y']
+
+    Z, potentials = {}, {}
+    for key in npz_file.files:
+        name, _, n = key.partition('_')
+        if name == 'Z':
+            Z[int(n)] = npz_file[key]
+        elif name == 'P' and n:
+            potentials[int(n)] = tuple(npz_file[s + '_' + n]
+                                       for s in ('P', 'x', 'y'))
+    if not potentials and 'P' in npz_file.files:
+        potentials[0] = tuple(npz_file[s] for s in ('P', 'x', 'y'))
+
+    return X, Y, Z, potentials
+
+
+def build_potential(Z, X, Y, mode=1, L=10., W=1., sigmax=10., sigmay=1.,
+                    amplitude=1., pic_ascii=False, txt_potential=None,
+                    peak_function='local', threshold=None, shift=None,
+                    interpolate=0, spline_degree=1,
+                    limits=[1e-2, 0.99, 5e-2, 0.95], interactive=False,
+                    filter='uniform', cutoff=None, eta0=None, splat=False,
+                    binary_potential=False, cutoff_bins=CUTOFF_BINS,
+                    tile_width=FILTER_TILE_WIDTH, nthreads=None,
+                    coordinates_file=FILE_NAME + '.dat'):
+    """Construct the greens_code potential from the wavefunction intensity Z
+    of a single mode and write it to mode_<mode>_peaks_potential.dat.
+
+    See main for a description of the parameters.
+
+        Returns:
+        --------
+            P: ndarray
+                Potential.
+            x, y: (N,) ndarrays
+                Coordinates of the peaks used to construct the potential.
+    """
+
+    print "Building potential based on mode {}...".format(mode)
+    P = np.zeros_like(X)
+
+    if len(limits) != 4:
+        raise Exception("Error: --limits option needs exactly 4 entries.")
+    # define waveguide geometry (avoid minima due to boundary conditions
+    # at walls)
+    xlim = (limits[0]*L, limits[1]*L)
+    ylim = (limits[2]*W, limits[3]*W)
+    if pic_ascii:
+        ylim = (PIC_ASCII_YMIN*W, PIC_ASCII_YMAX*W)
+
+    if 'local' in peak_function:
+        x, y = find_local_extrema(Z, X, Y, xlim, ylim, peak_type='minimum',
+                                  tile_width=tile_width)
+    else:
+        X_mask = np.logical_and(xlim[0] < X, X < xlim[1])
+        Y_mask = np.logical_and(ylim[0] < Y, Y < ylim[1])
+        WG_mask = np.logical_and(X_mask, Y_mask)
+
+        if 'cut' in peak_function:
+            peaks = np.logical_and(Z < threshold*Z.max(), WG_mask)
+        elif 'const' in peak_function:
+            peaks = np.ones_like(Z)
+        else:
+            peaks = np.zeros_like(Z)
+
+        # get array-indices of peaks
+        idx = np.where(peaks)
+        x, y = [u[idx].flatten() for u in (X, Y)]
+    print "Found {} peaks...".format(len(x))
+
+    if txt_potential:
+        print "Loading txt_potential..."
+        x, y = np.loadtxt(txt_potential, unpack=True)
+
+    if interactive:
+        print "Starting interactive session..."
+        from matplotlib import pyplot as plt
+        from ep.plot import get_colors
+
+        _, cmap, _ = get_colors()
+
+        fig, ax = plt.subplots()
+
+        ax.pcolormesh(X, Y, Z, picker=PICKER_TOLERANCE, cmap=cmap)
+        ax.scatter(x, y, s=5e1, c="w", edgecolors=None)
+        ax.set_xlim(X.min(), X.max())
+        ax.set_ylim(Y.min(), Y.max())
+
+        event_coordinates = []
+        on_pick_lambda = lambda s: on_pick(s, event_coordinates, fig)
+        key_press_lambda = lambda s: on_key(s, plt)
+        fig.canvas.callbacks.connect('pick_event', on_pick_lambda)
+        fig.canvas.callbacks.connect('key_press_event', key_press_lambda)
+        plt.show()
+        try:
+            x, y = np.asarray(event_coordinates).T
+        except:
+            print """Warning: event_coordinates cannot be unpacked.
+            Proceeding with old (x,y) values."""
+
+    # sort coordinates wrt x-coordinate
+    x, y = [u[np.argsort(x)] for u in (x, y)]
+
+    if interpolate:
+        print "Interpolating data points..."
+        from scipy.interpolate import splprep, splev
+
+        tck, _ = splprep([x, y], s=0.0, k=spline_degree)
+        x, y = splev(np.linspace(0, 1, interpolate), tck)
+
+    # reapply limits
+    x_mask = (x > L*limits[0]) & (x < L*limits[1])
+    x, y = [u[x_mask] for u in x, y]
+
+    # write potential to grid-points
+    print "Writing potential to grid-points..."
+    # TODO: factor was 1.05 - introduces bugs?
+    # eps = W/P.shape[0]*1.10
+    # for xi, yi in zip(x, y):
+    #     zi = np.where((np.abs(X - xi) < eps) & (np.abs(Y - yi) < eps))
+    #     P[zi] = POT_CUTOFF_VALUE
+    if 'const' in peak_function:
+        P = 1.*peaks
+    else:
+        dx = L/P.shape[1]
+        P = rasterize_peaks(x, y, P.shape, dx, splat=splat)
+
+    # sigma here is in % of waveguide width W (r_ny) [caveat: P = P(y,x)]
+    sigmax, sigmay = [P.shape[0]*s/100. for s in sigmax, sigmay]
+
+    # decorate data points with filter
+    print "Applying filter..."
+    P = filter_tiled(P, (sigmay, sigmax), filter=filter,
+                     tile_width=tile_width, nthreads=nthreads)
+
+    # normalize potential based on most frequent value P_ij < 0.
+    print "Normalize potential..."
+    if not cutoff:
+        print "Determine cutoff..."
+        cutoff = estimate_cutoff(P, bins=cutoff_bins)
+        print "cutoff value:", cutoff
+    P[P < 0.99*cutoff] = POT_CUTOFF_VALUE
+    P /= -P.min()
+
+    # the envelopes only depend on x: apply them in place via
+    # broadcasting along the 1D x-axis to avoid full-size temporaries
+    x_axis, _, transposed = get_axes(X, Y)
+    if transposed:
+        x_axis = x_axis[:, np.newaxis]
+
+    if 'sine' in peak_function:
+        print "Applying sine envelope..."
+        L0 = L*(limits[1] - limits[0])/2.
+        envelope = np.sin(np.pi/(2.*L0)*(x_axis - L*limits[0]))
+        P *= envelope
+
+    if 'eps' in peak_function:
+        print "Applying eps_sq envelope..."
+        print "WARNING: using eps(x)/eps0 = 0.5(1-cos(2pi/Lx)) parametrization!"
+
+        L0 = L*(limits[1] - limits[0])/2.
+        envelope = 0.5*(1. - np.cos(np.pi/L0*(x_axis - L*limits[0])))
+        if 'sq' in peak_function:
+            envelope *= envelope
+        P *= envelope
+
+    if shift:
+        print "Shifting indices of target array..."
+        for n, vn in np.loadtxt(shift):
+            P[:, n] = np.roll(P[:, n], -int(vn), axis=0)
+
+    # scale potential
+    P *= amplitude
+
+    if eta0:
+        P += eta0
+
+    print "Writing potential based on mode {}...".format(mode)
+    potential_file = "mode_{}_peaks_potential".format(mode)
+    write_potential_file(potential_file + ".dat", P.flatten('F'))
+    if binary_potential:
+        write_potential_file(potential_file + ".bin", P.flatten('F'),
+                             binary=True)
+
+    # always write the potential coordinates
+    print "Writing coordinates file..."
+    np.savetxt(coordinates_file, zip(x, y))
+
+    return P, x, y
+
+
+@argh.arg('--modes', type=str, nargs='+')
 @argh.arg('--mode1', type=str)
 @argh.arg('--mode2', type=str)
 @argh.arg('--npz-potential', type=str)
 @argh.arg('--txt-potential', type=str)
-@argh.arg('--write-peaks', type=str)
+@argh.arg('--write-peaks', type=str, nargs='+')
 @argh.arg('--r-nx', type=int)
 @argh.arg('--r-ny', type=int)
 @argh.arg('--shift', type=str)
@@ -73,14 +582,19 @@ def on_key(event, plt):
 @argh.arg('--cutoff', type=float)
 @argh.arg('--limits', type=float, nargs='+')
 @argh.arg('--eta0', type=float)
+@argh.arg('--nthreads', type=int)
+@argh.arg('--nprocs', type=int)
 def main(pphw=50, N=2.6, L=10., W=1., sigmax=10., sigmay=1.,
          amplitude=1., r_nx=None, r_ny=None, plot=False,
-         pic_ascii=False, write_peaks=None, mode1=None, mode2=None,
-         npz_potential=None, txt_potential=None, peak_function='local',
-         savez=False, threshold=None, shift=None, interpolate=0,
-         spline_degree=1,
+         pic_ascii=False, write_peaks=None, modes=None, mode1=None,
+         mode2=None, npz_potential=None, txt_potential=None,
+         peak_function='local', savez=False, threshold=None, shift=None,
+         interpolate=0, spline_degree=1,
          limits=[1e-2, 0.99, 5e-2, 0.95], dryrun=False, no_mayavi=False,
-         interactive=False, filter='uniform', cutoff=None, eta0=None):
+         interactive=False, filter='uniform', cutoff=None, eta0=None,
+         splat=False, binary_potential=False, cutoff_bins=CUTOFF_BINS,
+         tile_width=FILTER_TILE_WIDTH, nthreads=None, cache=False,
+         nprocs=None):
     """Generate greens_code potentials from *.ascii files.
 
         Parameters:
@@ -101,10 +615,12 @@ def main(pphw=50, N=2.6, L=10., W=1., sigmax=10., sigmay=1.,
                 whether to plot wavefunctions and potentials
             pic_ascii: bool
                 build potential from pic.*.ascii files
-            write_peaks: int (1|2)
-                whether to construct a potential from mode 1 or 2
+            write_peaks: list of str (1|2|...|all)
+                modes from which potentials are constructed
+            modes: list of str
+                *.ascii files of modes 1, 2, ...
             mode1, mode2: str
-                *.ascii file of mode 1 and 2
+                *.ascii file of mode 1 and 2 (used if modes is not supplied)
             npz_potential: str
                 if supplied, use .npz file as input
             txt_potential: str
@@ -139,6 +655,26 @@ def main(pphw=50, N=2.6, L=10., W=1., sigmax=10., sigmay=1.,
                 chooses which filter to apply
             eta0: float
                 constant absorption background
+            splat: bool
+                whether to distribute each peak over the neighboring
+                grid-points with bilinear weights
+            binary_potential: bool
+                whether to additionally write the potential as raw float64
+                data (mode_*_peaks_potential.bin)
+            cutoff_bins: int
+                number of histogram bins used to determine the most frequent
+                negative potential value if no cutoff is supplied
+            tile_width: int
+                number of columns per tile when applying the filter and
+                searching the local minima
+            nthreads: int
+                number of threads used to filter the tiles
+            cache: bool
+                whether to cache the parsed wavefunction intensities in
+                <mode>.ascii.npz files for reuse
+            nprocs: int
+                number of processes reading the mode files (defaults to
+                the number of CPUs)
     """
     settings = json.dumps(vars(), sort_keys=True, indent=4)
     print settings + "\n"
@@ -150,11 +686,18 @@ def main(pphw=50, N=2.6, L=10., W=1., sigmax=10., sigmay=1.,
     if dryrun:
         sys.exit()
 
+    pyramids = {}
+    potentials = {}
+
     if npz_potential:
-        npz_file = np.load(npz_potential)
-        npz_vars = ('X', 'Y', 'Z_1', 'Z_2', 'P', 'x', 'y')
-        X, Y, Z_1, Z_2, P, x, y = [npz_file[s] for s in npz_vars]
+        X, Y, Z, potentials = load_npz_potential(npz_potential)
+        arrays = dict(('Z_{}'.format(n), Zn) for n, Zn in Z.iteritems())
+        arrays.update(('P_{}'.format(n), P)
+                      for n, (P, _, _) in potentials.iteritems())
+        pyramids = load_pyramids(npz_potential, X, Y, **arrays)
     else:
+        if not modes:
+            modes = [m for m in (mode1, mode2) if m is not None]
         ascii_array_kwargs = {'L': L,
                               'W': W,
                               'pphw': pphw,
@@ -164,17 +707,10 @@ def main(pphw=50, N=2.6, L=10., W=1., sigmax=10., sigmay=1.,
                               'pic_ascii': pic_ascii,
                               'return_abs': True}
         print "Reading .ascii files..."
-        try:
-            pool = multiprocessing.Pool(processes=2)
-            R = [pool.apply_async(read_ascii_array, args=(m,),
-                                  kwds=ascii_array_kwargs) for m in (mode1,
-                                                                     mode2)]
-            (X, Y, Z_1), (_, _, Z_2) = [r.get() for r in R]
-        except:
-            X, Y, Z_1 = read_ascii_array(mode1, **ascii_array_kwargs)
-            _, _, Z_2 = read_ascii_array(mode2, **ascii_array_kwargs)
+        X, Y, Z = read_modes(modes, cache=cache, nprocs=nprocs,
+                             **ascii_array_kwargs)
 
-    if plot or interactive:
+    if plot:
         # import matplotlib
         from matplotlib import pyplot as plt
         from ep.plot import get_colors
@@ -182,167 +718,95 @@ def main(pphw=50, N=2.6, L=10., W=1., sigmax=10., sigmay=1.,
         _, cmap, _ = get_colors()
 
     if write_peaks:
-        if write_peaks == '1':
-            Z = Z_1
-        elif write_peaks == '2':
-            Z = Z_2
-
-        print "Building potential based on mode {}...".format(write_peaks)
-        P = np.zeros_like(X)
-
-        if len(limits) != 4:
-            raise Exception("Error: --limits option needs exactly 4 entries.")
-        # define waveguide geometry (avoid minima due to boundary conditions
-        # at walls)
-        X_mask = np.logical_and(limits[0]*L < X, X < limits[1]*L)
-        Y_mask = np.logical_and(limits[2]*W < Y, Y < limits[3]*W)
-        if pic_ascii:
-            Y_mask = np.logical_and(PIC_ASCII_YMIN*W < Y, Y < PIC_ASCII_YMAX*W)
-        WG_mask = np.logical_and(X_mask, Y_mask)
-
-        if 'local' in peak_function:
-            peaks = get_local_peaks(Z, peak_type='minimum')
-            peaks[~WG_mask] = 0.0
-        elif 'cut' in peak_function:
-            peaks = np.logical_and(Z < threshold*Z.max(), WG_mask)
-        elif 'const' in peak_function:
-            peaks = np.ones_like(Z)
-        else:
-            peaks = np.zeros_like(Z)
-
-        # get array-indices of peaks
-        idx = np.where(peaks)
-        print "Found {} peaks...".format(len(idx[0]))
-        x, y = [u[idx].flatten() for u in (X, Y)]
-
-        if txt_potential:
-            print "Loading txt_potential..."
-            x, y = np.loadtxt(txt_potential, unpack=True)
-
-        if interactive:
-            print "Starting interactive session..."
-
-            fig, ax = plt.subplots()
-
-            ax.pcolormesh(X, Y, Z, picker=PICKER_TOLERANCE, cmap=cmap)
-            ax.scatter(x, y, s=5e1, c="w", edgecolors=None)
-            ax.set_xlim(X.min(), X.max())
-            ax.set_ylim(Y.min(), Y.max())
-
-            event_coordinates = []
-            on_pick_lambda = lambda s: on_pick(s, event_coordinates, fig)
-            key_press_lambda = lambda s: on_key(s, plt)
-            fig.canvas.callbacks.connect('pick_event', on_pick_lambda)
-            fig.canvas.callbacks.connect('key_press_event', key_press_lambda)
-            plt.show()
-            try:
-                x, y = np.asarray(event_coordinates).T
-            except:
-                print """Warning: event_coordinates cannot be unpacked.
-                Proceeding with old (x,y) values."""
-
-        # sort coordinates wrt x-coordinate
-        x, y = [u[np.argsort(x)] for u in (x, y)]
-
-        if interpolate:
-            print "Interpolating data points..."
-            from scipy.interpolate import splprep, splev
-
-            tck, _ = splprep([x, y], s=0.0, k=spline_degree)
-            x, y = splev(np.linspace(0, 1, interpolate), tck)
-
-        # reapply limits
-        x_mask = (x > L*limits[0]) & (x < L*limits[1])
-        x, y = [u[x_mask] for u in x, y]
-
-        # write potential to grid-points
-        print "Writing potential to grid-points..."
-        # TODO: factor was 1.05 - introduces bugs?
-        # eps = W/P.shape[0]*1.10
-        # for xi, yi in zip(x, y):
-        #     zi = np.where((np.abs(X - xi) < eps) & (np.abs(Y - yi) < eps))
-        #     P[zi] = POT_CUTOFF_VALUE
-        if 'const' in peak_function:
-            P = 1.*peaks
+        if 'all' in write_peaks:
+            write_peaks = sorted(Z.keys())
+        write_peaks = [int(n) for n in write_peaks]
+
+        potential_kwargs = {'L': L,
+                            'W': W,
+                            'sigmax': sigmax,
+                            'sigmay': sigmay,
+                            'amplitude': amplitude,
+                            'pic_ascii': pic_ascii,
+                            'txt_potential': txt_potential,
+                            'peak_function': peak_function,
+                            'threshold': threshold,
+                            'shift': shift,
+                            'interpolate': interpolate,
+                            'spline_degree': spline_degree,
+                            'limits': limits,
+                            'interactive': interactive,
+                            'filter': filter,
+                            'cutoff': cutoff,
+                            'eta0': eta0,
+                            'splat': splat,
+                            'binary_potential': binary_potential,
+                            'cutoff_bins': cutoff_bins,
+                            'tile_width': tile_width,
+                            'nthreads': nthreads}
+
+        def build_mode_potential(n):
+            if len(write_peaks) > 1:
+                coordinates_file = FILE_NAME + '_mode_{}.dat'.format(n)
+            else:
+                coordinates_file = FILE_NAME + '.dat'
+            return build_potential(Z[n], X, Y, mode=n,
+                                   coordinates_file=coordinates_file,
+                                   **potential_kwargs)
+
+        # the interactive session has to run in the main thread
+        if interactive or len(write_peaks) == 1:
+            results = [build_mode_potential(n) for n in write_peaks]
         else:
-            dx = L/P.shape[1]
-            xn, yn = [np.floor(u/dx) for u in x, y]
-            for xi, yi in zip(xn, yn):
-                P[yi, xi] = POT_CUTOFF_VALUE
-
-
-        # sigma here is in % of waveguide width W (r_ny) [caveat: P = P(y,x)]
-        sigmax, sigmay = [P.shape[0]*s/100. for s in sigmax, sigmay]
-
-        # decorate data points with filter
-        print "Applying filter..."
-        if 'uniform' in filter:
-            P = uniform_filter(P, (sigmay, sigmax), mode='constant')
-        elif 'gauss' in filter:
-            P = gaussian_filter(P, (sigmay, sigmax), mode='constant')
-
-        # normalize potential based on most frequent value P_ij < 0.
-        print "Normalize potential..."
-        if not cutoff:
-            print "Determine cutoff..."
-            cutoff = stats.mode(P[P < 0.])[0][0]
-            print "cutoff value:", cutoff
-        P[P < 0.99*cutoff] = POT_CUTOFF_VALUE
-        P /= -P.min()
-
-        if 'sine' in peak_function:
-            print "Applying sine envelope..."
-            L0 = L*(limits[1] - limits[0])/2.
-            envelope = np.sin(np.pi/(2.*L0)*(X - L*limits[0]))
-            P *= envelope
-
-        if 'eps' in peak_function:
-            print "Applying eps_sq envelope..."
-            print "WARNING: using eps(x)/eps0 = 0.5(1-cos(2pi/Lx)) parametrization!"
-
-            L0 = L*(limits[1] - limits[0])/2.
-            envelope = 0.5*(1. - np.cos(np.pi/L0*(X - L*limits[0])))
-            if 'sq' in peak_function:
-                envelope *= envelope
-            P *= envelope
-
-        if shift:
-            print "Shifting indices of target array..."
-            for n, vn in np.loadtxt(shift):
-                P[:, n] = np.roll(P[:, n], -int(vn), axis=0)
-
-        # scale potential
-        P *= amplitude
-
-        if eta0:
-            P += eta0
-
-        print "Writing potential based on mode {}...".format(write_peaks)
-        np.savetxt("mode_{}_peaks_potential.dat".format(write_peaks),
-                   list(enumerate(P.flatten('F'))))
-
-        # always write the potential coordinates
-        print "Writing coordinates file..."
-        np.savetxt(FILE_NAME + '.dat', zip(x, y))
+            pool = ThreadPool(processes=len(write_peaks))
+            results = pool.map(build_mode_potential, write_peaks)
+            pool.close()
+            pool.join()
+        potentials = dict(zip(write_peaks, results))
 
         if savez:
             print "Writing .npz file..."
-            np.savez(FILE_NAME + '.npz',
-                     X=X, Y=Y, Z_1=Z_1, Z_2=Z_2, P=P, x=x, y=y)
+            arrays = dict(('Z_{}'.format(n), Zn) for n, Zn in Z.iteritems())
+            for n, (P, x, y) in potentials.iteritems():
+                arrays.update({'P_{}'.format(n): P,
+                               'x_{}'.format(n): x,
+                               'y_{}'.format(n): y})
+            if len(potentials) == 1:
+                arrays.update(P=P, x=x, y=y)
+            np.savez(FILE_NAME + '.npz', X=X, Y=Y, **arrays)
+
+            print "Writing pyramid file..."
+            pyramid_arrays = dict(('Z_{}'.format(n), Zn)
+                                  for n, Zn in Z.iteritems())
+            pyramid_arrays.update(('P_{}'.format(n), P)
+                                  for n, (P, _, _) in potentials.iteritems())
+            pyramids = get_pyramids(X, Y, **pyramid_arrays)
+            save_pyramid(FILE_NAME + '_pyramid.npz', **pyramids)
 
     if plot:
         print "Plotting wavefunctions..."
         matplotlib.rcParams.update({'font.size': PLOT_FONTSIZE})
 
-        f, (ax1, ax2) = plt.subplots(nrows=2, figsize=PLOT_FIGSIZE)
+        for n, Zn in Z.iteritems():
+            if 'Z_{}'.format(n) not in pyramids:
+                pyramids.update(get_pyramids(X, Y, **{'Z_{}'.format(n): Zn}))
 
-        # scattering wavefunction
-        ax1.pcolormesh(X, Y, Z_1, cmap=cmap)
-        ax2.pcolormesh(X, Y, Z_2, cmap=cmap)
+        f, axes = plt.subplots(nrows=len(Z), figsize=PLOT_FIGSIZE,
+                               squeeze=False)
+        axes = axes[:, 0]
 
-        if write_peaks:
-            ax1.scatter(x, y, s=1.5e4, c="w", edgecolors=None)
-            ax2.scatter(x, y, s=1.5e4, c="w", edgecolors=None)
+        # scattering wavefunctions (rendered from the coarsest level which
+        # resolves the output image)
+        axsize = (PLOT_FIGSIZE[0], PLOT_FIGSIZE[1]/float(len(Z)))
+        for ax, n in zip(axes, sorted(Z.keys())):
+            ax.pcolormesh(*select_level(pyramids['Z_{}'.format(n)], axsize,
+                                        dpi=get_dpi(PLOT_FIGSIZE)),
+                          cmap=cmap)
+
+            # a single set of peaks is shown in all panels
+            if write_peaks and (len(potentials) == 1 or n in potentials):
+                _, x, y = potentials.get(n, potentials.values()[0])
+                ax.scatter(x, y, s=1.5e4, c="w", edgecolors=None)
 
         # if npz_potential:
         #     X_nodes = npz_file['x']
@@ -350,37 +814,48 @@ def main(pphw=50, N=2.6, L=10., W=1., sigmax=10., sigmay=1.,
         #     ax1.scatter(X_nodes, Y_nodes, s=1e4, c="k", edgecolors=None)
         #     ax2.scatter(X_nodes, Y_nodes, s=1e4, c="k", edgecolors=None)
 
-        for ax in (ax1, ax2):
+        for ax in axes:
             ax.set_xlim(X.min(), X.max())
             ax.set_ylim(Y.min(), Y.max())
 
-        plt.savefig(FILE_NAME + '_wavefunction.png', bbox_inches='tight')
-
-        print "Plotting 2D potential..."
-        f, ax = plt.subplots(figsize=(PLOT_FIGSIZE_SCALING*L,
-                                      PLOT_FIGSIZE_SCALING*W))
-        ax.set_xlim(X.min(), X.max())
-        ax.set_ylim(Y.min(), Y.max())
-        ax.grid(True)
-        p = ax.pcolormesh(X, Y, P, cmap=cmap)
-        f.colorbar(p)
-        ax.set_aspect('equal', 'datalim')
-        plt.savefig(FILE_NAME + '_potential_2D.png', bbox_inches='tight')
-
-        if not no_mayavi:
-            try:
-                print "Plotting 3D potential..."
-                from mayavi import mlab
-
-                mlab.figure(size=(1024, 756))
-                extent = (0, 1, 0, 5, 0, 1)
-                p = mlab.surf(-P, extent=extent)
-                cmap = cmap(np.arange(256))*255.
-                p.module_manager.scalar_lut_manager.lut.table = cmap
-                mlab.view(distance=7.5)
-                mlab.savefig(FILE_NAME + '_potential_3D.png')
-            except:
-                print "Error: potential image not written."
+        plt.savefig(FILE_NAME + '_wavefunction.png', bbox_inches='tight',
+                    dpi=get_dpi(PLOT_FIGSIZE))
+
+        for n, (P, _, _) in sorted(potentials.iteritems()):
+            if len(potentials) > 1:
+                potential_name = FILE_NAME + '_mode_{}_potential'.format(n)
+            else:
+                potential_name = FILE_NAME + '_potential'
+
+            print "Plotting 2D potential..."
+            key = 'P_{}'.format(n)
+            if key not in pyramids:
+                pyramids.update(get_pyramids(X, Y, **{key: P}))
+            figsize = (PLOT_FIGSIZE_SCALING*L, PLOT_FIGSIZE_SCALING*W)
+            f, ax = plt.subplots(figsize=figsize)
+            ax.set_xlim(X.min(), X.max())
+            ax.set_ylim(Y.min(), Y.max())
+            ax.grid(True)
+            p = ax.pcolormesh(*select_level(pyramids[key], figsize), cmap=cmap)
+            f.colorbar(p)
+            ax.set_aspect('equal', 'datalim')
+            plt.savefig(potential_name + '_2D.png', bbox_inches='tight',
+                        dpi=get_dpi(figsize))
+
+            if not no_mayavi:
+                try:
+                    print "Plotting 3D potential..."
+                    from mayavi import mlab
+
+                    mlab.figure(size=(1024, 756))
+                    extent = (0, 1, 0, 5, 0, 1)
+                    p = mlab.surf(-P, extent=extent)
+                    lut = cmap(np.arange(256))*255.
+                    p.module_manager.scalar_lut_manager.lut.table = lut
+                    mlab.view(distance=7.5)
+                    mlab.savefig(potential_name + '_3D.png')
+                except:
+                    print "Error: potential image not written."
 
 
 if __name__ == '__main__':
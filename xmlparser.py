@@ -1,11 +1,117 @@
 #!/usr/bin/env python2.7
 
+import os
+import time
+
 import argh
 try:
     from lxml import etree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
 
+from helper_functions import open_archived_file, split_archive_path
+
+
+# process-wide parameter cache, keyed by (absolute path, modification time,
+# size, inode)
+_PARAMS_CACHE = {}
+# files modified less than this many seconds ago are not cached, since a
+# rewrite within the mtime resolution of the filesystem would go unnoticed
+MTIME_RESOLUTION = 2.
+
+# parameters required to determine the grid settings
+GRID_PARAMS = ('modes', 'points_per_halfwave', 'W', 'L')
+
+
+def get_grid_params(params):
+    """Return the grid settings derived from the xml parameters."""
+
+    nyout = params.get("modes")*params.get("points_per_halfwave")
+    dx = params.get("W")/(nyout + 1.)
+    dy = dx
+    r_nx = int(params.get("L")/dx)
+    r_ny = int(params.get("W")/dy)
+    pot_len = r_nx*r_ny
+
+    values = {
+            'nyout': nyout,
+            'dx': dx,
+            'dy': dy,
+            'r_nx': r_nx,
+            'r_ny': r_ny,
+            'pot_len': pot_len}
+
+    return values
+
+
+def _stream_params(xml):
+    """Read all numerical parameters from the input xml file with iterparse.
+
+    Elements are freed as soon as they have been processed and parsing stops
+    once the section containing the parameters has been closed (provided all
+    grid parameters have been found), such that the remaining document is
+    never read. Gzipped files (*.gz) are decompressed on the fly and members
+    of sweep archives can be read directly (see
+    helper_functions.open_archived_file).
+    """
+
+    params = {}
+    depth = 0
+    param_depth = None
+
+    with open_archived_file(xml) as f:
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                continue
+
+            depth -= 1
+            if elem.tag == 'param':
+                param_depth = depth
+                name = elem.attrib.get('name')
+                value = elem.text
+                try:
+                    params[name] = float(value)
+                except (TypeError, ValueError):
+                    pass
+                elem.clear()
+            elif param_depth is not None and depth < param_depth:
+                # the enclosing parameter section has been closed
+                if all(p in params for p in GRID_PARAMS):
+                    break
+                param_depth = None
+
+    # avoid confusion between parameter 'N' from the input-vector object
+    # and the variable 'N' used for modes in the Waveguide class
+    params.pop("N", None)
+    params.pop("v[i]", None)
+
+    params.update(get_grid_params(params))
+
+    return params
+
+
+def read_params(xml):
+    """Return a dictionary of the parameters parsed from the input xml.
+
+    The result is cached for the lifetime of the process, keyed by the path
+    and the modification time, size and inode of the file (of the archive
+    for archived files), such that repeated calls (e.g., in parameter
+    sweeps) reduce to a dictionary lookup. Files modified within the last
+    MTIME_RESOLUTION seconds, e.g., an input.xml which has just been
+    rewritten in place, are always parsed again.
+    """
+
+    st = os.stat(split_archive_path(xml)[0])
+    if time.time() - st.st_mtime < MTIME_RESOLUTION:
+        return _stream_params(xml)
+
+    key = (os.path.abspath(xml), st.st_mtime, st.st_size, st.st_ino)
+    if key not in _PARAMS_CACHE:
+        _PARAMS_CACHE[key] = _stream_params(xml)
+
+    return dict(_PARAMS_CACHE[key])
+
 
 class XML(object):
     """Simple wrapper class for xml.etree.ElementTree/lxml.etree.
@@ -18,53 +124,21 @@ class XML(object):
         Attributes:
         -----------
             root: Element object
+                Root of the full element tree (parsed on first access).
             params: dict
                 Dictionary of the parameters parsed from the input xml.
     """
 
     def __init__(self, xml):
         self.xml = xml
-        self.root = ET.parse(xml).getroot()
-        self.params = self._read_xml()
-
-    def _read_xml(self):
-        """Read all variables from the input.xml file."""
-
-        params = {}
-        for elem in self.root.iter(tag='param'):
-            name = elem.attrib.get('name')
-            value = elem.text
-            try:
-                params[name] = float(value)
-            except ValueError:
-                pass
-
-        # avoid confusion between parameter 'N' from the input-vector object
-        # and the variable 'N' used for modes in the Waveguide class
-        try:
-            params.pop("N")
-            params.pop("v[i]")
-        except:
-            print "Warning: could not remove 'N' and 'v[i]' parameters."
-
-        nyout = params.get("modes")*params.get("points_per_halfwave")
-        dx = params.get("W")/(nyout + 1.)
-        dy = dx
-        r_nx = int(params.get("L")/dx)
-        r_ny = int(params.get("W")/dy)
-        pot_len = r_nx*r_ny
-
-        values = {
-                'nyout': nyout,
-                'dx': dx,
-                'dy': dy,
-                'r_nx': r_nx,
-                'r_ny': r_ny,
-                'pot_len': pot_len}
-
-        params.update(values)
-
-        return params
+        self._root = None
+        self.params = read_params(xml)
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = ET.parse(self.xml).getroot()
+        return self._root
 
 
 def parse_xml(infile='input.xml'):